@@ -0,0 +1,314 @@
+
+# 記録したハンドシェイクメッセージを使ったエンコード・デコードのベンチマーク
+#
+#   python -m benchmarks.codec record [--corpus DIR]
+#   python -m benchmarks.codec import-openssl MSG_LOG [--corpus DIR]
+#   python -m benchmarks.codec run [--corpus DIR] [--output FILE] [--baseline FILE]
+#
+# record は同じプロセスでサーバとクライアントを動かし，Handshake.from_bytes に
+# 渡されたメッセージのバイト列を corpus ディレクトリに tls13-<種類>.bin として保存する．
+# Certificate は受け取った証明書を繰り返して 3 つと 5 つの証明書チェーンも作る．
+#
+# import-openssl は `openssl s_client -msg` の出力からハンドシェイクメッセージを取り出して
+# openssl-<種類>.bin として保存する．
+#
+#   sleep 2 | openssl s_client -connect localhost:4433 -tls1_3 -msg > s_client.log
+#   python -m benchmarks.codec import-openssl s_client.log
+#
+# 証明書チェーンは s_server の -cert_chain で中間証明書を足して取る．
+#
+#   python -m benchmarks.codec import-openssl s_client.log --types certificate
+#
+# run は corpus の各メッセージについて，デコード (parse)，エンコード (serialize)，
+# デコードしてエンコード (round_trip)，レコードからのデコード (record_parse) の
+# 1秒あたりの回数と，デコードしたメッセージ1つが使うメモリ（tracemalloc）を JSON で出力する．
+# --baseline に前の結果を与えると，操作ごとに前の結果との比を表示する．
+
+import argparse
+import json
+import os
+import platform
+import re
+import threading
+import time
+import timeit
+import tracemalloc
+
+from tls13.protocol import *
+from tls13.metastruct import *
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), 'corpus')
+
+OPERATIONS = ['parse', 'serialize', 'round_trip', 'record_parse']
+
+
+def message_name(data):
+    """
+    ハンドシェイクメッセージのバイト列の種類の名前（client_hello など）．
+    2つ以上の証明書がある Certificate は certificate-chain3 のように証明書の数を付ける．
+    """
+    name = HandshakeType.labels().get(Uint8(data[0]), 'unknown_%d' % data[0])
+    if name == 'certificate':
+        length = len(Handshake.from_bytes(data).msg.certificate_list)
+        if length > 1:
+            name += '-chain%d' % length
+    return name
+
+
+def save_corpus(corpus, origin, messages):
+    """
+    messages（ハンドシェイクメッセージのバイト列のリスト）を corpus に保存して，
+    保存したファイル名のリストを返す．同じ種類が2つ目からは名前に番号を付ける．
+    """
+    os.makedirs(corpus, exist_ok=True)
+    counts = {}
+    filenames = []
+    for data in messages:
+        name = message_name(data)
+        counts[name] = counts.get(name, 0) + 1
+        if counts[name] > 1:
+            name += '-%d' % counts[name]
+        filename = os.path.join(corpus, '%s-%s.bin' % (origin, name))
+        with open(filename, 'wb') as f:
+            f.write(data)
+        filenames.append(filename)
+    return filenames
+
+
+def make_certificate_chain(data, length):
+    """
+    Certificate のバイト列 data の最初の証明書を length 個並べた Certificate を作る．
+    """
+    certificate = Handshake.from_bytes(data).msg
+    entry = certificate.certificate_list[0]
+    return Handshake(
+        msg_type=HandshakeType.certificate,
+        msg=Certificate(
+            certificate_request_context=certificate.certificate_request_context,
+            certificate_list=[entry] * length)).to_bytes()
+
+
+def record(corpus):
+    """
+    サーバとクライアントを動かして，受信したハンドシェイクメッセージを保存する．
+    """
+    from tls13.main import client, server
+
+    messages = []
+    lock = threading.Lock()
+    from_bytes = Handshake.from_bytes.__func__
+
+    def recording_from_bytes(cls, data, state=None):
+        with lock:
+            messages.append(bytes(data))
+        return from_bytes(cls, data, state)
+
+    Handshake.from_bytes = classmethod(recording_from_bytes)
+    try:
+        server_thread = threading.Thread(
+            target=server.server_cmd, args=(['-n', '1', '--trace', 'off'],))
+        server_thread.start()
+        time.sleep(0.5)
+        client.client_request(client.REQUEST)
+        server_thread.join()
+    finally:
+        Handshake.from_bytes = classmethod(from_bytes)
+
+    # サーバの証明書は1つなので，3つと5つの証明書チェーンは同じ証明書を並べて作る
+    certificates = [x for x in messages if message_name(x) == 'certificate']
+    for length in (3, 5):
+        messages += [make_certificate_chain(x, length) for x in certificates[:1]]
+    return save_corpus(corpus, 'tls13', messages)
+
+
+def parse_openssl_msg(text):
+    """
+    `openssl s_client -msg` の出力からハンドシェイクメッセージのバイト列を取り出す．
+
+        >>> TLS 1.3, Handshake [length 00c2], ClientHello
+            01 00 00 be 03 03 ...
+    """
+    messages = []
+    current = None
+    for line in text.splitlines():
+        if line.startswith(('>>> ', '<<< ')):
+            current = bytearray() if ', Handshake [' in line else None
+            if current is not None:
+                messages.append(current)
+        elif current is not None and re.fullmatch(r'\s+([0-9a-f]{2}\s*)+', line):
+            current += bytes.fromhex(line)
+        else:
+            current = None
+    return [bytes(x) for x in messages]
+
+
+def import_openssl(corpus, filename, types=None):
+    """
+    filename の s_client の出力のハンドシェイクメッセージを保存する．
+    types（certificate など）を与えたときはその種類のメッセージだけを保存する．
+    """
+    with open(filename) as f:
+        messages = parse_openssl_msg(f.read())
+    if types is not None:
+        messages = [x for x in messages
+                    if HandshakeType.labels().get(Uint8(x[0])) in types]
+    return save_corpus(corpus, 'openssl', messages)
+
+
+def load_corpus(corpus):
+    """
+    corpus の (名前, バイト列) のリストを名前の順に返す．
+    """
+    result = []
+    for filename in sorted(os.listdir(corpus)):
+        if filename.endswith('.bin'):
+            with open(os.path.join(corpus, filename), 'rb') as f:
+                result.append((filename[:-len('.bin')], f.read()))
+    return result
+
+
+def make_record(data):
+    return ContentType.handshake.to_bytes() + b'\x03\x03' + \
+        Uint16(len(data)).to_bytes() + data
+
+
+def decode(data):
+    # Handshake.from_bytes は msg を参照するまでデコードしない
+    return Handshake.from_bytes(data).msg
+
+
+def encode(msg_type, msg):
+    return Handshake(msg_type=msg_type, msg=msg).to_bytes()
+
+
+def measure_memory(data, count=200):
+    """
+    デコードしたメッセージを count 個残したときの1つあたりのメモリ [byte]．
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        msgs = [decode(data) for _ in range(count)]
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del msgs
+    return (after - before) // count
+
+
+def bench_message(data, number):
+    msg_type = Uint8(data[0])
+    msg = decode(data)
+    if encode(msg_type, msg) != data:
+        raise RuntimeError("round trip does not reproduce the message")
+
+    operations = {
+        'parse': lambda: decode(data),
+        'serialize': lambda: encode(msg_type, msg),
+        'round_trip': lambda: encode(msg_type, decode(data)),
+    }
+    # 1つのレコードに入らないメッセージはレコードからのデコードを測らない
+    if len(data) <= 2**14:
+        record = make_record(data)
+        operations['record_parse'] = \
+            lambda: TLSPlaintext.from_bytes(record).fragment.msg
+
+    result = {'size': len(data)}
+    for name, func in operations.items():
+        result[name] = number / timeit.timeit(func, number=number)
+    result['bytes_per_msg'] = measure_memory(data)
+    return result
+
+
+def run(corpus, number):
+    corpus_data = load_corpus(corpus)
+    if not corpus_data:
+        raise SystemExit("no messages in %s (run `record` first)" % corpus)
+    return {
+        'python': platform.python_version(),
+        'number': number,
+        'messages': {name: bench_message(data, number)
+                     for name, data in corpus_data},
+    }
+
+
+def compare(results, baseline):
+    """
+    操作ごとに baseline との比（大きいほど速い）を返す．メモリは baseline / results．
+    """
+    ratios = {}
+    for name, result in results['messages'].items():
+        base = baseline['messages'].get(name)
+        if base is None:
+            continue
+        ratios[name] = {op: result[op] / base[op]
+                        for op in OPERATIONS if op in result and op in base}
+        if result['bytes_per_msg'] and base['bytes_per_msg']:
+            ratios[name]['bytes_per_msg'] = \
+                base['bytes_per_msg'] / result['bytes_per_msg']
+    return ratios
+
+
+def print_results(results, ratios=None):
+    columns = OPERATIONS + ['bytes_per_msg']
+    print("%-32s %6s" % ('[ops/sec]', 'size') +
+          ''.join(' %13s' % x for x in columns))
+    for name, result in results['messages'].items():
+        line = "%-32s %6d" % (name, result['size'])
+        for column in columns:
+            if column not in result:
+                line += ' %13s' % '-'
+            elif ratios is not None and column in ratios.get(name, {}):
+                line += ' %7d(%.2fx)' % (result[column], ratios[name][column])
+            else:
+                line += ' %13d' % result[column]
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.codec')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    record_parser = subparsers.add_parser(
+        'record', help='record the messages of a handshake with our server')
+    record_parser.add_argument('--corpus', default=CORPUS_DIR)
+
+    openssl_parser = subparsers.add_parser(
+        'import-openssl', help='import messages from `openssl s_client -msg`')
+    openssl_parser.add_argument('msg_log')
+    openssl_parser.add_argument('--corpus', default=CORPUS_DIR)
+    openssl_parser.add_argument('--types', default=None,
+                                help='comma-separated message types to import, '
+                                     'e.g. "certificate"')
+
+    run_parser = subparsers.add_parser('run', help='run the benchmark')
+    run_parser.add_argument('--corpus', default=CORPUS_DIR)
+    run_parser.add_argument('--number', type=int, default=2000,
+                            help='iterations per operation (default: %(default)s)')
+    run_parser.add_argument('--output', default=None,
+                            help='write the results to this JSON file')
+    run_parser.add_argument('--baseline', default=None,
+                            help='JSON file of earlier results to compare with')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        for filename in record(args.corpus):
+            print(filename)
+    elif args.command == 'import-openssl':
+        types = args.types.split(',') if args.types else None
+        for filename in import_openssl(args.corpus, args.msg_log, types):
+            print(filename)
+    else:
+        results = run(args.corpus, args.number)
+        ratios = None
+        if args.baseline is not None:
+            with open(args.baseline) as f:
+                ratios = compare(results, json.load(f))
+        print_results(results, ratios)
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+# DuplexPipeline のベンチマーク
+#
+#   python -m benchmarks.pipeline [--size MB] [--repeat N]
+#
+# socketpair でつないだ2つのプロセスの間で size [MB] のアプリケーションデータを
+# 実際の暗号（TLS_CHACHA20_POLY1305_SHA256）で暗号化・復号して送り，
+# 送信側と受信側の両方で --pipeline を使わない場合と使う場合の
+# 経過時間とスループットを比べる．
+# 送信側は RecordWriter（パイプラインでは送信スレッド）で暗号化して送り，
+# 受信側は recv_app_data（パイプラインでは受信スレッド）で受信・復号する．
+
+import argparse
+import io
+import multiprocessing
+import socket
+import time
+
+from tls13.protocol import *
+from tls13.main.tlsconnection import TLSConnection
+from tls13.utils.pipeline import DuplexPipeline
+from tests.test_utils.common import make_connection
+
+CHUNK_SIZE = 2**16
+
+
+def send_data(sock, size, pipelined):
+    """
+    別のプロセスで size [bytes] のデータを暗号化して送り，接続を閉じる．
+    """
+    conn = make_connection(sock, b'\x02', b'\x01')
+    writer = RecordWriter(conn, None, state=conn.state,
+                          max_fragment_size=conn.state.max_fragment_size)
+    data = io.BytesIO(bytes(size))
+    if pipelined:
+        pipeline = DuplexPipeline(conn, TLSConnection.established(conn.state), writer)
+        pipeline.send(data)
+        pipeline.close()
+    else:
+        writer.write(data)
+        conn.close()
+
+
+def bench_transfer(size, pipelined):
+    """
+    相手のプロセスが送る size [bytes] のデータを受信し終わるまでの時間 [sec]．
+    """
+    sock, peer_sock = socket.socketpair()
+    conn = make_connection(sock, b'\x01', b'\x02', side='server')
+    sender = multiprocessing.get_context('fork').Process(
+        target=send_data, args=(peer_sock, size, pipelined))
+
+    start = time.perf_counter()
+    sender.start()
+    peer_sock.close()
+    tls = TLSConnection.established(conn.state)
+    if pipelined:
+        pipeline = DuplexPipeline(conn, tls, None)
+        recv = pipeline.recv
+    else:
+        recv = lambda: conn.recv_app_data(tls)
+    received = 0
+    while True:
+        data = recv()
+        if len(data) == 0:
+            break
+        received += len(data)
+    elapsed = time.perf_counter() - start
+    sender.join()
+    conn.close()
+    if received != size:
+        raise RuntimeError("received %d bytes, expected %d" % (received, size))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.pipeline')
+    parser.add_argument('--size', type=float, default=4,
+                        help='application data to transfer [MB] '
+                             '(default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='number of transfers per mode, the best one is '
+                             'reported (default: %(default)s)')
+    args = parser.parse_args()
+
+    size = int(args.size * 2**20)
+    for name, pipelined in (('sync', False), ('pipeline', True)):
+        elapsed = min(bench_transfer(size, pipelined)
+                      for _ in range(args.repeat))
+        print("%-8s %.1f MB: %.2fs, %.2f MB/s" %
+              (name, size / 2**20, elapsed, size / 2**20 / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+
+# TLS 構造体のエンコード・デコードのベンチマーク
+#
+#   python -m benchmarks.structs [--number N]
+#
+# 構造体ごとに to_bytes / len / from_bytes を number 回繰り返したときの
+# 1秒あたりの回数と，from_bytes で作った構造体1つが使うメモリ（tracemalloc）を表示する．
+
+import argparse
+import timeit
+import tracemalloc
+
+from tls13.protocol import *
+from tls13.metastruct import *
+
+
+def make_client_hello():
+    return Handshake(
+        msg_type=HandshakeType.client_hello,
+        msg=ClientHello(
+            random=bytes(32),
+            legacy_session_id=bytes(32),
+            cipher_suites=[CipherSuite.TLS_AES_128_GCM_SHA256,
+                           CipherSuite.TLS_CHACHA20_POLY1305_SHA256],
+            extensions=[
+                Extension(
+                    extension_type=ExtensionType.supported_versions,
+                    extension_data=SupportedVersions(
+                        msg_type=HandshakeType.client_hello,
+                        versions=[ProtocolVersion.TLS13])),
+                Extension(
+                    extension_type=ExtensionType.supported_groups,
+                    extension_data=NamedGroupList(
+                        named_group_list=[NamedGroup.x25519,
+                                          NamedGroup.secp256r1])),
+                Extension(
+                    extension_type=ExtensionType.signature_algorithms,
+                    extension_data=SignatureSchemeList(
+                        supported_signature_algorithms=[
+                            SignatureScheme.rsa_pss_rsae_sha256,
+                            SignatureScheme.ecdsa_secp256r1_sha256])),
+                Extension(
+                    extension_type=ExtensionType.key_share,
+                    extension_data=KeyShareClientHello(
+                        client_shares=[
+                            KeyShareEntry(group=NamedGroup.x25519,
+                                          key_exchange=bytes(32))])),
+            ]))
+
+
+def make_certificate():
+    return Certificate(certificate_list=[
+        CertificateEntry(cert_data=bytes(1200)) for _ in range(3)])
+
+
+def make_large_certificate():
+    # 大きな証明書の Certificate．from_bytes では証明書のバイト列を1回だけコピーする
+    return Handshake(
+        msg_type=HandshakeType.certificate,
+        msg=Certificate(certificate_list=[
+            CertificateEntry(cert_data=bytes(16000), extensions=[])
+            for _ in range(5)]))
+
+
+def make_offered_psks():
+    return OfferedPsks(
+        identities=[PskIdentity(identity=bytes(120),
+                                obfuscated_ticket_age=Uint32(1234))],
+        binders=[PskBinderEntry(binder=bytes(32))])
+
+
+def make_ticket_state():
+    return TicketState(cipher_suite=CipherSuite.TLS_AES_128_GCM_SHA256,
+                       ticket_age_add=Uint32(1), ticket_lifetime=Uint32(7200),
+                       issued_at=Uint32(0), psk=bytes(32))
+
+
+def make_ticket_file():
+    return SessionTicketFile(tickets=[
+        SessionTicketEntry(host=b'localhost', port=Uint16(50007), alpn=b'',
+                           cipher_suite=CipherSuite.TLS_AES_128_GCM_SHA256,
+                           ticket_age_add=Uint32(1), ticket_lifetime=Uint32(7200),
+                           received_at=Uint32(0), max_early_data_size=Uint32(0),
+                           psk=bytes(32), ticket=bytes(150))
+        for _ in range(4)])
+
+
+# (名前, 構造体を作る関数, バイト列から作る関数)
+CASES = [
+    ('KeyShareEntry',
+     lambda: KeyShareEntry(group=NamedGroup.x25519, key_exchange=bytes(32)),
+     KeyShareEntry.from_bytes),
+    ('OfferedPsks', make_offered_psks, OfferedPsks.from_bytes),
+    ('Certificate', make_certificate, Certificate.from_bytes),
+    ('Handshake(Certificate)', make_large_certificate, Handshake.from_bytes),
+    ('TicketState', make_ticket_state, TicketState.from_bytes),
+    ('SessionTicketFile', make_ticket_file, SessionTicketFile.from_bytes),
+    ('Handshake(ClientHello)', make_client_hello, Handshake.from_bytes),
+]
+
+
+def measure_memory(from_bytes, data, count=200):
+    """
+    from_bytes で作った構造体を count 個残したときの1つあたりのメモリ [byte]．
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        objs = [from_bytes(data) for _ in range(count)]
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del objs
+    return (after - before) // count
+
+
+def bench(number):
+    results = []
+    for name, make, from_bytes in CASES:
+        obj = make()
+        data = obj.to_bytes()
+        assert from_bytes(data).to_bytes() == data
+        encode = timeit.timeit(obj.to_bytes, number=number)
+        length = timeit.timeit(lambda: len(obj), number=number)
+        decode = timeit.timeit(lambda: from_bytes(data), number=number)
+        memory = measure_memory(from_bytes, data)
+        results.append((name, number / encode, number / length, number / decode,
+                        memory))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.structs')
+    parser.add_argument('--number', type=int, default=2000,
+                        help='iterations per operation (default: %(default)s)')
+    args = parser.parse_args()
+
+    print("%-24s %12s %12s %12s %12s" %
+          ('[ops/sec]', 'to_bytes', 'len', 'from_bytes', 'bytes/obj'))
+    for name, encode, length, decode, memory in bench(args.number):
+        print("%-24s %12.0f %12.0f %12.0f %12d" %
+              (name, encode, length, decode, memory))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+# unittest needs this file
@@ -0,0 +1,224 @@
+import os
+import unittest
+
+from tls13.main.tlsconnection import *
+from tls13.protocol import *
+from tls13.utils.antireplay import AntiReplayFilter
+from tls13.utils.psk import ExternalPsk, ExternalPskTable
+
+SSH_DIR = os.path.join(os.path.dirname(__file__), '..', '..', '.ssh')
+PSK_SPEC = 'client1:' + '00112233445566778899aabbccddeeff' * 2
+
+
+def handshake(client, server, chunk_size=None):
+    """
+    client と server の間でバイト列を送り合い，送るものが無くなったら
+    (client のイベント, server のイベント) を返す．
+    chunk_size を与えたときはバイト列を chunk_size ずつに分けて渡す．
+    """
+    client_events, server_events = [], []
+    while True:
+        to_server = client.data_to_send()
+        to_client = server.data_to_send()
+        if not to_server and not to_client:
+            return client_events, server_events
+        size = chunk_size or max(len(to_server), len(to_client), 1)
+        for i in range(0, len(to_server), size):
+            server_events += server.receive_data(to_server[i:i + size])
+        for i in range(0, len(to_client), size):
+            client_events += client.receive_data(to_client[i:i + size])
+
+
+def make_record(type, fragment):
+    return bytes([type]) + b'\x03\x03' + len(fragment).to_bytes(2, 'big') + fragment
+
+
+def of_type(events, event_type):
+    return [event for event in events if isinstance(event, event_type)]
+
+
+class TLSConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ticket_key_ring = TicketKeyRing()
+        self.anti_replay = AntiReplayFilter()
+
+    def make_server(self, **kwargs):
+        return ServerTLSConnection(
+            ticket_key_ring=self.ticket_key_ring, anti_replay=self.anti_replay,
+            certificate_file=os.path.join(SSH_DIR, 'server.crt'),
+            private_key_file=os.path.join(SSH_DIR, 'server.key'), **kwargs)
+
+    def connect(self, client, server, early_data=b'', chunk_size=None):
+        client.start_handshake(early_data=early_data)
+        return handshake(client, server, chunk_size)
+
+    def test_handshake(self):
+        client, server = ClientTLSConnection(), self.make_server()
+        client_events, server_events = self.connect(client, server)
+        self.assertTrue(client.handshake_complete and server.handshake_complete)
+        completed, = of_type(client_events, HandshakeCompleted)
+        self.assertEqual(completed.cipher_suite,
+                         CipherSuite.TLS_CHACHA20_POLY1305_SHA256)
+        self.assertFalse(completed.psk_accepted)
+        self.assertEqual(len(of_type(server_events, HandshakeCompleted)), 1)
+        self.assertEqual(len(of_type(client_events, SessionTicketReceived)), 1)
+        self.assertEqual(client.resumption_master_secret,
+                         server.resumption_master_secret)
+
+    def test_handshake__fragmented(self):
+        # レコードの途中で切れたバイト列を渡してもよい
+        client, server = ClientTLSConnection(), self.make_server()
+        client_events, _ = self.connect(client, server, chunk_size=7)
+        self.assertEqual(len(of_type(client_events, HandshakeCompleted)), 1)
+
+    def test_application_data(self):
+        client, server = ClientTLSConnection(), self.make_server()
+        self.connect(client, server)
+        self.assertEqual(client.send_data(b'request'), 7)
+        events = server.receive_data(client.data_to_send())
+        self.assertEqual([event.data for event in of_type(events, DataReceived)],
+                         [b'request'])
+
+        server.send_data(b'x' * 40000)
+        events = client.receive_data(server.data_to_send())
+        self.assertEqual(b''.join(event.data for event in events), b'x' * 40000)
+
+    def test_established(self):
+        # ハンドシェイクを済ませた state から作った接続でそのまま送受信できる
+        client, server = ClientTLSConnection(), self.make_server()
+        self.connect(client, server)
+        tls = TLSConnection.established(client.state)
+        self.assertTrue(tls.handshake_complete)
+        tls.send_data(b'request')
+        events = server.receive_data(tls.data_to_send())
+        self.assertEqual([event.data for event in of_type(events, DataReceived)],
+                         [b'request'])
+
+    def test_key_update(self):
+        client, server = ClientTLSConnection(), self.make_server()
+        self.connect(client, server)
+        client.send_key_update(request_update=True)
+        client.send_data(b'after update')
+        events = server.receive_data(client.data_to_send())
+        self.assertEqual(events[0].data, b'after update')
+        self.assertTrue(server.state.key_update_requested)
+        # 求められたサーバは次のアプリケーションデータの前に鍵を更新する
+        server.send_data(b'response')
+        events = client.receive_data(server.data_to_send())
+        self.assertEqual(events[0].data, b'response')
+        self.assertFalse(server.state.key_update_requested)
+
+    def test_close(self):
+        client, server = ClientTLSConnection(), self.make_server()
+        self.connect(client, server)
+        client.close()
+        events = server.receive_data(client.data_to_send())
+        self.assertEqual(len(of_type(events, ConnectionClosed)), 1)
+        self.assertTrue(server.closed)
+
+    def test_resumption_early_data(self):
+        client, server = ClientTLSConnection(), self.make_server()
+        client_events, _ = self.connect(client, server)
+        session = of_type(client_events, SessionTicketReceived)[0].session
+
+        client, server = ClientTLSConnection(session=session), self.make_server()
+        client_events, server_events = self.connect(client, server, b'0-RTT')
+        completed, = of_type(client_events, HandshakeCompleted)
+        self.assertTrue(completed.psk_accepted)
+        self.assertTrue(completed.early_data_accepted)
+        self.assertEqual([event.data for event in
+                          of_type(server_events, EarlyDataReceived)], [b'0-RTT'])
+
+    def test_resumption_early_data_rejected(self):
+        # 拒否した early data は読み捨ててハンドシェイクを続ける
+        client, server = ClientTLSConnection(), self.make_server()
+        client_events, _ = self.connect(client, server)
+        session = of_type(client_events, SessionTicketReceived)[0].session
+
+        # チケットの経過時間が合わないので early data を受け入れない
+        session.received_at -= 600
+        client, server = ClientTLSConnection(session=session), self.make_server()
+        client_events, server_events = self.connect(client, server, b'0-RTT')
+        completed, = of_type(client_events, HandshakeCompleted)
+        self.assertTrue(completed.psk_accepted)
+        self.assertFalse(completed.early_data_accepted)
+        self.assertEqual(of_type(server_events, EarlyDataReceived), [])
+        self.assertTrue(server.handshake_complete)
+
+    def test_external_psk(self):
+        for mode in (PskKeyExchangeMode.psk_ke, PskKeyExchangeMode.psk_dhe_ke):
+            external_psk = ExternalPsk.from_string(PSK_SPEC)
+            external_psks = ExternalPskTable()
+            external_psks.add(external_psk)
+            client = ClientTLSConnection(external_psk=external_psk, psk_ke_mode=mode)
+            server = self.make_server(external_psks=external_psks)
+            client_events, _ = self.connect(client, server)
+            completed, = of_type(client_events, HandshakeCompleted)
+            self.assertTrue(completed.psk_accepted)
+
+    def test_external_psk__not_offered(self):
+        # PSK を提案していないクライアントに pre_shared_key を返すのは illegal_parameter
+        external_psk = ExternalPsk.from_string(PSK_SPEC)
+        external_psks = ExternalPskTable()
+        external_psks.add(external_psk)
+        client = ClientTLSConnection(external_psk=external_psk)
+        server = self.make_server(external_psks=external_psks)
+        client.start_handshake()
+        server.receive_data(client.data_to_send())
+        other = ClientTLSConnection()
+        other.start_handshake()
+        with self.assertRaisesRegex(RuntimeError, 'illegal_parameter'):
+            other.receive_data(server.data_to_send())
+
+    def test_no_key_share_without_psk(self):
+        # key_share の無い ClientHello は PSK を受け入れたときしか受け付けない
+        client = ClientTLSConnection(
+            external_psk=ExternalPsk.from_string(PSK_SPEC),
+            psk_ke_mode=PskKeyExchangeMode.psk_ke)
+        server = self.make_server()
+        client.start_handshake()
+        with self.assertRaisesRegex(RuntimeError, 'missing_extension'):
+            server.receive_data(client.data_to_send())
+        self.assertEqual(b'', server.data_to_send())
+
+    def test_record_size_limit(self):
+        client = ClientTLSConnection(record_size_limit=512)
+        server = self.make_server(record_size_limit=4096)
+        self.connect(client, server)
+        self.assertEqual(server.state.max_fragment_size, 511)
+        self.assertEqual(client.state.max_fragment_size, 4095)
+        self.assertTrue(client.record_size_limit_negotiated)
+        self.assertTrue(server.record_size_limit_negotiated)
+
+    def test_unexpected_message(self):
+        client, other = ClientTLSConnection(), ClientTLSConnection()
+        client.start_handshake()
+        with self.assertRaises(RuntimeError):
+            other.receive_data(client.data_to_send())
+
+    def test_change_cipher_spec(self):
+        # 1つのメッセージが ChangeCipherSpec を挟んだ複数のレコードにまたがってもよい
+        client, server = ClientTLSConnection(), self.make_server()
+        client.start_handshake()
+        data = client.data_to_send()
+        fragment = data[5:]
+        records = [make_record(0x16, fragment[:3]), make_record(0x14, b'\x01'),
+                   make_record(0x16, fragment[3:100]),
+                   make_record(0x16, fragment[100:])]
+        server.receive_data(b''.join(records))
+        client_events, _ = handshake(client, server)
+        self.assertEqual(len(of_type(client_events, HandshakeCompleted)), 1)
+
+    def test_application_data_before_handshake(self):
+        server = self.make_server()
+        with self.assertRaises(RuntimeError):
+            server.receive_data(make_record(0x17, b'foo'))
+
+    def test_send_data_before_handshake(self):
+        with self.assertRaises(RuntimeError):
+            ClientTLSConnection().send_data(b'data')
+
+
+if __name__ == '__main__':
+    unittest.main()
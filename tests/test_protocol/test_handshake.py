@@ -3,6 +3,10 @@ import unittest
 
 from tls13.protocol.handshake import *
 from tls13.protocol.keyexchange.messages import *
+from tls13.protocol.keyexchange.supportedgroups import *
+from tls13.protocol.keyexchange.version import *
+from tls13.protocol.ciphersuite import *
+from tls13.metastruct.codec import ReaderParseError
 from tls13.metastruct.type import *
 
 from .common import TypeTestMixin, StructTestMixin
@@ -20,4 +24,64 @@ class HandshakeTest(unittest.TestCase, StructTestMixin):
         self.target = Handshake
         self.obj = Handshake(
             msg_type=HandshakeType.client_hello,
-            msg=ClientHello())
+            msg=ClientHello(
+                cipher_suites=[CipherSuite.TLS_AES_128_GCM_SHA256],
+                extensions=[
+                    Extension(
+                        extension_type=ExtensionType.supported_versions,
+                        extension_data=SupportedVersions(
+                            msg_type=HandshakeType.client_hello,
+                            versions=[ProtocolVersion.TLS13])),
+                    Extension(
+                        extension_type=ExtensionType.supported_groups,
+                        extension_data=NamedGroupList(
+                            named_group_list=[NamedGroup.x25519])),
+                ]))
+
+    def test_from_bytes__keeps_raw(self):
+        data = self.obj.to_bytes()
+        handshake = Handshake.from_bytes(data)
+        self.assertEqual(handshake.raw, data)
+        self.assertIs(handshake.to_bytes(), handshake.raw)
+        self.assertEqual(len(handshake), len(data))
+        self.assertIsNone(self.obj.raw)
+
+    def test_from_bytes__lazy(self):
+        # msg を参照するまではデコードしないので，壊れた本体のエラーもそのときに出る
+        handshake = Handshake.from_bytes(
+            HandshakeType.client_hello.to_bytes() + bytes.fromhex('000002 0303'))
+        self.assertEqual(handshake.msg_type, HandshakeType.client_hello)
+        with self.assertRaises(Exception):
+            handshake.msg
+
+    def test_from_bytes__unknown_extension(self):
+        # デコードで落ちる拡張があっても，元のバイト列はそのまま残る
+        unknown = bytes.fromhex('fafa 0004 abcdabcd')
+        hello = ClientHello(cipher_suites=[CipherSuite.TLS_AES_128_GCM_SHA256],
+                            extensions=[]).to_bytes()
+        hello = hello[:-2] + (len(unknown)).to_bytes(2, 'big') + unknown
+        data = HandshakeType.client_hello.to_bytes() + \
+            len(hello).to_bytes(3, 'big') + hello
+        handshake = Handshake.from_bytes(data)
+        self.assertIsInstance(handshake.msg, ClientHello)
+        self.assertEqual(handshake.to_bytes(), data)
+
+    def test_from_bytes__too_large(self):
+        # 長さが上限を超えるときは本体を読まないでエラーにする
+        length = Handshake.max_message_size + 1
+        data = HandshakeType.certificate.to_bytes() + length.to_bytes(3, 'big')
+        with self.assertRaises(RuntimeError):
+            Handshake.from_bytes(data)
+
+    def test_from_bytes__wrong_length(self):
+        data = self.obj.to_bytes()
+        with self.assertRaises(ReaderParseError):
+            Handshake.from_bytes(data[:-1])
+
+    def test_msg_replaced(self):
+        handshake = Handshake.from_bytes(self.obj.to_bytes())
+        handshake.msg = ClientHello(cipher_suites=[], extensions=[])
+        self.assertIsNone(handshake.raw)
+        self.assertEqual(handshake.to_bytes(),
+                         Handshake(msg_type=HandshakeType.client_hello,
+                                   msg=handshake.msg).to_bytes())
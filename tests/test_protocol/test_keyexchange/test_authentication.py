@@ -3,6 +3,8 @@ import unittest
 
 from tls13.protocol.keyexchange.signature import *
 from tls13.protocol.keyexchange.authentication import *
+from tls13.protocol.ciphersuite import CipherSuite
+from tls13.protocol.state import ConnectionState
 from tls13.metastruct.type import *
 
 from ..common import TypeTestMixin, StructTestMixin
@@ -54,8 +56,15 @@ class FinishedTest(unittest.TestCase):
         self.assertEqual(len(self.obj), len(self.obj.to_bytes()))
 
     def test_restruct(self):
-        from tls13.protocol.keyexchange.authentication import Hash
-        hash_size = 32
-        Hash.set_size(hash_size)
         restructed = self.target.from_bytes(self.obj.to_bytes())
         self.assertEqual(repr(self.obj), repr(restructed))
+
+    def test_restruct_with_state(self):
+        # verify_data の長さは接続ごとの state で決まる
+        state = ConnectionState(side='client')
+        state.set_cipher_suite(CipherSuite.TLS_AES_256_GCM_SHA384)
+        obj = Finished(verify_data=bytes(range(48)))
+        restructed = self.target.from_bytes(obj.to_bytes(), state=state)
+        self.assertEqual(repr(obj), repr(restructed))
+        with self.assertRaises(RuntimeError):
+            self.target.from_bytes(self.obj.to_bytes(), state=state)
@@ -1,8 +1,10 @@
 
 import secrets
 import unittest
+import unittest.mock
 
 from tls13.protocol import *
+from tls13.metastruct.codec import ReaderParseError
 from tls13.metastruct.type import *
 
 from ..common import TypeTestMixin, StructTestMixin
@@ -48,6 +50,54 @@ class ClientHelloTest(unittest.TestCase, StructTestMixin):
         ext = self.obj.get_extension(extension_type=Uint.get_type(ExtensionType._size)(0x00))
         self.assertEqual(ext, None)
 
+    def test_from_bytes__no_random(self):
+        # from_bytes では random と legacy_session_id のデフォルト値を作らない
+        data = self.obj.to_bytes()
+        with unittest.mock.patch('secrets.token_bytes') as token_bytes:
+            restructed = ClientHello.from_bytes(data)
+        token_bytes.assert_not_called()
+        self.assertEqual(restructed.random, self.obj.random)
+
+    def test_get_extension__index(self):
+        # from_bytes で作ったときは辞書で拡張を引く
+        restructed = ClientHello.from_bytes(self.obj.to_bytes())
+        self.assertEqual(len(restructed._extension_index), 4)
+        ext = restructed.get_extension(extension_type=ExtensionType.key_share)
+        self.assertIsInstance(ext, KeyShareClientHello)
+        ext = restructed.get_extension(extension_type=ExtensionType.server_name)
+        self.assertEqual(ext, None)
+
+    def test_from_bytes__unknown_extension(self):
+        # 知らない拡張はバイト列のまま残るので，同じバイト列に戻せる
+        self.obj.extensions.append(Extension.raw(Uint16(0xfafa), b'\xab\xcd'))
+        data = self.obj.to_bytes()
+        restructed = ClientHello.from_bytes(data)
+        self.assertEqual(restructed.extensions[-1].extension_type, Uint16(0xfafa))
+        self.assertEqual(restructed.extensions[-1].extension_data, b'\xab\xcd')
+        self.assertEqual(restructed.to_bytes(), data)
+        self.assertIn('unknown', repr(restructed))
+
+    def test_from_bytes__session_id_too_long(self):
+        # legacy_session_id<0..32>
+        self.obj.legacy_session_id = bytes(33)
+        with self.assertRaises(ReaderParseError):
+            ClientHello.from_bytes(self.obj.to_bytes())
+
+    def test_from_bytes__no_cipher_suites(self):
+        # cipher_suites<2..2^16-2>
+        self.obj.cipher_suites = []
+        with self.assertRaises(ReaderParseError):
+            ClientHello.from_bytes(self.obj.to_bytes())
+
+    def test_from_bytes__too_many_extensions(self):
+        self.obj.extensions = [Extension.raw(Uint16(0xfa00 + i), b'')
+                               for i in range(Extension.max_extensions + 1)]
+        with self.assertRaises(ReaderParseError):
+            ClientHello.from_bytes(self.obj.to_bytes())
+        self.obj.extensions.pop()
+        self.assertEqual(len(ClientHello.from_bytes(self.obj.to_bytes()).extensions),
+                         Extension.max_extensions)
+
 
 class ServerHelloTest(unittest.TestCase, StructTestMixin):
 
@@ -100,6 +150,22 @@ class ExtensionTest(unittest.TestCase, StructTestMixin):
     def test_from_bytes__error_when_unset_msg_type(self):
         self.assertRaises(Exception, lambda: Extension.from_bytes(self.obj.to_bytes()))
 
+    def test_get_extension_class(self):
+        self.assertEqual(
+            Extension.get_extension_class(ExtensionType.key_share,
+                                          HandshakeType.server_hello),
+            (KeyShareServerHello, {}))
+        self.assertEqual(
+            Extension.get_extension_class(ExtensionType.early_data,
+                                          HandshakeType.new_session_ticket),
+            (EarlyDataIndication, {'msg_type': HandshakeType.new_session_ticket}))
+        self.assertEqual(
+            Extension.get_extension_class(ExtensionType.server_name,
+                                          HandshakeType.client_hello),
+            (None, None))
+        with self.assertRaises(RuntimeError):
+            Extension.get_extension_class(ExtensionType.key_share)
+
 
 class KeyShareEntryTest(unittest.TestCase, StructTestMixin):
 
@@ -130,6 +196,17 @@ class KeyShareClientHelloTest(unittest.TestCase, StructTestMixin):
         self.assertEqual(key_exchange, self.my_key_exchange)
         self.assertTrue(type(key_exchange) == bytes)
 
+    def test_from_bytes__too_many_shares(self):
+        share = KeyShareEntry(group=NamedGroup.x25519, key_exchange=bytes(32))
+        self.obj.client_shares = [share] * 17
+        with self.assertRaises(ReaderParseError):
+            KeyShareClientHello.from_bytes(self.obj.to_bytes())
+
+    def test_from_bytes__empty_key_exchange(self):
+        # key_exchange<1..2^16-1>
+        with self.assertRaises(ReaderParseError):
+            KeyShareClientHello.from_bytes(bytes.fromhex('0004 001d 0000'))
+
 
 class KeyShareServerHelloTest(unittest.TestCase, StructTestMixin):
 
@@ -145,3 +222,100 @@ class KeyShareServerHelloTest(unittest.TestCase, StructTestMixin):
         key_exchange = self.obj.get_key_exchange()
         self.assertEqual(key_exchange, self.my_key_exchange)
         self.assertTrue(type(key_exchange) == bytes)
+
+
+class PskKeyExchangeModeTest(unittest.TestCase, TypeTestMixin):
+
+    def setUp(self):
+        self.target = PskKeyExchangeMode
+
+
+class PskKeyExchangeModesTest(unittest.TestCase, StructTestMixin):
+
+    def setUp(self):
+        self.target = PskKeyExchangeModes
+        self.obj = PskKeyExchangeModes(
+            ke_modes=[PskKeyExchangeMode.psk_ke, PskKeyExchangeMode.psk_dhe_ke])
+
+
+class EarlyDataIndicationTest(unittest.TestCase):
+
+    def test_length(self):
+        obj = EarlyDataIndication(msg_type=HandshakeType.client_hello)
+        self.assertEqual(0, len(obj))
+        self.assertEqual(b'', obj.to_bytes())
+
+        obj = EarlyDataIndication(msg_type=HandshakeType.new_session_ticket,
+                                  max_early_data_size=Uint32(2**14))
+        self.assertEqual(len(obj), len(obj.to_bytes()))
+
+    def test_restruct(self):
+        obj = EarlyDataIndication(msg_type=HandshakeType.new_session_ticket,
+                                  max_early_data_size=Uint32(2**14))
+        restructed = EarlyDataIndication.from_bytes(
+            obj.to_bytes(), msg_type=HandshakeType.new_session_ticket)
+        self.assertEqual(repr(obj), repr(restructed))
+
+
+class OfferedPsksTest(unittest.TestCase, StructTestMixin):
+
+    def setUp(self):
+        self.target = OfferedPsks
+        self.obj = OfferedPsks(
+            identities=[
+                PskIdentity(identity=b'ticket1',
+                            obfuscated_ticket_age=Uint32(12345)),
+                PskIdentity(identity=b'ticket2',
+                            obfuscated_ticket_age=Uint32(67890)) ],
+            binders=[
+                PskBinderEntry(binder=secrets.token_bytes(32)),
+                PskBinderEntry(binder=secrets.token_bytes(32)) ])
+
+    def test_get_binders_length(self):
+        self.assertEqual(2 + 2 * (1 + 32), self.obj.get_binders_length())
+        self.assertTrue(self.obj.to_bytes().endswith(
+            self.obj.to_bytes()[-self.obj.get_binders_length():]))
+
+
+class PreSharedKeyExtensionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pre_shared_key_ch = PreSharedKeyExtension(
+            msg_type=HandshakeType.client_hello,
+            offered_psks=OfferedPsks(
+                identities=[PskIdentity(identity=b'ticket')],
+                binders=[PskBinderEntry(binder=secrets.token_bytes(32))] ))
+        self.pre_shared_key_sh = PreSharedKeyExtension(
+            msg_type=HandshakeType.server_hello,
+            selected_identity=Uint16(0))
+
+    def test_restruct(self):
+        for obj in (self.pre_shared_key_ch, self.pre_shared_key_sh):
+            restructed = Extension.from_bytes(
+                Extension(extension_type=ExtensionType.pre_shared_key,
+                          extension_data=obj).to_bytes(),
+                msg_type=obj.msg_type)
+            self.assertEqual(repr(obj), repr(restructed.extension_data))
+
+
+class RecordSizeLimitTest(unittest.TestCase, StructTestMixin):
+
+    def setUp(self):
+        self.target = RecordSizeLimit
+        self.obj = RecordSizeLimit(record_size_limit=Uint16(512))
+
+    def test_get_max_fragment_size(self):
+        self.assertEqual(511, self.obj.get_max_fragment_size())
+        # プロトコルの上限より大きい値
+        obj = RecordSizeLimit(record_size_limit=Uint16(2**15))
+        self.assertEqual(2**14, obj.get_max_fragment_size())
+
+    def test_illegal_parameter(self):
+        with self.assertRaises(RuntimeError):
+            RecordSizeLimit.from_bytes(Uint16(63).to_bytes())
+
+    def test_extension(self):
+        restructed = Extension.from_bytes(
+            Extension(extension_type=ExtensionType.record_size_limit,
+                      extension_data=self.obj).to_bytes())
+        self.assertEqual(repr(self.obj), repr(restructed.extension_data))
@@ -0,0 +1,31 @@
+import unittest
+
+from tls13.protocol import *
+from tls13.metastruct.type import *
+
+from .common import TypeTestMixin, StructTestMixin
+
+
+class KeyUpdateRequestTest(unittest.TestCase, TypeTestMixin):
+
+    def setUp(self):
+        self.target = KeyUpdateRequest
+
+
+class KeyUpdateTest(unittest.TestCase, StructTestMixin):
+
+    def setUp(self):
+        self.target = KeyUpdate
+        self.obj = KeyUpdate(request_update=KeyUpdateRequest.update_requested)
+
+    def test_default(self):
+        self.assertEqual(b'\x00', bytes(KeyUpdate().to_bytes()))
+
+    def test_handshake(self):
+        handshake = Handshake(msg_type=HandshakeType.key_update, msg=self.obj)
+        restructed = Handshake.from_bytes(handshake.to_bytes())
+        self.assertEqual(repr(handshake), repr(restructed))
+
+    def test_illegal_parameter(self):
+        with self.assertRaises(RuntimeError):
+            KeyUpdate.from_bytes(b'\x02')
@@ -1,9 +1,11 @@
 
+import io
 import unittest
 import secrets
 
 from tls13.protocol import *
 from tls13.metastruct.type import *
+from tls13.encryption import Cipher
 
 from .common import TypeTestMixin, StructTestMixin
 
@@ -149,3 +151,462 @@ class TLSCiphertextTest(unittest.TestCase, StructTestMixin):
         self.target = TLSCiphertext
         self.obj = TLSCiphertext(
             encrypted_record=b'foobar')
+
+
+class ProtectTest(unittest.TestCase):
+
+    def setUp(self):
+        key, nonce = secrets.token_bytes(32), secrets.token_bytes(12)
+        self.write_crypto = Cipher.Chacha20Poly1305(key=key, nonce=nonce)
+        self.read_crypto = Cipher.Chacha20Poly1305(key=key, nonce=nonce)
+
+    def test_protect(self):
+        record = protect(b'foobar', self.write_crypto)
+        self.assertEqual(b'\x17\x03\x03\x00\x17', record[:5])
+        type, content = unprotect(record, self.read_crypto)
+        self.assertEqual(ContentType.application_data, type)
+        self.assertEqual(b'foobar', content)
+        # 平文はコピーせずに memoryview で返す
+        self.assertIsInstance(content, memoryview)
+
+    def test_padding(self):
+        record = protect(b'foo\x00', self.write_crypto, ContentType.handshake,
+                         length_of_padding=100)
+        self.assertEqual(5 + 4 + 1 + 100 + 16, len(record))
+        type, content = unprotect(record, self.read_crypto)
+        self.assertIs(ContentType.handshake, type)
+        self.assertEqual(b'foo\x00', content)
+
+    def test_same_as_struct(self):
+        # 構造体で作ったレコードと同じバイト列になる
+        tlsplaintext = TLSPlaintext(type=ContentType.application_data,
+                                    fragment=Data(b'foobar'))
+        expected = TLSCiphertext.create(tlsplaintext, self.read_crypto)
+        record = protect(b'foobar', self.write_crypto, length_of_padding=9)
+        self.assertEqual(expected.to_bytes(), record)
+
+    def test_opaque_type(self):
+        record = bytearray(protect(b'foobar', self.write_crypto))
+        record[0] = ContentType.handshake.value
+        with self.assertRaisesRegex(RuntimeError, 'unexpected_message'):
+            unprotect(record, self.read_crypto)
+
+    def test_record_overflow(self):
+        record = b'\x17\x03\x03\x41\x01' + bytes(2**14 + 257)
+        with self.assertRaisesRegex(RuntimeError, 'record_overflow'):
+            unprotect(record, self.read_crypto)
+
+    def test_no_content_type(self):
+        record = protect(b'', self.write_crypto, Uint8(0), length_of_padding=3)
+        with self.assertRaisesRegex(RuntimeError, 'unexpected_message'):
+            unprotect(record, self.read_crypto)
+
+    def test_bad_tag(self):
+        record = bytearray(protect(b'foobar', self.write_crypto))
+        record[-1] ^= 1
+        with self.assertRaises(RuntimeError):
+            unprotect(record, self.read_crypto)
+
+
+def make_record(type, fragment):
+    return bytes([type]) + b'\x03\x03' + len(fragment).to_bytes(2, 'big') + fragment
+
+
+class FakeSocket:
+    # recv_into で chunks を1つずつ返す
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv_into(self, buffer):
+        if not self.chunks:
+            return 0
+        chunk = self.chunks.pop(0)
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+
+class RecordFramerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.records = [
+            make_record(0x16, b'\x01' * 100),
+            make_record(0x14, b'\x01'),
+            make_record(0x17, secrets.token_bytes(2**14 + 256)),
+            make_record(0x17, b''),
+        ]
+        self.stream = b''.join(self.records)
+
+    def read_all(self, framer, sock):
+        records = []
+        while True:
+            record = framer.next_record()
+            if record is not None:
+                records.append(bytes(record))
+                continue
+            if framer.recv_into(sock) == 0:
+                return records
+
+    def test_coalesced(self):
+        framer = RecordFramer()
+        sock = FakeSocket([self.stream])
+        self.assertEqual(self.records, self.read_all(framer, sock))
+        self.assertEqual(0, len(framer))
+
+    def test_split(self):
+        framer = RecordFramer()
+        sock = FakeSocket(self.stream[i:i+7] for i in range(0, len(self.stream), 7))
+        self.assertEqual(self.records, self.read_all(framer, sock))
+
+    def test_split_and_coalesced(self):
+        framer = RecordFramer(buffer_size=16)
+        cut = len(self.records[0]) + 3
+        sock = FakeSocket([self.stream[:cut], self.stream[cut:]])
+        self.assertEqual(self.records, self.read_all(framer, sock))
+
+    def test_feed(self):
+        framer = RecordFramer()
+        framer.feed(self.stream[:3])
+        self.assertEqual(None, framer.next_record())
+        framer.feed(self.stream[3:])
+        self.assertEqual(self.records, [bytes(record) for record in framer])
+
+    def test_zero_copy(self):
+        framer = RecordFramer()
+        framer.feed(self.records[0])
+        record = framer.next_record()
+        self.assertIsInstance(record, memoryview)
+        self.assertIs(framer.buffer, record.obj)
+
+    def test_buffered_records(self):
+        framer = RecordFramer()
+        self.assertEqual(0, framer.buffered_records())
+        framer.feed(self.stream)
+        self.assertEqual(4, framer.buffered_records())
+        framer.next_record()
+        self.assertEqual(3, framer.buffered_records())
+        framer.feed(self.records[0][:3])
+        self.assertEqual(None, framer.buffered_records())
+        framer.feed(self.records[0][3:10])
+        self.assertEqual(None, framer.buffered_records())
+
+    def test_record_overflow(self):
+        framer = RecordFramer()
+        framer.feed(b'\x17\x03\x03' + (2**14 + 257).to_bytes(2, 'big'))
+        with self.assertRaises(RuntimeError):
+            framer.next_record()
+
+
+class HandshakeReassemblerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = [
+            b'\x08' + (2).to_bytes(3, 'big') + b'\x00\x00',
+            b'\x0b' + (40000).to_bytes(3, 'big') + secrets.token_bytes(40000),
+            b'\x14' + (32).to_bytes(3, 'big') + secrets.token_bytes(32),
+        ]
+        self.stream = b''.join(self.messages)
+
+    def test_coalesced(self):
+        reassembler = HandshakeReassembler()
+        reassembler.feed(self.stream)
+        self.assertEqual(self.messages[0], reassembler.next_message())
+        self.assertEqual(self.messages[1], reassembler.next_message())
+        self.assertEqual(self.messages[2], reassembler.next_message())
+        self.assertEqual(None, reassembler.next_message())
+
+    def test_spanning_records(self):
+        reassembler = HandshakeReassembler()
+        messages = []
+        for i in range(0, len(self.stream), 2**14):
+            reassembler.feed(self.stream[i:i + 2**14])
+            while True:
+                message = reassembler.next_message()
+                if message is None:
+                    break
+                messages.append(message)
+        self.assertEqual(self.messages, messages)
+        self.assertEqual(0, len(reassembler))
+
+    def test_message_too_large(self):
+        # 長さが上限を超えるメッセージはヘッダを受け取ったところでエラーにする
+        reassembler = HandshakeReassembler(max_message_size=32768)
+        with self.assertRaises(RuntimeError):
+            reassembler.feed(self.messages[1][:4])
+
+    def test_buffer_too_large(self):
+        reassembler = HandshakeReassembler(max_buffer_size=2**14)
+        reassembler.feed(self.stream[:2**14])
+        with self.assertRaises(RuntimeError):
+            reassembler.feed(self.stream[2**14:2**14 + 1])
+
+
+class FakeConnection:
+    def __init__(self):
+        self.calls = []
+
+    def send_buffers(self, buffers):
+        self.calls.append([bytes(buffer) for buffer in buffers])
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class RecordSizerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.sizer = RecordSizer(initial_size=1000, boost_threshold=3000,
+                                 idle_timeout=1.0, clock=self.clock)
+
+    def send(self, count):
+        sizes = []
+        for _ in range(count):
+            size = self.sizer.next_size()
+            self.sizer.record_sent(size)
+            sizes.append(size)
+        return sizes
+
+    def test_boost(self):
+        self.assertEqual([1000, 1000, 1000, 2**14, 2**14], self.send(5))
+
+    def test_reset_after_idle(self):
+        self.send(4)
+        self.clock.now += 0.5
+        self.assertEqual(2**14, self.sizer.next_size())
+        self.clock.now += 1.0
+        self.assertEqual([1000, 1000, 1000, 2**14], self.send(4))
+
+    def test_boost_after(self):
+        # boost_threshold に届かなくても，送り始めてから boost_after 秒で最大サイズにする
+        sizer = RecordSizer(initial_size=1000, boost_threshold=10**9,
+                            boost_after=2.0, idle_timeout=1.0, clock=self.clock)
+        sizes = []
+        for _ in range(5):
+            sizes.append(sizer.next_size())
+            sizer.record_sent(sizes[-1])
+            self.clock.now += 0.6
+        self.assertEqual([1000, 1000, 1000, 1000, 2**14], sizes)
+        # 送らない時間が idle_timeout を超えたら，送り始めた時刻も数え直す
+        self.clock.now += 1.0
+        sizes = []
+        for _ in range(4):
+            sizes.append(sizer.next_size())
+            sizer.record_sent(sizes[-1])
+            self.clock.now += 0.6
+        self.assertEqual([1000, 1000, 1000, 1000], sizes)
+        self.assertEqual(2**14, sizer.next_size())
+
+    def test_boost_after__disabled(self):
+        sizer = RecordSizer(initial_size=1000, boost_threshold=10**9,
+                            boost_after=None, idle_timeout=1000, clock=self.clock)
+        sizer.record_sent(1000)
+        self.clock.now += 100
+        self.assertEqual(1000, sizer.next_size())
+
+    def test_max_size(self):
+        sizer = RecordSizer(initial_size=1000, max_size=511)
+        self.assertEqual(511, sizer.next_size())
+
+
+class RecordWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.key, self.iv = b'\x01' * 32, b'\x02' * 12
+        self.data = secrets.token_bytes(3 * 2**14 + 100)
+
+    def write(self, data, **kwargs):
+        conn = FakeConnection()
+        writer = RecordWriter(conn, Cipher.Chacha20Poly1305(key=self.key, nonce=self.iv),
+                              **kwargs)
+        written = writer.write(data)
+        return written, conn
+
+    def decrypt_all(self, conn):
+        framer = RecordFramer()
+        for buffers in conn.calls:
+            for buffer in buffers:
+                framer.feed(buffer)
+        crypto = Cipher.Chacha20Poly1305(key=self.key, nonce=self.iv)
+        contents = []
+        for record in framer:
+            self.assertLessEqual(len(record), 5 + 2**14 + 1 + 16)
+            type, content = TLSCiphertext.decrypt(record, crypto)
+            self.assertEqual(ContentType.application_data, type)
+            contents.append(bytes(content))
+        return contents
+
+    def test_write_bytes(self):
+        written, conn = self.write(self.data)
+        self.assertEqual(len(self.data), written)
+        contents = self.decrypt_all(conn)
+        self.assertEqual([2**14, 2**14, 2**14, 100], [len(c) for c in contents])
+        self.assertEqual(self.data, b''.join(contents))
+
+    def test_write_file(self):
+        written, conn = self.write(io.BytesIO(self.data))
+        self.assertEqual(len(self.data), written)
+        self.assertEqual(self.data, b''.join(self.decrypt_all(conn)))
+
+    def test_write_iterable(self):
+        # 小さな断片はまとめてレコードにする
+        chunks = [self.data[i:i+1000] for i in range(0, len(self.data), 1000)]
+        written, conn = self.write(iter(chunks))
+        self.assertEqual(len(self.data), written)
+        contents = self.decrypt_all(conn)
+        self.assertEqual(4, len(contents))
+        self.assertEqual(self.data, b''.join(contents))
+
+    def test_records_per_send(self):
+        written, conn = self.write(self.data, records_per_send=2)
+        self.assertEqual(2, len(conn.calls))
+        for buffers in conn.calls:
+            framer = RecordFramer()
+            for buffer in buffers:
+                framer.feed(buffer)
+            self.assertEqual(2, len(list(framer)))
+
+    def test_write__segments(self):
+        # ヘッダと暗号文は別々のバッファで sendmsg に渡す
+        written, conn = self.write(self.data[:100])
+        self.assertEqual([5, 100 + 1 + 16], [len(b) for b in conn.calls[0]])
+
+    def test_max_fragment_size(self):
+        written, conn = self.write(self.data[:1000], max_fragment_size=256)
+        self.assertEqual([256, 256, 256, 232],
+                         [len(c) for c in self.decrypt_all(conn)])
+
+    def test_sizer(self):
+        sizer = RecordSizer(initial_size=1000, boost_threshold=2000)
+        for data in (self.data, io.BytesIO(self.data), iter([self.data])):
+            sizer.reset()
+            written, conn = self.write(data, sizer=sizer)
+            contents = self.decrypt_all(conn)
+            self.assertEqual([1000, 1000, 2**14, 2**14, 14484],
+                             [len(c) for c in contents])
+            self.assertEqual(self.data, b''.join(contents))
+
+    def test_write_empty(self):
+        written, conn = self.write(b'')
+        self.assertEqual(0, written)
+        self.assertEqual([], conn.calls)
+
+    def test_kernel_tx(self):
+        # kTLS では平文をそのまま1レコード分ずつ送る
+        conn = FakeConnection()
+        state = ConnectionState(side='server')
+        state.set_crypto(write_crypto=Cipher.Chacha20Poly1305(key=self.key,
+                                                              nonce=self.iv))
+        state.kernel_tx = True
+        writer = RecordWriter(conn, None, state=state, max_fragment_size=2**13)
+        self.assertEqual(len(self.data), writer.write(io.BytesIO(self.data)))
+        self.assertEqual(self.data, b''.join(b''.join(c) for c in conn.calls))
+        self.assertTrue(all(len(c) == 1 and len(c[0]) <= 2**13
+                            for c in conn.calls))
+        self.assertEqual(len(conn.calls), state.write_crypto.seq_number)
+        self.assertEqual(len(self.data), state.bytes_written)
+
+
+class HandshakeFlightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.key, self.iv = b'\x01' * 32, b'\x02' * 12
+        self.hello = b'\x02' + (5).to_bytes(3, 'big') + b'hello'
+        self.messages = [b'\x08' + (2).to_bytes(3, 'big') + b'\x00\x00',
+                         b'\x0b' + (3).to_bytes(3, 'big') + b'abc',
+                         b'\x14' + (4).to_bytes(3, 'big') + b'fini']
+
+    def send_flight(self, pack):
+        conn = FakeConnection()
+        crypto = Cipher.Chacha20Poly1305(key=self.key, nonce=self.iv)
+        flight = HandshakeFlight(conn, pack=pack)
+        flight.add(self.hello)
+        for message in self.messages:
+            flight.add(message, crypto=crypto)
+        num_records = flight.flush()
+        return num_records, conn
+
+    def recv_flight(self, conn):
+        framer = RecordFramer()
+        for buffer in conn.calls[0]:
+            framer.feed(buffer)
+        records = list(framer)
+        self.assertEqual(ContentType.handshake, Uint8(records[0][0]))
+        self.assertEqual(self.hello, bytes(records[0][5:]))
+        crypto = Cipher.Chacha20Poly1305(key=self.key, nonce=self.iv)
+        data = b''
+        for record in records[1:]:
+            type, content = TLSCiphertext.decrypt(record, crypto)
+            self.assertEqual(ContentType.handshake, type)
+            data += content
+        self.assertEqual(b''.join(self.messages), data)
+        return records
+
+    def test_flush_once(self):
+        num_records, conn = self.send_flight(pack=False)
+        self.assertEqual(4, num_records)
+        self.assertEqual(1, len(conn.calls))
+        self.assertEqual(4, len(self.recv_flight(conn)))
+
+    def test_pack(self):
+        # 同じ鍵で送るメッセージは1つのレコードに詰める
+        num_records, conn = self.send_flight(pack=True)
+        self.assertEqual(2, num_records)
+        self.assertEqual(1, len(conn.calls))
+        self.assertEqual(2, len(self.recv_flight(conn)))
+
+    def test_pack_large_message(self):
+        conn = FakeConnection()
+        flight = HandshakeFlight(conn, pack=True)
+        flight.add(b'\x0b' + (2**14).to_bytes(3, 'big') + bytes(2**14))
+        self.assertEqual(2, flight.flush())
+
+    def test_max_fragment_size(self):
+        # 暗号化するレコードだけを相手の record_size_limit 以下にする
+        conn = FakeConnection()
+        crypto = Cipher.Chacha20Poly1305(key=self.key, nonce=self.iv)
+        flight = HandshakeFlight(conn, pack=True, max_fragment_size=4)
+        flight.add(self.hello)
+        for message in self.messages:
+            flight.add(message, crypto=crypto)
+        self.assertEqual(1 + 6, flight.flush())
+        records = self.recv_flight(conn)
+        self.assertEqual(5 + len(self.hello), len(records[0]))
+        self.assertTrue(all(len(record) <= 5 + 4 + 1 + 16
+                            for record in records[1:]))
+
+    def test_segments(self):
+        # to_segments のバッファのリストを追加すると，暗号化しないレコードでは
+        # 大きなバッファをコピーしないで send_buffers に渡す
+        class RawConnection:
+            def send_buffers(self, buffers):
+                self.buffers = buffers
+        conn = RawConnection()
+        cert_data = bytes(range(256)) * 4
+        segments = [b'\x0b' + (1024).to_bytes(3, 'big'), cert_data]
+        flight = HandshakeFlight(conn, max_fragment_size=600)
+        flight.add(segments)
+        crypto = Cipher.Chacha20Poly1305(key=self.key, nonce=self.iv)
+        flight.add(segments, crypto=crypto)
+        self.assertEqual(1 + 2, flight.flush())
+        self.assertTrue(any(isinstance(buffer, memoryview) and
+                            buffer.obj is cert_data for buffer in conn.buffers))
+
+        framer = RecordFramer()
+        for buffer in conn.buffers:
+            framer.feed(buffer)
+        records = list(framer)
+        self.assertEqual(b''.join(segments), bytes(records[0][5:]))
+        crypto = Cipher.Chacha20Poly1305(key=self.key, nonce=self.iv)
+        data = b''.join(bytes(TLSCiphertext.decrypt(record, crypto)[1])
+                        for record in records[1:])
+        self.assertEqual(b''.join(segments), data)
+
+    def test_flush_empty(self):
+        conn = FakeConnection()
+        self.assertEqual(0, HandshakeFlight(conn).flush())
+        self.assertEqual([], conn.calls)
@@ -0,0 +1,114 @@
+import unittest
+
+from tls13.protocol import *
+from tls13.encryption import Cipher
+
+
+class ConnectionStateTest(unittest.TestCase):
+
+    def test_set_cipher_suite(self):
+        state = ConnectionState(side='server')
+        state.set_cipher_suite(CipherSuite.TLS_CHACHA20_POLY1305_SHA256)
+        self.assertEqual('sha256', state.hash_algo)
+        self.assertEqual(32, state.hash_size)
+        state.set_cipher_suite(CipherSuite.TLS_AES_256_GCM_SHA384)
+        self.assertEqual('sha384', state.hash_algo)
+        self.assertEqual(48, state.hash_size)
+
+    def test_set_crypto(self):
+        state = ConnectionState(side='client')
+        read_crypto = Cipher.Chacha20Poly1305(key=b'\x01' * 32, nonce=b'\x02' * 12)
+        write_crypto = Cipher.Chacha20Poly1305(key=b'\x03' * 32, nonce=b'\x04' * 12)
+        state.set_crypto(read_crypto=read_crypto, write_crypto=write_crypto)
+        state.set_crypto(write_crypto=read_crypto)
+        self.assertIs(read_crypto, state.read_crypto)
+        self.assertIs(read_crypto, state.write_crypto)
+
+    def test_independent_connections(self):
+        # 2つの接続のハッシュ長とシーケンス番号は互いに影響しない
+        state1 = ConnectionState(side='client')
+        state2 = ConnectionState(side='client')
+        state1.set_cipher_suite(CipherSuite.TLS_CHACHA20_POLY1305_SHA256)
+        state2.set_cipher_suite(CipherSuite.TLS_AES_256_GCM_SHA384)
+        finished1 = Handshake(msg_type=HandshakeType.finished,
+                              msg=Finished(verify_data=bytes(32)))
+        finished2 = Handshake(msg_type=HandshakeType.finished,
+                              msg=Finished(verify_data=bytes(48)))
+        self.assertEqual(finished1.to_bytes(), TLSPlaintext.from_handshake_bytes(
+            finished1.to_bytes(), state=state1).fragment.to_bytes())
+        self.assertEqual(finished2.to_bytes(), TLSPlaintext.from_handshake_bytes(
+            finished2.to_bytes(), state=state2).fragment.to_bytes())
+
+        key, iv = b'\x01' * 32, b'\x02' * 12
+        state1.set_crypto(write_crypto=Cipher.Chacha20Poly1305(key=key, nonce=iv))
+        state2.set_crypto(write_crypto=Cipher.Chacha20Poly1305(key=key, nonce=iv))
+        record1 = TLSCiphertext.encrypt(b'foo', ContentType.application_data,
+                                        state1.write_crypto)
+        record2 = TLSCiphertext.encrypt(b'foo', ContentType.application_data,
+                                        state2.write_crypto)
+        self.assertEqual(record1, record2)
+        self.assertEqual(1, state1.write_crypto.seq_number)
+        self.assertEqual(1, state2.write_crypto.seq_number)
+
+
+class KeyUpdatePolicyTest(unittest.TestCase):
+
+    def test_needs_update(self):
+        policy = KeyUpdatePolicy(max_records=10, max_bytes=1000)
+        self.assertFalse(policy.needs_update(9, 999))
+        self.assertTrue(policy.needs_update(10, 0))
+        self.assertTrue(policy.needs_update(0, 1000))
+        policy = KeyUpdatePolicy(max_records=None, max_bytes=None)
+        self.assertFalse(policy.needs_update(2**64, 2**64))
+
+
+class KeyUpdateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = ConnectionState(side='client')
+        self.server = ConnectionState(side='server')
+        suite = CipherSuite.TLS_CHACHA20_POLY1305_SHA256
+        key, iv = b'\x01' * 32, b'\x02' * 12
+        for state in (self.client, self.server):
+            state.set_cipher_suite(suite)
+        self.client.set_crypto(
+            write_crypto=Cipher.Chacha20Poly1305(key=key, nonce=iv),
+            write_secret=b'\x03' * 32)
+        self.server.set_crypto(
+            read_crypto=Cipher.Chacha20Poly1305(key=key, nonce=iv),
+            read_secret=b'\x03' * 32)
+
+    def test_seal_key_update(self):
+        old_crypto = self.client.write_crypto
+        record = self.client.seal_key_update(request_update=True)
+        self.assertIsNot(old_crypto, self.client.write_crypto)
+        self.assertEqual(0, self.client.write_crypto.seq_number)
+
+        type, content = TLSCiphertext.decrypt(record, self.server.read_crypto)
+        self.assertEqual(ContentType.handshake, type)
+        handshake = Handshake.from_bytes(bytes(content))
+        self.assertEqual(KeyUpdateRequest.update_requested,
+                         handshake.msg.request_update)
+
+        # 次の世代の鍵で送ったレコードを次の世代の鍵で復号できる
+        self.server.update_read_crypto()
+        self.assertEqual(self.client.write_secret, self.server.read_secret)
+        record = TLSCiphertext.encrypt(b'foo', ContentType.application_data,
+                                       self.client.write_crypto)
+        type, content = TLSCiphertext.decrypt(record, self.server.read_crypto)
+        self.assertEqual(b'foo', bytes(content))
+
+    def test_needs_key_update(self):
+        self.client.key_update_policy = KeyUpdatePolicy(max_records=2)
+        self.assertFalse(self.client.needs_key_update())
+        for _ in range(2):
+            TLSCiphertext.encrypt(b'foo', ContentType.application_data,
+                                  self.client.write_crypto)
+        self.assertTrue(self.client.needs_key_update())
+        self.client.update_write_crypto()
+        self.assertFalse(self.client.needs_key_update())
+
+    def test_update_without_secret(self):
+        # ハンドシェイクの鍵は KeyUpdate で更新できない
+        with self.assertRaises(RuntimeError):
+            self.client.update_read_crypto()
@@ -0,0 +1,295 @@
+
+import os
+import time
+import tempfile
+import unittest
+
+from tls13.protocol import *
+from tls13.metastruct.type import *
+
+from .common import StructTestMixin
+
+
+class NewSessionTicketTest(unittest.TestCase, StructTestMixin):
+
+    def setUp(self):
+        self.target = NewSessionTicket
+        self.obj = NewSessionTicket(
+            ticket_lifetime=Uint32(7200),
+            ticket_age_add=Uint32(0x12345678),
+            ticket_nonce=b'nonce',
+            ticket=b'foobar',
+            extensions=[
+                Extension(
+                    extension_type=ExtensionType.early_data,
+                    extension_data=EarlyDataIndication(
+                        msg_type=HandshakeType.new_session_ticket,
+                        max_early_data_size=Uint32(2**14) )) ])
+
+    def test_get_extension(self):
+        early_data = self.obj.get_extension(ExtensionType.early_data)
+        self.assertEqual(Uint32(2**14), early_data.max_early_data_size)
+
+
+class TicketStateTest(unittest.TestCase, StructTestMixin):
+
+    def setUp(self):
+        self.target = TicketState
+        self.obj = TicketState(
+            cipher_suite=CipherSuite.TLS_CHACHA20_POLY1305_SHA256,
+            ticket_age_add=Uint32(0x12345678),
+            ticket_lifetime=Uint32(7200),
+            psk=b'\x01' * 32)
+
+    def test_is_expired(self):
+        now = int(self.obj.issued_at)
+        self.assertFalse(self.obj.is_expired(now + 7200))
+        self.assertTrue(self.obj.is_expired(now + 7201))
+
+
+class SessionTicketKeyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state = TicketState(
+            cipher_suite=CipherSuite.TLS_CHACHA20_POLY1305_SHA256,
+            ticket_age_add=Uint32(0x12345678),
+            ticket_lifetime=Uint32(7200),
+            psk=b'\x01' * 32)
+
+    def test_seal_open(self):
+        key = SessionTicketKey()
+        opened = key.open(key.seal(self.state))
+        self.assertEqual(self.state.to_bytes(), opened.to_bytes())
+
+    def test_open__wrong_key(self):
+        ticket = SessionTicketKey().seal(self.state)
+        self.assertEqual(None, SessionTicketKey().open(ticket))
+
+    def test_open__broken_ticket(self):
+        key = SessionTicketKey()
+        ticket = bytearray(key.seal(self.state))
+        ticket[-1] ^= 0xff
+        self.assertEqual(None, key.open(ticket))
+        self.assertEqual(None, key.open(b'foobar'))
+
+
+class TicketKeyFileTest(unittest.TestCase, StructTestMixin):
+
+    def setUp(self):
+        self.target = TicketKeyFile
+        self.obj = TicketKeyFile(keys=[
+            TicketKeyEntry(key_id=b'\x00\x01\x02\x03',
+                           created_at=Uint32(1534000000),
+                           key=b'\x01' * 32),
+            TicketKeyEntry(key_id=b'\x04\x05\x06\x07',
+                           created_at=Uint32(1533990000),
+                           key=b'\x02' * 32) ])
+
+
+class TicketKeyRingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state = TicketState(
+            cipher_suite=CipherSuite.TLS_CHACHA20_POLY1305_SHA256,
+            ticket_age_add=Uint32(0x12345678),
+            ticket_lifetime=Uint32(7200),
+            psk=b'\x01' * 32)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'ticket.keys')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_key_id_prefix(self):
+        ring = TicketKeyRing()
+        ticket = ring.seal(self.state)
+        self.assertEqual(ring.current.key_id, ticket[:4])
+        self.assertEqual(self.state.to_bytes(), ring.open(ticket).to_bytes())
+
+    def test_rotate(self):
+        ring = TicketKeyRing(rotation_interval=3600, max_previous_keys=2)
+        now = ring.current.created_at
+        ticket = ring.seal(self.state)
+
+        ring.rotate(now + 3600)
+        ring.rotate(now + 7200)
+        self.assertEqual(2, len(ring.previous))
+        self.assertNotEqual(None, ring.open(ticket))
+
+        # max_previous_keys を超えた古い鍵は捨てられる
+        ring.rotate(now + 10800)
+        self.assertEqual(2, len(ring.previous))
+        self.assertEqual(None, ring.open(ticket))
+
+    def test_rotate__not_yet(self):
+        ring = TicketKeyRing(rotation_interval=3600)
+        current = ring.current
+        ring.rotate(current.created_at + 3599)
+        self.assertIs(current, ring.current)
+
+    def test_open__unknown_key_id(self):
+        ring = TicketKeyRing()
+        ticket = TicketKeyRing().seal(self.state)
+        self.assertEqual(None, ring.open(ticket))
+        self.assertEqual(None, ring.open(b''))
+
+    def test_persist(self):
+        ring1 = TicketKeyRing(path=self.path)
+        ticket = ring1.seal(self.state)
+        self.assertEqual(0o600, os.stat(self.path).st_mode & 0o777)
+
+        # 再起動や別のプロセスでも同じ鍵で復号できる
+        ring2 = TicketKeyRing(path=self.path)
+        self.assertEqual(ring1.current.key_id, ring2.current.key_id)
+        self.assertEqual(self.state.to_bytes(), ring2.open(ticket).to_bytes())
+
+    def test_persist__rotate_by_other_process(self):
+        ring1 = TicketKeyRing(path=self.path, reload_interval=0)
+        ring2 = TicketKeyRing(path=self.path, reload_interval=0)
+        now = ring1.current.created_at
+
+        ring2.rotate(now + 3600)
+        ticket = ring2.seal(self.state)
+        self.assertEqual(self.state.to_bytes(), ring1.open(ticket).to_bytes())
+        self.assertEqual(ring2.current.key_id, ring1.current.key_id)
+
+        # ring1 は ring2 が更新した鍵を読み直すので，もう一度は更新しない
+        ring1.rotate(now + 3600)
+        self.assertEqual(ring2.current.key_id, ring1.current.key_id)
+
+
+class SessionTicketTest(unittest.TestCase):
+
+    def test_obfuscated_ticket_age(self):
+        session = SessionTicket(
+            ticket=b'foobar', psk=b'\x01' * 32,
+            cipher_suite=CipherSuite.TLS_CHACHA20_POLY1305_SHA256,
+            ticket_age_add=2**32 - 1000, ticket_lifetime=7200,
+            received_at=100.0)
+        self.assertEqual(Uint32(2**32 - 1000), session.get_obfuscated_ticket_age(100.0))
+        self.assertEqual(Uint32(1000), session.get_obfuscated_ticket_age(102.0))
+        self.assertFalse(session.is_expired(7300.0))
+        self.assertTrue(session.is_expired(7301.0))
+
+    def test_max_ticket_lifetime(self):
+        session = SessionTicket(
+            ticket=b'foobar', psk=b'\x01' * 32,
+            cipher_suite=CipherSuite.TLS_CHACHA20_POLY1305_SHA256,
+            ticket_age_add=0, ticket_lifetime=2**32 - 1,
+            received_at=0)
+        self.assertFalse(session.is_expired(604800))
+        self.assertTrue(session.is_expired(604801))
+
+
+class SessionTicketFileTest(unittest.TestCase, StructTestMixin):
+
+    def setUp(self):
+        self.target = SessionTicketFile
+        self.obj = SessionTicketFile(tickets=[
+            SessionTicketEntry(
+                host=b'localhost', port=Uint16(50007), alpn=b'',
+                cipher_suite=CipherSuite.TLS_CHACHA20_POLY1305_SHA256,
+                ticket_age_add=Uint32(0x12345678),
+                ticket_lifetime=Uint32(7200),
+                received_at=Uint32(1534000000),
+                max_early_data_size=Uint32(16384),
+                psk=b'\x01' * 32, ticket=b'\x02' * 64),
+            SessionTicketEntry(
+                host=b'example.com', port=Uint16(443), alpn=b'h2',
+                cipher_suite=CipherSuite.TLS_CHACHA20_POLY1305_SHA256,
+                ticket_age_add=Uint32(0),
+                ticket_lifetime=Uint32(3600),
+                received_at=Uint32(1534000001),
+                max_early_data_size=Uint32(0),
+                psk=b'\x03' * 32, ticket=b'\x04' * 16) ])
+
+
+class SessionTicketStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'tickets')
+        self.now = time.time()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make_session(self, ticket, received_at=None, ticket_lifetime=7200):
+        if received_at is None:
+            received_at = self.now
+        return SessionTicket(
+            ticket=ticket, psk=b'\x01' * 32,
+            cipher_suite=CipherSuite.TLS_CHACHA20_POLY1305_SHA256,
+            ticket_age_add=0x12345678, ticket_lifetime=ticket_lifetime,
+            max_early_data_size=16384, received_at=int(received_at))
+
+    def test_pop_freshest(self):
+        store = SessionTicketStore()
+        store.add('localhost', 50007, self.make_session(b'old', self.now - 10))
+        store.add('localhost', 50007, self.make_session(b'new', self.now))
+        store.add('localhost', 50007, self.make_session(b'mid', self.now - 5))
+        self.assertEqual(b'new', store.pop('localhost', 50007).ticket)
+        self.assertEqual(b'mid', store.pop('localhost', 50007).ticket)
+        self.assertEqual(b'old', store.pop('localhost', 50007).ticket)
+        self.assertEqual(None, store.pop('localhost', 50007))
+
+    def test_keyed_by_server(self):
+        store = SessionTicketStore()
+        store.add('localhost', 50007, self.make_session(b'a'))
+        store.add('localhost', 50008, self.make_session(b'b'))
+        store.add('localhost', 50007, self.make_session(b'c'), alpn=b'h2')
+        self.assertEqual(None, store.pop('example.com', 50007))
+        self.assertEqual(b'c', store.pop('localhost', 50007, alpn=b'h2').ticket)
+        self.assertEqual(b'b', store.pop('localhost', 50008).ticket)
+        self.assertEqual(b'a', store.pop('localhost', 50007).ticket)
+
+    def test_prune(self):
+        store = SessionTicketStore()
+        store.add('localhost', 50007,
+                  self.make_session(b'expired', self.now - 100, ticket_lifetime=10))
+        store.add('localhost', 50007,
+                  self.make_session(b'fresh', self.now - 200))
+        self.assertEqual(1, len(store))
+        self.assertEqual(b'fresh', store.pop('localhost', 50007).ticket)
+        self.assertEqual(None, store.pop('localhost', 50007))
+
+    def test_max_tickets_per_server(self):
+        store = SessionTicketStore(max_tickets_per_server=2)
+        for i in range(4):
+            store.add('localhost', 50007, self.make_session(bytes([i]), self.now + i))
+        self.assertEqual(2, len(store))
+        self.assertEqual(b'\x03', store.pop('localhost', 50007).ticket)
+        self.assertEqual(b'\x02', store.pop('localhost', 50007).ticket)
+
+    def test_persist(self):
+        session = self.make_session(b'foobar')
+        SessionTicketStore(path=self.path).add('localhost', 50007, session)
+        self.assertEqual(0o600, os.stat(self.path).st_mode & 0o777)
+
+        # 次に起動したクライアントが同じチケットを使える
+        store = SessionTicketStore(path=self.path)
+        restored = store.pop('localhost', 50007)
+        self.assertEqual(session.ticket, restored.ticket)
+        self.assertEqual(session.psk, restored.psk)
+        self.assertEqual(session.ticket_age_add, restored.ticket_age_add)
+        self.assertEqual(session.ticket_lifetime, restored.ticket_lifetime)
+        self.assertEqual(session.max_early_data_size, restored.max_early_data_size)
+        self.assertEqual(session.received_at, restored.received_at)
+
+        # 取り出したチケットはファイルからも消える
+        self.assertEqual(None, SessionTicketStore(path=self.path).pop('localhost', 50007))
+
+    def test_load__broken_file(self):
+        # 途中で切れたファイルは読み捨てて空から始め，次の書き込みで置き換える
+        store = SessionTicketStore(path=self.path)
+        store.add('localhost', 50007, self.make_session(b'foobar'))
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        for broken in (data[:len(data) // 2], b'\xff' * 7):
+            with open(self.path, 'wb') as f:
+                f.write(broken)
+            store = SessionTicketStore(path=self.path)
+            self.assertEqual(None, store.pop('localhost', 50007))
+            store.add('localhost', 50007, self.make_session(b'new'))
+            self.assertEqual(b'new', SessionTicketStore(path=self.path)
+                             .pop('localhost', 50007).ticket)
@@ -0,0 +1,16 @@
+
+from tls13.protocol import *
+from tls13.utils.connection import Connection
+from tls13.encryption import Cipher
+
+
+def make_connection(sock, read_key, write_key, side='client'):
+    # sock で送受信し，read_key と write_key から作った鍵で暗号化・復号する接続
+    conn = Connection(side=side)
+    conn.socket = sock
+    conn.state.set_cipher_suite(CipherSuite.TLS_CHACHA20_POLY1305_SHA256)
+    conn.state.set_crypto(
+        read_crypto=Cipher.Chacha20Poly1305(key=read_key * 32, nonce=read_key * 12),
+        write_crypto=Cipher.Chacha20Poly1305(key=write_key * 32, nonce=write_key * 12),
+        read_secret=read_key * 32, write_secret=write_key * 32)
+    return conn
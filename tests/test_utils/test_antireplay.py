@@ -0,0 +1,61 @@
+
+import secrets
+import unittest
+
+from tls13.utils.antireplay import BloomFilter, AntiReplayFilter
+
+
+class BloomFilterTest(unittest.TestCase):
+
+    def test_add(self):
+        bloom = BloomFilter(capacity=1000, error_rate=1e-6)
+        items = [secrets.token_bytes(32) for _ in range(1000)]
+        for item in items:
+            bloom.add(item)
+        self.assertTrue(all(item in bloom for item in items))
+
+    def test_false_positive(self):
+        bloom = BloomFilter(capacity=1000, error_rate=1e-3)
+        for _ in range(1000):
+            bloom.add(secrets.token_bytes(32))
+        false_positive = sum(secrets.token_bytes(32) in bloom for _ in range(1000))
+        self.assertLess(false_positive, 20)
+
+    def test_clear(self):
+        bloom = BloomFilter(capacity=10)
+        bloom.add(b'foobar')
+        bloom.clear()
+        self.assertFalse(b'foobar' in bloom)
+
+
+class AntiReplayFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.anti_replay = AntiReplayFilter(window=10, capacity=100)
+        self.now = self.anti_replay.rotated_at
+
+    def test_check_and_add(self):
+        self.assertTrue(self.anti_replay.check_and_add(b'binder1', self.now))
+        self.assertFalse(self.anti_replay.check_and_add(b'binder1', self.now))
+        self.assertTrue(self.anti_replay.check_and_add(b'binder2', self.now))
+
+    def test_rotate(self):
+        self.assertTrue(self.anti_replay.check_and_add(b'binder', self.now))
+        # 1回切り替えた後も記録は残る
+        self.assertFalse(self.anti_replay.check_and_add(b'binder', self.now + 10))
+        # 2回切り替えると記録は消える
+        self.assertTrue(self.anti_replay.check_and_add(b'binder', self.now + 20))
+
+    def test_rotate__idle(self):
+        self.assertTrue(self.anti_replay.check_and_add(b'binder', self.now))
+        self.assertTrue(self.anti_replay.check_and_add(b'binder', self.now + 25))
+
+    def test_capacity(self):
+        for i in range(100):
+            self.assertTrue(self.anti_replay.check_and_add(bytes([i]), self.now))
+        self.assertFalse(self.anti_replay.check_and_add(b'binder', self.now))
+
+    def test_is_fresh(self):
+        self.assertTrue(self.anti_replay.is_fresh(1000, 1000))
+        self.assertTrue(self.anti_replay.is_fresh(1000, 11000))
+        self.assertFalse(self.anti_replay.is_fresh(1000, 11001))
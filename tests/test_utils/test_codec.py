@@ -1,7 +1,8 @@
 
 import unittest
 
-from tls13.metastruct.codec import Reader
+from tls13.metastruct.codec import Reader, ReaderParseError, SegmentWriter
+from tls13.metastruct.metastruct import Listof
 from tls13.metastruct.type import *
 
 class ReaderTest(unittest.TestCase):
@@ -97,9 +98,94 @@ class ReaderTest(unittest.TestCase):
         reader.get(3)
         self.assertEqual(b'\xef', reader.get_rest())
 
+    def test_get_rest__view(self):
+        data = bytearray.fromhex('deadbeef')
+        rest = Reader(data).get_rest()
+        self.assertIsInstance(rest, memoryview)
+        self.assertEqual(rest.obj, data)
+
+    def test_copy(self):
+        data = bytearray.fromhex('02deadbeef')
+        reader = Reader(data)
+        value = reader.get_var_bytes(1, copy=True)
+        self.assertIsInstance(value, bytes)
+        self.assertIsInstance(reader.get_rest(), memoryview)
+
+        reader = Reader(data, copy=True)
+        self.assertIsInstance(reader.get_var_bytes(1), bytes)
+        self.assertIsInstance(reader.get_rest(), bytes)
+        self.assertIsInstance(reader.get_rest(copy=False), memoryview)
+
+    def test_nested_reader(self):
+        # memoryview から作った Reader も元のバイト列を指す
+        data = bytes.fromhex('0004 0002cafe 00')
+        reader = Reader(data)
+        inner = Reader(reader.get(bytes, length_t=Uint16))
+        self.assertEqual(b'\xca\xfe', inner.get(bytes, length_t=Uint16))
+        self.assertIs(inner.view.obj, data)
+
+    def test_get_var_bytes__overrun(self):
+        reader = Reader(bytes.fromhex('05deadbeef'))
+        self.assertRaises(ReaderParseError, lambda: reader.get_var_bytes(1))
+
+    def test_get_fix_list__uint24(self):
+        reader = Reader(bytes.fromhex('000001 010000'))
+        self.assertEqual([1, 0x010000],
+                         reader.get_fix_list(elem_length=3, list_length=2))
+        self.assertRaises(ReaderParseError,
+                          lambda: reader.get_fix_list(elem_length=2, list_length=1))
+
+    def test_get_var_list__misaligned(self):
+        reader = Reader(bytes.fromhex('03 000100'))
+        self.assertRaises(SyntaxError,
+                          lambda: reader.get_var_list(elem_length=2, length_length=1))
+
     def test_get_rest_length(self):
         reader = Reader(bytearray.fromhex('deadbeef'))
         self.assertEqual(4, reader.get_rest_length())
 
         reader.get(3)
         self.assertEqual(1, reader.get_rest_length())
+
+    def test_get_var_bytes__limits(self):
+        data = bytes.fromhex('03 abcdef')
+        reader = Reader(data)
+        value = reader.get_var_bytes(1, copy=True, min_length=3, max_length=3)
+        self.assertEqual(b'\xab\xcd\xef', value)
+        with self.assertRaises(ReaderParseError):
+            Reader(data).get_var_bytes(1, min_length=4)
+        with self.assertRaises(ReaderParseError):
+            Reader(data).get_var_bytes(1, max_length=2)
+
+    def test_get__limits(self):
+        # 長さが範囲外のときはデータが足りなくても長さのエラーになる
+        reader = Reader(bytes.fromhex('ffff 0304'))
+        with self.assertRaises(ReaderParseError):
+            reader.get(Listof(Uint16), length_t=Uint16, max_length=254)
+        reader = Reader(bytes.fromhex('0304'))
+        with self.assertRaises(ReaderParseError):
+            reader.get(bytes, min_length=3)
+
+
+class SegmentWriterTest(unittest.TestCase):
+
+    def test_small_bytes_are_joined(self):
+        writer = SegmentWriter()
+        writer.add_bytes(b'ab', length_t=Uint8)
+        writer.add_bytes(Uint16(3))
+        self.assertEqual([bytes.fromhex('02 6162 0003')], writer.get_segments())
+
+    def test_large_bytes_are_referenced(self):
+        data = bytes(300)
+        writer = SegmentWriter()
+        writer.add_bytes(data, length_t=Uint16)
+        writer.add_bytes(b'end')
+        segments = writer.get_segments()
+        self.assertEqual(3, len(segments))
+        self.assertIs(data, segments[1])
+        self.assertEqual(b'\x01\x2c' + data + b'end', b''.join(segments))
+
+    def test_min_segment_size(self):
+        writer = SegmentWriter(min_segment_size=2)
+        writer.add_bytes(b'ab')
+        self.assertEqual([b'ab'], writer.get_segments())
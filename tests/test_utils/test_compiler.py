@@ -0,0 +1,279 @@
+import unittest
+
+from tls13.metastruct.codec import Reader, ReaderParseError
+from tls13.metastruct.metastruct import *
+from tls13.metastruct.type import *
+from tls13.protocol import (CipherSuite, ClientHello, Extension, ExtensionType,
+                           Finished, Handshake, HandshakeType,
+                           KeyShareClientHello)
+
+
+class Color(Type):
+    red = Uint8(1)
+    blue = Uint8(2)
+    _size = 1
+
+
+class Tag(bytes):
+    _size = 4
+
+
+class Point(Struct):
+    members = [
+        Member(Color, 'color', default=Color.red),
+        Member(Uint16, 'x'),
+        Member(Uint24, 'y'),
+    ]
+
+    def __init__(self, **kwargs):
+        self.set_args(**kwargs)
+
+
+class Shape(Struct):
+    members = [
+        Member(Tag, 'tag'),
+        Member(bytes, 'name', length_t=Uint8),
+        Member(Listof(Point), 'points', length_t=Uint16),
+        Member(Listof(Uint16), 'weights', length_t=Uint8),
+        Member(Point, 'center'),
+        Member(bytes, 'comment'),
+    ]
+
+    def __init__(self, **kwargs):
+        self.set_args(**kwargs)
+
+
+class CompiledStructTest(unittest.TestCase):
+
+    def make_shape(self):
+        return Shape(
+            tag=b'abcd',
+            name=b'triangle',
+            points=[Point(x=Uint16(1), y=Uint24(0x010203)),
+                    Point(color=Color.blue, x=Uint16(2), y=Uint24(3))],
+            weights=[Uint16(0xaaaa), Uint16(0xbbbb)],
+            center=Point(x=Uint16(0), y=Uint24(0)),
+            comment=b'rest')
+
+    def test_to_bytes(self):
+        point = Point(x=Uint16(0x1234), y=Uint24(0x56789a))
+        self.assertEqual(point.to_bytes(), bytes.fromhex('01 1234 56789a'))
+        self.assertEqual(len(point), 6)
+
+    def test_len(self):
+        shape = self.make_shape()
+        self.assertEqual(len(shape), len(shape.to_bytes()))
+
+    def test_from_bytes(self):
+        shape = self.make_shape()
+        data = shape.to_bytes()
+        shape2 = Shape.from_bytes(data)
+        self.assertEqual(shape2.tag, b'abcd')
+        self.assertEqual(shape2.name, b'triangle')
+        self.assertEqual(shape2.points[0].y, Uint24(0x010203))
+        self.assertEqual(shape2.points[1].color, Color.blue)
+        self.assertEqual(shape2.weights, [Uint16(0xaaaa), Uint16(0xbbbb)])
+        self.assertEqual(shape2.comment, b'rest')
+        self.assertEqual(shape2.to_bytes(), data)
+
+    def test_from_bytes__reader(self):
+        data = Point(x=Uint16(1), y=Uint24(2)).to_bytes() * 2
+        reader = Reader(data)
+        point1, reader = Point.from_bytes(reader=reader)
+        point2, reader = Point.from_bytes(reader=reader)
+        self.assertEqual(point2.x, Uint16(1))
+        self.assertEqual(reader.get_rest_length(), 0)
+
+    def test_from_bytes__truncated(self):
+        data = self.make_shape().to_bytes()
+        for size in (3, 5, 10, 20):
+            with self.assertRaises(ReaderParseError):
+                Shape.from_bytes(data[:size])
+
+    def test_from_bytes__element_overrun(self):
+        # 要素の長さがリストの長さを超えるときはエラー
+        data = bytes.fromhex('0005') + Point(x=Uint16(1), y=Uint24(2)).to_bytes()
+        with self.assertRaises(ReaderParseError):
+            KeyShareClientHello.from_bytes(bytes.fromhex('0003 001d 0020'))
+        with self.assertRaises(ReaderParseError):
+            Shape.from_bytes(b'abcd' + b'\x00' + data)
+
+    def test_from_bytes__limits(self):
+        class Limited(Struct):
+            members = [
+                Member(bytes, 'name', length_t=Uint8, min_length=2, max_length=4),
+                Member(Listof(Point), 'points', length_t=Uint16, max_count=2),
+                Member(Listof(Uint16), 'weights', length_t=Uint8, max_count=2),
+            ]
+
+            def __init__(self, **kwargs):
+                self.set_args(**kwargs)
+
+        point = Point(x=Uint16(1), y=Uint24(2))
+        ok = Limited(name=b'ab', points=[point] * 2, weights=[Uint16(1)] * 2)
+        self.assertEqual(Limited.from_bytes(ok.to_bytes()).to_bytes(), ok.to_bytes())
+        for kwargs in [dict(name=b'a'), dict(name=b'abcde'),
+                       dict(points=[point] * 3), dict(weights=[Uint16(1)] * 3)]:
+            obj = Limited(name=b'ab', points=[], weights=[])
+            for name, value in kwargs.items():
+                setattr(obj, name, value)
+            with self.assertRaises(ReaderParseError):
+                Limited.from_bytes(obj.to_bytes())
+
+    def test_set_args__default(self):
+        self.assertEqual(Point(x=Uint16(1), y=Uint24(2)).color, Color.red)
+        self.assertEqual(Shape(tag=b'abcd').points, [])
+        self.assertEqual(Shape(tag=b'abcd').name, None)
+
+    def test_set_args__list_default_is_copied(self):
+        hello1 = ClientHello(cipher_suites=[], extensions=[])
+        hello2 = ClientHello(cipher_suites=[], extensions=[])
+        hello1.legacy_compression_methods.append(Uint8(1))
+        self.assertEqual(hello2.legacy_compression_methods, [Uint8(0)])
+
+    def test_set_args__default_factory(self):
+        # default_factory は引数が無いときだけ呼ばれる
+        calls = []
+
+        class Stamped(Struct):
+            members = [
+                Member(Uint32, 'stamp',
+                       default_factory=lambda: calls.append(1) or Uint32(7)),
+            ]
+
+            def __init__(self, **kwargs):
+                self.set_args(**kwargs)
+
+        self.assertEqual(Stamped(stamp=Uint32(1)).stamp, Uint32(1))
+        self.assertEqual(calls, [])
+        self.assertEqual(Stamped().stamp, Uint32(7))
+        self.assertEqual(calls, [1])
+        Stamped.from_bytes(bytes(4))
+        self.assertEqual(calls, [1])
+
+    def test_set_default__factory(self):
+        calls = []
+
+        class OldPoint(Struct):
+            def __init__(self, **kwargs):
+                self.struct = Members(self, Point.members)
+                self.struct.set_default(
+                    'x', factory=lambda: calls.append(1) or Uint16(3))
+                self.struct.set_args(**kwargs)
+
+        self.assertEqual(OldPoint(x=Uint16(1), y=Uint24(2)).x, Uint16(1))
+        self.assertEqual(calls, [])
+        self.assertEqual(OldPoint(y=Uint24(2)).x, Uint16(3))
+        self.assertEqual(calls, [1])
+
+    def test_set_args__assert(self):
+        with self.assertRaises(RuntimeError):
+            Point(color=Uint8(3), x=Uint16(1), y=Uint24(2))
+        with self.assertRaises(RuntimeError):
+            Shape(tag=b'abcd', weights=[Uint8(1)])
+
+    def test_to_bytes__nested(self):
+        # 入れ子の構造体とリストの要素のバイト列をつなげたものになる
+        shape = self.make_shape()
+        self.assertEqual(shape.to_bytes(),
+                         b''.join([b'abcd', b'\x08triangle',
+                                   bytes.fromhex('000c'),
+                                   shape.points[0].to_bytes(),
+                                   shape.points[1].to_bytes(),
+                                   bytes.fromhex('04 aaaa bbbb'),
+                                   shape.center.to_bytes(), b'rest']))
+
+    def test_to_bytes__bytes_member(self):
+        # Member(Struct, ...) にバイト列が入っていてもよい
+        ext = Extension(extension_type=ExtensionType.server_name,
+                        extension_data=b'abc')
+        self.assertEqual(ext.to_bytes(), bytes.fromhex('0000 0003') + b'abc')
+
+    def test_write_into(self):
+        # 入れ子の構造体も buf に直接書き，to_bytes と同じバイト列になる
+        shape = self.make_shape()
+        data = shape.to_bytes()
+        buf = bytearray(len(data) + 3)
+        self.assertEqual(shape.write_into(buf, 3), len(buf))
+        self.assertEqual(bytes(buf[3:]), data)
+
+    def test_write_into__bytes_member(self):
+        ext = Extension(extension_type=ExtensionType.server_name,
+                        extension_data=b'abc')
+        buf = bytearray(len(ext))
+        self.assertEqual(ext.write_into(buf, 0), 7)
+        self.assertEqual(bytes(buf), bytes.fromhex('0000 0003') + b'abc')
+
+    def test_write_into__handshake(self):
+        # 受信したバイト列から作った Handshake はそのバイト列を書く
+        hello = Handshake(
+            msg_type=HandshakeType.client_hello,
+            msg=ClientHello(cipher_suites=[
+                CipherSuite.TLS_CHACHA20_POLY1305_SHA256], extensions=[]))
+        for handshake in (hello, Handshake.from_bytes(hello.to_bytes())):
+            buf = bytearray(len(handshake))
+            self.assertEqual(handshake.write_into(buf, 0), len(buf))
+            self.assertEqual(bytes(buf), hello.to_bytes())
+
+    def test_to_segments(self):
+        shape = self.make_shape()
+        self.assertEqual(b''.join(shape.to_segments()), shape.to_bytes())
+
+    def test_to_segments__large_bytes_not_copied(self):
+        # 大きなバイト列はコピーしないでそのまま segments に入る
+        comment = bytes(1000)
+        shape = self.make_shape()
+        shape.comment = comment
+        segments = shape.to_segments()
+        self.assertTrue(any(segment is comment for segment in segments))
+        self.assertEqual(b''.join(segments), shape.to_bytes())
+
+    def test_to_segments__empty(self):
+        class Empty(Struct):
+            members = []
+
+            def __init__(self, **kwargs):
+                self.set_args(**kwargs)
+
+        self.assertEqual(Empty().to_segments(), [])
+
+    def test_repr(self):
+        point = Point(x=Uint16(1), y=Uint24(2))
+        self.assertIn('color: Uint8(0x01) == red', repr(point))
+
+    def test_slots(self):
+        point = Point(x=Uint16(1), y=Uint24(2))
+        self.assertEqual(Point.__slots__, ('color', 'x', 'y'))
+        self.assertFalse(hasattr(point, '__dict__'))
+        with self.assertRaises(AttributeError):
+            point.z = 1
+
+    def test_slots__extra(self):
+        class Labeled(Point):
+            members = Point.members
+            __slots__ = ('label',)
+
+        point = Labeled(x=Uint16(1), y=Uint24(2))
+        point.label = 'a'
+        self.assertFalse(hasattr(point, '__dict__'))
+
+    def test_keep_handwritten_methods(self):
+        # クラスに書いた from_bytes は生成したものに置き換えない
+        self.assertEqual(Finished.from_bytes.__func__.__qualname__,
+                         'Finished.from_bytes')
+        self.assertFalse(hasattr(Extension, '_decode'))
+
+    def test_same_bytes_as_members(self):
+        # インスタンスごとの Members と同じバイト列になる
+        class OldPoint(Struct):
+            def __init__(self, **kwargs):
+                self.struct = Members(self, Point.members)
+                self.struct.set_args(**kwargs)
+
+        kwargs = dict(color=Color.blue, x=Uint16(7), y=Uint24(0xabcdef))
+        self.assertEqual(OldPoint(**kwargs).to_bytes(), Point(**kwargs).to_bytes())
+        self.assertEqual(len(OldPoint(**kwargs)), len(Point(**kwargs)))
+
+
+if __name__ == '__main__':
+    unittest.main()
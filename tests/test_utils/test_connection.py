@@ -0,0 +1,162 @@
+import socket
+import unittest
+
+from tls13.protocol import *
+from tls13.main.tlsconnection import TLSConnection
+from tls13.utils.connection import Connection
+from .common import make_connection
+
+
+def make_record(type, fragment):
+    return bytes([type]) + b'\x03\x03' + len(fragment).to_bytes(2, 'big') + fragment
+
+
+class PartialSocket:
+    # sendmsg で最大 limit バイトしか送れないソケット
+    def __init__(self, limit):
+        self.limit = limit
+        self.sent = bytearray()
+        self.calls = 0
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        data = b''.join(bytes(buffer) for buffer in buffers)[:self.limit]
+        self.sent += data
+        return len(data)
+
+
+class ConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sock, self.peer = socket.socketpair()
+        self.conn = Connection()
+        self.conn.socket = self.sock
+
+    def tearDown(self):
+        self.sock.close()
+        self.peer.close()
+
+    def test_recv_record(self):
+        records = [make_record(0x17, b'foo'), make_record(0x17, b'barbaz')]
+        self.peer.sendall(b''.join(records))
+        self.peer.close()
+        self.assertEqual(records[0], bytes(self.conn.recv_record()))
+        self.assertEqual(records[1], bytes(self.conn.recv_record()))
+        self.assertEqual(b'', self.conn.recv_record())
+
+    def test_record_size_limit(self):
+        self.conn.set_record_size_limit(64)
+        self.peer.sendall(make_record(0x17, bytes(64 + 255)) +
+                          make_record(0x17, bytes(64 + 256)))
+        self.assertEqual(5 + 64 + 255, len(self.conn.recv_record()))
+        with self.assertRaises(RuntimeError):
+            self.conn.recv_record()
+
+    def key_update_pair(self):
+        # self.conn（クライアント）と peer（サーバ）の application_traffic_secret を設定する
+        self.conn = make_connection(self.sock, b'\x01', b'\x02')
+        return make_connection(self.peer, b'\x02', b'\x01', side='server')
+
+    def test_recv_app_data_key_update(self):
+        peer = self.key_update_pair()
+        tls = TLSConnection.established(self.conn.state)
+        peer_tls = TLSConnection.established(peer.state)
+        peer_tls.send_key_update(request_update=True)
+        peer.send_msg(peer_tls.data_to_send())
+        RecordWriter(peer, None, state=peer.state).write(b'foo')
+        self.peer.shutdown(socket.SHUT_WR)
+        self.assertEqual(b'foo', self.conn.recv_app_data(tls))
+        self.assertEqual(b'', self.conn.recv_app_data(tls))
+        # 更新を求められたので self.conn も次に送るときに KeyUpdate を送る
+        RecordWriter(self.conn, None, state=self.conn.state).write(b'bar')
+        self.assertEqual(b'bar', peer.recv_app_data(peer_tls))
+
+    def test_recv_app_data_close_notify(self):
+        peer = self.key_update_pair()
+        tls = TLSConnection.established(self.conn.state)
+        peer_tls = TLSConnection.established(peer.state)
+        # ChangeCipherSpec は読み捨て，close_notify を受け取ったら b'' を返す
+        peer.send_msg(make_record(0x14, b'\x01'))
+        RecordWriter(peer, None, state=peer.state).write(b'foo')
+        peer_tls.close()
+        peer.send_msg(peer_tls.data_to_send())
+        self.assertEqual(b'foo', self.conn.recv_app_data(tls))
+        self.assertEqual(b'', self.conn.recv_app_data(tls))
+        self.assertTrue(tls.closed)
+
+    def test_auto_key_update(self):
+        peer = self.key_update_pair()
+        tls = TLSConnection.established(self.conn.state)
+        peer.state.key_update_policy = KeyUpdatePolicy(max_records=2)
+        data = bytes(range(256)) * 40
+        RecordWriter(peer, None, state=peer.state, max_fragment_size=1024) \
+            .write(data)
+        self.peer.close()
+        received = b''
+        while True:
+            content = self.conn.recv_app_data(tls)
+            if not content:
+                break
+            received += content
+        self.assertEqual(data, received)
+        self.assertEqual(self.conn.state.read_secret, peer.state.write_secret)
+        self.assertNotEqual(b'\x02' * 32, self.conn.state.read_secret)
+
+    def test_send_buffers(self):
+        buffers = [b'foo', b'', b'barbaz', b'qux']
+        self.conn.send_buffers(buffers)
+        self.sock.close()
+        self.assertEqual(b'foobarbazqux', self.peer.recv(100))
+
+    def test_send_buffers_partial(self):
+        self.conn.socket = PartialSocket(limit=4)
+        self.conn.send_buffers([b'foo', b'barbaz', b'qux'])
+        self.assertEqual(b'foobarbazqux', self.conn.socket.sent)
+        self.assertEqual(3, self.conn.socket.calls)
+        self.assertEqual(3, self.conn.stats.send_calls)
+        self.assertEqual(12, self.conn.stats.bytes_sent)
+
+    def test_stats(self):
+        record = make_record(0x17, b'foo')
+        self.peer.sendall(record + record)
+        self.conn.recv_record()
+        self.conn.recv_record()
+        self.conn.send_msg(record)
+        self.assertEqual(1, self.conn.stats.recv_calls)
+        self.assertEqual(2 * len(record), self.conn.stats.bytes_received)
+        self.assertEqual(1, self.conn.stats.send_calls)
+        self.assertEqual(len(record), self.conn.stats.bytes_sent)
+
+    def test_drive(self):
+        # 送るバイト列を送信し，イベントが起きるまでレコードを1つずつ渡す
+        class FakeTLS:
+            def __init__(self):
+                self.outgoing = b'hello'
+                self.records = []
+
+            def data_to_send(self):
+                data, self.outgoing = self.outgoing, b''
+                return data
+
+            def receive_record(self, record):
+                self.records.append(bytes(record))
+                return [len(self.records)] if len(self.records) == 2 else []
+
+        records = [make_record(0x16, b'a'), make_record(0x16, b'b'),
+                   make_record(0x17, b'c')]
+        self.peer.sendall(b''.join(records))
+        tls = FakeTLS()
+        self.assertEqual([2], self.conn.drive(tls, int))
+        self.assertEqual(records[:2], tls.records)
+        self.assertEqual(b'hello', self.peer.recv(5))
+        # 後のレコードは受信バッファに残る
+        self.assertEqual(records[2], bytes(self.conn.recv_record()))
+
+    def test_drive_closed(self):
+        class FakeTLS:
+            def data_to_send(self):
+                return b''
+
+        self.peer.close()
+        with self.assertRaises(ConnectionError):
+            self.conn.drive(FakeTLS(), int)
@@ -239,7 +239,8 @@ class Chacha20Poly1305Test(unittest.TestCase):
 
         polychacha = Chacha20Poly1305(key=b'\x00'*32, nonce=b'\x00'*12)
         tag = polychacha.poly1305_mac(text, otk)
-        self.assertEqual(tag, b'\x00')
+        # https://tools.ietf.org/html/rfc7539#appendix-A.3 (#1)
+        self.assertEqual(tag, b'\x00'*16)
 
     def test_vector_poly2(self):
         r = 0
@@ -434,7 +435,9 @@ class Chacha20Poly1305Test(unittest.TestCase):
 
         polychacha = Chacha20Poly1305(key=b'\x00'*32, nonce=b'\x00'*12)
         tag = polychacha.poly1305_mac(message, otk)
+        # https://tools.ietf.org/html/rfc7539#appendix-A.3 (#5)
+        # タグの上位のバイトが 0 でも 16 [bytes] になる
         expected_tag = binascii.unhexlify(
-            '03')
+            '03000000000000000000000000000000')
 
         self.assertEqual(tag, expected_tag)
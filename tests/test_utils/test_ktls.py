@@ -0,0 +1,145 @@
+import socket
+import struct
+import tempfile
+import unittest
+
+from tls13.protocol import *
+from tls13.main.tlsconnection import TLSConnection
+from tls13.utils import ktls
+from tls13.utils.connection import Connection
+from tls13.encryption import Cipher
+from .common import make_connection
+
+
+def tcp_pair():
+    # ループバックの TCP 接続
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    return client, server
+
+
+class CryptoInfoTest(unittest.TestCase):
+
+    def test_chacha20_poly1305(self):
+        crypto = Cipher.Chacha20Poly1305(key=b'\x01' * 32, nonce=b'\x02' * 12)
+        crypto.seq_number = 3
+        info = ktls.crypto_info(CipherSuite.TLS_CHACHA20_POLY1305_SHA256, crypto)
+        self.assertEqual(4 + 12 + 32 + 8, len(info))
+        self.assertEqual((0x0304, ktls.TLS_CIPHER_CHACHA20_POLY1305),
+                         struct.unpack('=HH', info[:4]))
+        self.assertEqual(b'\x02' * 12, info[4:16])
+        self.assertEqual(b'\x01' * 32, info[16:48])
+        self.assertEqual((3).to_bytes(8, 'big'), info[48:])
+
+    def test_seq_number(self):
+        crypto = Cipher.Chacha20Poly1305(key=b'\x01' * 32, nonce=b'\x02' * 12)
+        info = ktls.crypto_info(CipherSuite.TLS_CHACHA20_POLY1305_SHA256, crypto,
+                                seq_number=2**40)
+        self.assertEqual((2**40).to_bytes(8, 'big'), info[-8:])
+
+    def test_aes_gcm(self):
+        # AES-GCM の IV は salt（先頭4バイト）と iv（残り8バイト）に分ける
+        class FakeCrypto:
+            key_raw = b'\x01' * 16
+            nonce_raw = bytes(range(12))
+            seq_number = 0
+        info = ktls.crypto_info(CipherSuite.TLS_AES_128_GCM_SHA256, FakeCrypto)
+        self.assertEqual(4 + 8 + 16 + 4 + 8, len(info))
+        self.assertEqual(bytes(range(4, 12)), info[4:12])
+        self.assertEqual(b'\x01' * 16, info[12:28])
+        self.assertEqual(bytes(range(4)), info[28:32])
+
+    def test_unsupported(self):
+        with self.assertRaises(NotImplementedError):
+            ktls.crypto_info(CipherSuite.TLS_AES_128_CCM_SHA256, None)
+
+
+class OffloadTest(unittest.TestCase):
+
+    def setUp(self):
+        client_sock, server_sock = tcp_pair()
+        self.client = make_connection(client_sock, b'\x01', b'\x02')
+        self.server = make_connection(server_sock, b'\x02', b'\x01', side='server')
+        self.client_tls = TLSConnection.established(self.client.state)
+        self.server_tls = TLSConnection.established(self.server.state)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def transfer(self):
+        data = bytes(range(256)) * 100
+        RecordWriter(self.client, None, state=self.client.state).write(data)
+        RecordWriter(self.server, None, state=self.server.state).write(b'pong')
+        self.assertEqual(b'pong', self.client.recv_app_data(self.client_tls))
+        self.client.close()
+        received = b''
+        while True:
+            content = self.server.recv_app_data(self.server_tls)
+            if not content:
+                break
+            received += content
+        self.assertEqual(data, received)
+
+    def test_loopback(self):
+        # カーネルが対応していなくても，ユーザ空間で暗号化・復号して通信できる
+        tx, rx = ktls.offload(self.server)
+        self.assertEqual((tx, rx), (self.server.state.kernel_tx,
+                                    self.server.state.kernel_rx))
+        self.transfer()
+
+    def test_buffered_record(self):
+        # offload の前に受信バッファに入っていたレコードはユーザ空間で復号する
+        RecordWriter(self.client, None, state=self.client.state).write(b'early')
+        self.server.framer.recv_into(self.server.socket)
+        self.assertEqual(1, self.server.framer.buffered_records())
+        ktls.offload(self.server)
+        self.assertEqual(b'early', self.server.recv_app_data(self.server_tls))
+        self.transfer()
+
+    @unittest.skipUnless(ktls.available(), "kernel TLS is not available")
+    def test_kernel(self):
+        self.assertEqual((True, True), ktls.offload(self.server))
+        self.assertEqual((True, True), ktls.offload(self.client))
+        self.transfer()
+
+    @unittest.skipUnless(ktls.available(), "kernel TLS is not available")
+    def test_sendfile(self):
+        # sendfile の後のシーケンス番号はカーネルが実際に送ったレコードの数に合わせる
+        tx, _ = ktls.offload(self.server, rx=False)
+        if not tx:
+            self.skipTest("kernel TLS TX does not support "
+                          "TLS_CHACHA20_POLY1305_SHA256")
+        data = bytes(range(256)) * 300
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.seek(0)
+            writer = RecordWriter(self.server, None, state=self.server.state)
+            self.assertEqual(len(data), writer.write(f))
+        self.server.close()
+        received, num_records = b'', 0
+        while True:
+            content = self.client.recv_app_data(self.client_tls)
+            if not content:
+                break
+            received += content
+            num_records += 1
+        self.assertEqual(data, received)
+        self.assertEqual(num_records, self.server.state.write_crypto.seq_number)
+        self.assertEqual(len(data), self.server.state.bytes_written)
+
+    def test_not_tcp(self):
+        sock, peer = socket.socketpair()
+        conn = make_connection(sock, b'\x01', b'\x02')
+        self.assertEqual((False, False), ktls.offload(conn))
+        sock.close()
+        peer.close()
+
+    def test_no_cipher_suite(self):
+        conn = Connection()
+        conn.socket = self.server.socket
+        self.assertEqual((False, False), ktls.offload(conn))
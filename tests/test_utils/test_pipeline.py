@@ -0,0 +1,133 @@
+import io
+import queue
+import socket
+import threading
+import unittest
+
+from tls13.protocol import *
+from tls13.main.tlsconnection import TLSConnection
+from tls13.utils.pipeline import DuplexPipeline
+from .common import make_connection
+
+
+class BlockingWriter:
+    # release されるまで write が戻らない
+    def __init__(self):
+        self.event = threading.Event()
+        self.written = []
+
+    def write(self, data):
+        self.event.wait()
+        self.written.append(data)
+        return len(data)
+
+
+class FailingWriter:
+    def write(self, data):
+        raise RuntimeError("send failed")
+
+
+class DuplexPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        sock, peer_sock = socket.socketpair()
+        self.conn = make_connection(sock, b'\x01', b'\x02')
+        self.peer = make_connection(peer_sock, b'\x02', b'\x01', side='server')
+        self.writer = RecordWriter(self.conn, None, state=self.conn.state,
+                                   max_fragment_size=1024)
+        self.peer_writer = RecordWriter(self.peer, None, state=self.peer.state)
+        self.tls = TLSConnection.established(self.conn.state)
+        self.peer_tls = TLSConnection.established(self.peer.state)
+
+    def tearDown(self):
+        self.conn.close()
+        self.peer.close()
+
+    def recv_all(self, recv):
+        received = b''
+        while True:
+            data = recv()
+            if not data:
+                return received
+            received += data
+
+    def test_recv(self):
+        pipeline = DuplexPipeline(self.conn, self.tls, self.writer)
+        self.peer_writer.write(b'foo')
+        self.peer_writer.write(b'bar')
+        self.peer.close()
+        self.assertEqual(b'foo', pipeline.recv())
+        self.assertEqual(b'bar', pipeline.recv())
+        self.assertEqual(b'', pipeline.recv())
+        self.assertEqual(b'', pipeline.recv())
+
+    def test_send(self):
+        pipeline = DuplexPipeline(self.conn, self.tls, self.writer)
+        data = bytes(range(256)) * 100
+        buffer = bytearray(b'foo')
+        self.assertEqual(3, pipeline.send(buffer))
+        # send した後に書き換えても送るデータは変わらない
+        buffer[:] = b'xxx'
+        self.assertEqual(len(data), pipeline.send(io.BytesIO(data)))
+        self.assertEqual(6, pipeline.send([b'bar', b'baz']))
+        pipeline.flush()
+        self.assertEqual(0, pipeline.pending_sends)
+        pipeline.close()
+        self.conn.close()
+        self.assertEqual(b'foo' + data + b'barbaz',
+                         self.recv_all(lambda: self.peer.recv_app_data(self.peer_tls)))
+
+    def test_recv_error_after_data(self):
+        pipeline = DuplexPipeline(self.conn, self.tls, self.writer)
+        self.peer_writer.write(b'foo')
+        record = bytearray(protect(b'bar', self.peer.state.write_crypto))
+        record[-1] ^= 1
+        self.peer.send_msg(bytes(record))
+        # エラーの前に受信したデータは先に返す
+        self.assertEqual(b'foo', pipeline.recv())
+        with self.assertRaisesRegex(RuntimeError, 'aead_decrypt'):
+            pipeline.recv()
+        with self.assertRaisesRegex(RuntimeError, 'aead_decrypt'):
+            pipeline.recv()
+
+    def test_send_error(self):
+        pipeline = DuplexPipeline(self.conn, self.tls, FailingWriter())
+        pipeline.send(b'foo')
+        with self.assertRaisesRegex(RuntimeError, 'send failed'):
+            pipeline.flush()
+        with self.assertRaisesRegex(RuntimeError, 'send failed'):
+            pipeline.send(b'bar')
+        with self.assertRaisesRegex(RuntimeError, 'send failed'):
+            pipeline.close()
+
+    def test_backpressure(self):
+        writer = BlockingWriter()
+        pipeline = DuplexPipeline(self.conn, self.tls, writer, send_queue_size=1)
+        pipeline.send(b'foo')
+        pipeline.send(b'bar')
+        # 送信スレッドが foo で止まり，キューには bar が残っている
+        with self.assertRaises(queue.Full):
+            pipeline.send(b'baz', timeout=0.05)
+        writer.event.set()
+        pipeline.close()
+        self.assertEqual([b'foo', b'bar'], writer.written)
+
+    def test_recv_timeout(self):
+        pipeline = DuplexPipeline(self.conn, self.tls, self.writer)
+        with self.assertRaises(queue.Empty):
+            pipeline.recv(timeout=0.05)
+
+    def test_key_update(self):
+        pipeline = DuplexPipeline(self.conn, self.tls, self.writer)
+        self.peer_tls.send_key_update(request_update=True)
+        self.peer.send_msg(self.peer_tls.data_to_send())
+        self.peer_writer.write(b'foo')
+        self.assertEqual(b'foo', pipeline.recv())
+        # 鍵の更新は送信スレッドが次のデータの前に行う
+        self.assertTrue(self.conn.state.key_update_requested)
+        pipeline.send(b'bar')
+        pipeline.close()
+        self.assertEqual(b'bar', self.peer.recv_app_data(self.peer_tls))
+        self.assertEqual(self.peer.state.read_secret,
+                         self.conn.state.write_secret)
+        self.assertFalse(self.conn.state.key_update_requested)
@@ -0,0 +1,65 @@
+import os
+import tempfile
+import unittest
+
+from tls13.utils import cryptomath
+from tls13.utils.psk import ExternalPsk, ExternalPskTable
+from tls13.protocol import CipherSuite
+
+
+class ExternalPskTest(unittest.TestCase):
+
+    def setUp(self):
+        self.key = bytes(range(32))
+
+    def test_precomputed_secrets(self):
+        psk = ExternalPsk(b'client1', self.key)
+        early_secret = cryptomath.HKDF_extract(bytearray(32), self.key, 'sha256')
+        self.assertEqual(early_secret, psk.early_secret)
+        self.assertEqual(cryptomath.derive_secret(early_secret, b"ext binder", b""),
+                         psk.binder_key)
+        # チケット (res binder) とは別の binder_key になる
+        self.assertNotEqual(cryptomath.gen_binder_key(early_secret), psk.binder_key)
+
+    def test_from_string(self):
+        psk = ExternalPsk.from_string('client1:' + self.key.hex())
+        self.assertEqual(b'client1', psk.identity)
+        self.assertEqual(self.key, psk.key)
+        self.assertEqual('sha256', psk.hash_algo)
+
+        psk = ExternalPsk.from_string('client1:' + self.key.hex() + ':sha384')
+        self.assertEqual('sha384', psk.hash_algo)
+        self.assertEqual(48, len(psk.binder_key))
+
+        with self.assertRaises(ValueError):
+            ExternalPsk.from_string('client1')
+
+    def test_is_usable_with(self):
+        psk = ExternalPsk(b'client1', self.key, 'sha256')
+        self.assertTrue(psk.is_usable_with(CipherSuite.TLS_CHACHA20_POLY1305_SHA256))
+        self.assertFalse(psk.is_usable_with(CipherSuite.TLS_AES_256_GCM_SHA384))
+
+
+class ExternalPskTableTest(unittest.TestCase):
+
+    def test_get(self):
+        psk1 = ExternalPsk(b'client1', b'\x01' * 32)
+        psk2 = ExternalPsk(b'client2', b'\x02' * 32)
+        table = ExternalPskTable([psk1, psk2])
+        self.assertEqual(2, len(table))
+        self.assertIs(psk1, table.get(b'client1'))
+        self.assertIs(psk2, table.get(bytearray(b'client2')))
+        self.assertEqual(None, table.get(b'client3'))
+
+    def test_load(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'psks')
+            with open(path, 'w') as f:
+                f.write('# internal links\n')
+                f.write('client1:%s\n' % ('01' * 32))
+                f.write('\n')
+                f.write('client2:%s:sha384  # backup\n' % ('02' * 48))
+            table = ExternalPskTable.load(path)
+        self.assertEqual(2, len(table))
+        self.assertEqual(b'\x01' * 32, table.get(b'client1').key)
+        self.assertEqual('sha384', table.get(b'client2').hash_algo)
@@ -0,0 +1,106 @@
+import io
+import os
+import tempfile
+import unittest
+
+from tls13.utils.trace import Tracer, StreamSink, RingBufferSink, \
+    ERROR, INFO, DEBUG
+
+
+class Counter:
+    # __str__ が呼ばれた回数を数える
+    def __init__(self):
+        self.count = 0
+
+    def __str__(self):
+        self.count += 1
+        return 'counter'
+
+
+class TracerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tracer = Tracer()
+        self.category = self.tracer.category('record')
+
+    def test_disabled_by_default(self):
+        self.assertFalse(self.category.error)
+        self.assertFalse(self.category.debug)
+        # レベルを設定しても sink が無ければ出力しない
+        self.tracer.set_level(DEBUG)
+        self.assertFalse(self.category.debug)
+
+    def test_levels(self):
+        sink = self.tracer.add_sink(RingBufferSink())
+        self.tracer.set_level(INFO)
+        self.assertTrue(self.category.error)
+        self.assertTrue(self.category.info)
+        self.assertFalse(self.category.debug)
+        self.category.log(INFO, "length: %d", 5)
+        self.category.log(DEBUG, "hidden")
+        self.assertEqual(["[record] length: 5"],
+                         [record.format() for record in sink.records])
+
+    def test_category_level(self):
+        sink = self.tracer.add_sink(RingBufferSink())
+        self.tracer.configure('error,record=debug')
+        other = self.tracer.category('handshake')
+        self.assertTrue(self.category.debug)
+        self.assertFalse(other.info)
+        self.assertTrue(other.error)
+        self.category.log(DEBUG, "shown")
+        other.log(INFO, "hidden")
+        self.assertEqual(["[record] shown"],
+                         [record.format() for record in sink.records])
+        self.tracer.set_level('off', 'record')
+        self.assertFalse(self.category.error)
+
+    def test_deferred_format(self):
+        counter = Counter()
+        self.category.log(ERROR, "%s", counter)
+        self.assertEqual(0, counter.count)
+        self.tracer.add_sink(RingBufferSink())
+        self.tracer.set_level(ERROR)
+        self.category.log(DEBUG, "%s", counter)
+        self.assertEqual(0, counter.count)
+        # sink が複数あっても書式化は1回だけ
+        self.tracer.add_sink(RingBufferSink())
+        self.category.log(ERROR, "%s", counter)
+        self.assertEqual(1, counter.count)
+
+    def test_unknown_level(self):
+        with self.assertRaises(ValueError):
+            self.tracer.set_level('verbose')
+
+    def test_stream_sink(self):
+        stream = io.StringIO()
+        self.tracer.add_sink(StreamSink(stream))
+        self.tracer.set_level(INFO)
+        self.category.log(INFO, "foo")
+        self.assertEqual("[record] foo\n", stream.getvalue())
+
+    def test_setup(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'trace.log')
+            self.tracer.setup('info', path)
+            self.category.log(INFO, "foo")
+            self.tracer.reset()
+            with open(path) as f:
+                self.assertEqual("[record] foo\n", f.read())
+        self.assertFalse(self.category.error)
+        self.tracer.setup('off')
+        self.assertEqual([], self.tracer.sinks)
+
+
+class RingBufferSinkTest(unittest.TestCase):
+
+    def test_capacity(self):
+        tracer = Tracer()
+        sink = tracer.add_sink(RingBufferSink(capacity=3))
+        tracer.set_level(DEBUG)
+        category = tracer.category('record')
+        for i in range(5):
+            category.log(DEBUG, "%d", i)
+        self.assertEqual("[record] 2\n[record] 3\n[record] 4", sink.dump())
+        sink.clear()
+        self.assertEqual("", sink.dump())
@@ -1,7 +1,8 @@
 
+import copy
 import unittest
 
-from tls13.metastruct.type import Uint8, Uint16, Uint24, Uint32
+from tls13.metastruct.type import Uint, Uint8, Uint16, Uint24, Uint32, Type
 
 
 class UintTestMixin:
@@ -13,12 +14,40 @@ class UintTestMixin:
     def test_len(self):
         self.assertEqual(self.target._size, len(self.target(0)))
 
+    def test_no_dict(self):
+        self.assertFalse(hasattr(self.target(0), '__dict__'))
+
+    def test_interned(self):
+        self.assertIs(self.target(0), self.target(0))
+        self.assertIs(self.target(255), self.target(255))
+
+    def test_copy(self):
+        self.assertEqual(copy.deepcopy(self.target(1000 % 2**(self.size*8))),
+                         self.target(1000 % 2**(self.size*8)))
+
 
 class UintTest(unittest.TestCase):
 
     def test_raise_when_init(self):
         self.assertRaises(Exception, lambda: Uint(8))
 
+    def test_raise_when_not_int(self):
+        self.assertRaises(Exception, lambda: Uint8(True))
+        self.assertRaises(Exception, lambda: Uint16(1.0))
+
+    def test_type_constants_are_interned(self):
+        class Color(Type):
+            red = Uint16(0x1234)
+            _size = 2
+
+        self.assertIs(Uint16(0x1234), Color.red)
+        self.assertIn(Uint16(0x1234), Color.values())
+
+    def test_not_interned(self):
+        # 大きい値は共有しない（キャッシュが際限なく大きくならない）
+        self.assertIsNot(Uint32(2**31 + 7), Uint32(2**31 + 7))
+        self.assertEqual(Uint32(2**31 + 7), Uint32(2**31 + 7))
+
 
 class Uint8Test(unittest.TestCase, UintTestMixin):
 
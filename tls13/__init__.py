@@ -1,3 +1,4 @@
-
-from .protocol import *
+# utils.trace はどのモジュールからもモジュールの先頭で import するので，
+# protocol より先に utils を読み込んでおく
 from .utils import *
+from .protocol import *
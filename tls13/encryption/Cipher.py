@@ -5,6 +5,10 @@ import math
 from .chacha20poly1305 import *
 
 from Crypto.Util.number import bytes_to_long, long_to_bytes
+from ..utils.trace import tracer, DEBUG
+
+# 鍵や nonce は secret カテゴリに出力する
+_trace = tracer.category('secret')
 
 ## NOTE : 今後のためにファイル分けとかも考えた方が良さそう?
 ##          chacha20poly1305だけならまだ大丈夫かも
@@ -25,8 +29,8 @@ def concatenate_bytes(array:list) -> bytes:
 
 class Cipher:
 
-    seq_number = 0
-
+    # シーケンス番号はインスタンスごと（鍵ごと）に持つ．
+    # クラス変数にすると同じプロセスの他の接続と共有されてしまう
     def __init__(self, key, nonce):
         self.key_raw = key
         self.nonce_raw = nonce
@@ -77,8 +81,9 @@ class Chacha20Poly1305(Cipher):
         self.iv = make_array(nonce, 4, to_int=True)
 
     def encrypt(self, plaintext, nonce):
-        print("[+] key", self.key_raw.hex(), self.key)
-        print("[+] nonce", self.nonce_raw.hex(), nonce)
+        if _trace.debug:
+            _trace.log(DEBUG, "key %s\nnonce %s %s",
+                       self.key_raw.hex(), self.nonce_raw.hex(), nonce)
 
         counter = 1
         #encrypted_message = bytearray(0)
@@ -142,11 +147,8 @@ class Chacha20Poly1305(Cipher):
 
 
         def le_num(n : int):
-            dt = hex(n)[2:].encode()
-            if len(dt) % 2 != 0:
-                dt = b'0' + dt
-            dt = b"".join([dt[i:i+2] for i in range(len(dt)-2, -1, -2)])
-            return int(dt, 16)
+            # 先頭の 0 のバイトを落とさないように 16 [bytes] で反転する
+            return int.from_bytes(n.to_bytes(16, 'big'), 'little')
 
         s, r = otk
 
@@ -175,7 +177,8 @@ class Chacha20Poly1305(Cipher):
         accumulator = (accumulator + s) % 2**128
         # print("[+] TAG(REVERSED) :\t ", long_to_bytes(accumulator).hex())
         # print("[+] TAG :\t\t ", long_to_bytes(accumulator)[::-1].hex())
-        return long_to_bytes(accumulator)[::-1]
+        # タグは常に 16 [bytes]（上位のバイトが 0 でも省略しない）
+        return accumulator.to_bytes(16, 'little')
 
 
     def poly1305_key_gen(self, nonce):
@@ -226,10 +229,8 @@ class Chacha20Poly1305(Cipher):
         Encrypts and authenticates plaintext using nonce and data. Returns the
         ciphertext, consisting of the encrypted plaintext and tag concatenated.
         """
-        print("self.iv:", self.iv)
         nonce = self.get_nonce()
         nonce = make_array(nonce, 4, to_int=True)
-        print("nonce:", nonce)
 
         ciphertext, tag = self.chacha20_aead_encrypt(aad, plaintext, nonce)
         return ciphertext + tag
@@ -244,23 +245,21 @@ class Chacha20Poly1305(Cipher):
 
         # if len(self.nonce) != 12:
         #     raise ValueError("Nonce must be 96 bit long")
-        print("[+] ciphertext : ", ciphertext)
         if len(ciphertext) < 16:
             return None
 
-        print("self.iv:", self.iv)
         nonce = self.get_nonce()
         nonce = make_array(nonce, 4, to_int=True)
-        print("nonce:", nonce)
 
         expected_tag = ciphertext[-16:]
         ciphertext = ciphertext[:-16]
 
         otk = self.poly1305_key_gen(nonce)
-        mac_data = aad + self.pad16(aad)
-        mac_data += ciphertext + self.pad16(ciphertext)
-        mac_data += struct.pack("<Q", len(aad))
-        mac_data += struct.pack("<Q", len(ciphertext))
+        # aad と ciphertext は memoryview のこともあるので join でつなげる
+        mac_data = b''.join((aad, self.pad16(aad),
+                             ciphertext, self.pad16(ciphertext),
+                             struct.pack("<Q", len(aad)),
+                             struct.pack("<Q", len(ciphertext))))
         tag = self.poly1305_mac(mac_data, otk)
 
         if not self.ct_compare_digest(tag, expected_tag):
@@ -269,17 +268,16 @@ class Chacha20Poly1305(Cipher):
         return self.decrypt(ciphertext, nonce)
 
     def get_nonce(self):
-        print("seq_number:", self.seq_number)
         # res = self.iv
         iv = b''.join(map(lambda x: struct.pack("<I", x), self.iv))
 
         iv_len = len(iv)
         seq = long_to_bytes(self.seq_number)
         seq = seq.rjust(iv_len, b'\x00')
-        print('iv: ', iv.hex())
-        print('seq:', seq.hex())
         res = b''.join(map(lambda x: bytearray([x[0] ^ x[1]]), zip(iv, seq)))
-        print("res:", res.hex())
+        if _trace.debug:
+            _trace.log(DEBUG, "seq_number: %d, iv: %s, nonce: %s",
+                       self.seq_number, iv.hex(), res.hex())
 
         self.seq_number += 1
         return res
@@ -1,383 +1,118 @@
 
-import time
-import secrets
-from ..utils import connection, cryptomath, http_parser
+import argparse
+from ..utils import connection, http_parser
+from ..utils.antireplay import AntiReplayFilter
+from ..utils.psk import ExternalPsk, ExternalPskTable
+from ..utils.pipeline import DuplexPipeline
+from ..utils import ktls
+from ..utils.trace import tracer, ERROR, INFO, DEBUG
 from ..protocol import *
 from ..metastruct import *
+from .tlsconnection import ServerTLSConnection, HandshakeCompleted, \
+    DataReceived, EarlyDataReceived, TICKET_LIFETIME, MAX_EARLY_DATA_SIZE, \
+    RECORD_SIZE_LIMIT
 
-# Crypto
-from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, \
-    X25519PublicKey
-from ..encryption.ffdhe import FFDHE
-from ..encryption import Cipher
-
-
-# TODO: グローバル変数作るならこんな感じ
-class Global:
-    connect_side = "server"
-    current_mode = ContentType.handshake
+_trace = tracer.category('handshake')
 
 
 class TLSServer:
-    def __init__(self, server_conn):
+    """
+    ServerTLSConnection のハンドシェイクを server_conn のソケットで進め，
+    その後のアプリケーションデータを server_conn で送受信する．
+    """
+    def __init__(self, server_conn, ticket_key_ring=None, anti_replay=None,
+                 max_early_data_size=MAX_EARLY_DATA_SIZE, external_psks=None,
+                 pack_handshake=False, record_size_limit=RECORD_SIZE_LIMIT,
+                 dynamic_record_size=True, key_update_policy=None,
+                 pipeline=False, kernel_tls=False):
         self.server_conn = server_conn
+        if key_update_policy is not None:
+            server_conn.state.key_update_policy = key_update_policy
+        # 複数の接続でセッション再開できるように ticket_key_ring と anti_replay は
+        # server_cmd で作ったものを共有する．
+        # ハンドシェイクで決まった鍵は server_conn.state に入るので，
+        # その後は server_conn でそのまま送受信できる
+        self.tls = ServerTLSConnection(
+            ticket_key_ring=ticket_key_ring or TicketKeyRing(),
+            anti_replay=anti_replay or AntiReplayFilter(),
+            max_early_data_size=max_early_data_size,
+            external_psks=external_psks or ExternalPskTable(),
+            pack_handshake=pack_handshake,
+            record_size_limit=record_size_limit,
+            dynamic_record_size=dynamic_record_size,
+            state=server_conn.state)
+
+        # client Finished の後に届いたレコードは server_conn の受信バッファに残る
+        self.early_data = b''
+        for event in server_conn.drive(self.tls, HandshakeCompleted):
+            if isinstance(event, (EarlyDataReceived, DataReceived)):
+                self.early_data += event.data
+        if self.tls.record_size_limit_negotiated:
+            server_conn.set_record_size_limit(record_size_limit)
+        self.record_sizer = self.tls.record_sizer
+
+        # ハンドシェイクの後のレコードの暗号化・復号をカーネルに任せる．
+        # カーネルが対応していなければユーザ空間で続ける
+        if kernel_tls:
+            tx, rx = ktls.offload(server_conn)
+            _trace.log(INFO, "kTLS: tx=%s, rx=%s", tx, rx)
+
+        # ハンドシェイクの後の暗号化・復号を別のスレッドで行う
+        self.pipeline = None
+        if pipeline:
+            self.pipeline = DuplexPipeline(server_conn, self.tls, self.make_writer())
 
-        messages = bytearray(0)
-
-        # <<< ClientHello <<<
-        data = server_conn.recv_msg()
-        recved_clienthello = TLSPlaintext.from_bytes(data)
-        # TLSPlaintext.fragment のバイト列を得るために
-        # len(ContentType + ProtocolVersion + length) == 5 より後ろのバイト列を取る
-        messages += data[5:]
-        print(recved_clienthello)
-
-        # >>> ServerHello >>>
-
-        # select params
-
-        client_session_id = recved_clienthello.legacy_session_id
-        client_cipher_suites = recved_clienthello.cipher_suites
-        client_key_share_groups = recved_clienthello \
-            .get_extension(ExtensionType.key_share) \
-            .get_groups()
-        client_signature_scheme_list = recved_clienthello \
-            .get_extension(ExtensionType.signature_algorithms) \
-            .supported_signature_algorithms
-        client_key_share = recved_clienthello.get_extension(ExtensionType.key_share)
-
-        # パラメータの決定と shared_key の作成
-        # 暗号化：受け取ったClientHelloの暗号スイートから選ぶ
-        if CipherSuite.TLS_CHACHA20_POLY1305_SHA256 in client_cipher_suites:
-            cipher_suite = CipherSuite.TLS_CHACHA20_POLY1305_SHA256
-        else:
-            raise NotImplementedError()
-
-        # 鍵共有：ClientHelloのKeyShareEntryを見てどの方法で鍵共有するか決めてから、
-        # パラメータ（group, key_exchange）を決める
-        if NamedGroup.ffdhe2048 in client_key_share_groups:
-            server_share_group = NamedGroup.ffdhe2048
-            client_key_exchange = client_key_share.get_key_exchange(server_share_group)
-            ffdhe2048 = FFDHE(server_share_group)
-            server_key_share_key_exchange = ffdhe2048.gen_public_key()
-            shared_key = ffdhe2048.gen_shared_key(client_key_exchange)
-        elif NamedGroup.x25519 in client_key_share_groups:
-            server_share_group = NamedGroup.x25519
-            client_key_exchange = client_key_share.get_key_exchange(server_share_group)
-            x25519 = X25519PrivateKey.generate()
-            server_key_share_key_exchange = x25519.public_key().public_bytes()
-            shared_key = \
-                x25519.exchange(X25519PublicKey.from_public_bytes(client_key_exchange))
-        else:
-            raise NotImplementedError()
-
-        print("shared_key: %s" % hexstr(shared_key))
-
-        selected_version = ProtocolVersion.TLS13
-
-        serverhello = TLSPlaintext(
-            type=ContentType.handshake,
-            fragment=Handshake(
-                msg_type=HandshakeType.server_hello,
-                msg=ServerHello(
-                    legacy_session_id_echo=client_session_id,
-                    cipher_suite=cipher_suite,
-                    extensions=[
-                        # supported_versions
-                        Extension(
-                            extension_type=ExtensionType.supported_versions,
-                            extension_data=SupportedVersions(
-                                msg_type=HandshakeType.server_hello,
-                                selected_version=selected_version )),
-
-                        # key_share
-                        Extension(
-                            extension_type=ExtensionType.key_share,
-                            extension_data=KeyShareServerHello(
-                                server_share=KeyShareEntry(
-                                    group=server_share_group,
-                                    key_exchange=server_key_share_key_exchange ))),
-                    ] )))
-
-        # ServerHello が入っている TLSPlaintext
-        print(serverhello)
-        server_conn.send_msg(serverhello.to_bytes())
-        messages += serverhello.fragment.to_bytes()
-
-        # -- HKDF ---
-
-        hash_algo   = CipherSuite.get_hash_algo_name(cipher_suite)
-        secret_size = CipherSuite.get_hash_algo_size(cipher_suite)
-        secret = bytearray(secret_size)
-        psk    = bytearray(secret_size)
-
-        # print("messages = ")
-        # print(hexdump(messages))
-        print("messages hash = " + cryptomath.secureHash(messages, 'sha256').hex())
-        print()
-
-        # early secret
-        secret = cryptomath.HKDF_extract(secret, psk, hash_algo)
-        print('early secret =', secret.hex())
-        # handshake secret
-        secret = cryptomath.derive_secret(secret, b"derived", b"")
-        print('derive_secret =', secret.hex())
-        secret = cryptomath.HKDF_extract(secret, shared_key, hash_algo)
-        print('handshake secret =', secret.hex())
-        client_handshake_traffic_secret = \
-            cryptomath.derive_secret(secret, b"c hs traffic", messages)
-        print('client_handshake_traffic_secret =', client_handshake_traffic_secret.hex())
-        server_handshake_traffic_secret = \
-            cryptomath.derive_secret(secret, b"s hs traffic", messages)
-        print('server_handshake_traffic_secret =', server_handshake_traffic_secret.hex())
-        # master secret
-        secret = cryptomath.derive_secret(secret, b"derived", b"")
-        print('derive_secret =', secret.hex())
-        secret = cryptomath.HKDF_extract(secret, bytearray(secret_size), hash_algo)
-        print('master secret =', secret.hex())
-        client_application_traffic_secret = \
-            cryptomath.derive_secret(secret, b"c ap traffic", messages)
-        server_application_traffic_secret = \
-            cryptomath.derive_secret(secret, b"s ap traffic", messages)
-        print('client_application_traffic_secret =', client_application_traffic_secret.hex())
-        print('server_application_traffic_secret =', server_application_traffic_secret.hex())
-
-        if cipher_suite == CipherSuite.TLS_CHACHA20_POLY1305_SHA256:
-            cipher_class = Cipher.Chacha20Poly1305
-            key_size     = Cipher.Chacha20Poly1305.key_size
-            nonce_size   = Cipher.Chacha20Poly1305.nonce_size
-        else:
-            raise NotImplementedError()
-
-        server_write_key, server_write_iv = \
-            cryptomath.gen_key_and_iv(server_handshake_traffic_secret,
-                                      key_size, nonce_size, hash_algo)
-        s_traffic_crypto = cipher_class(key=server_write_key, nonce=server_write_iv)
-
-        client_write_key, client_write_iv = \
-            cryptomath.gen_key_and_iv(client_handshake_traffic_secret,
-                                      key_size, nonce_size, hash_algo)
-        c_traffic_crypto = cipher_class(key=client_write_key, nonce=client_write_iv)
-
-        print('server_write_key =', server_write_key.hex())
-        print('server_write_iv =', server_write_iv.hex())
-        print('client_write_key =', client_write_key.hex())
-        print('client_write_iv =', client_write_iv.hex())
-
-        # >>> EncryptedExtensions >>>
-
-        encrypted_extensions = TLSPlaintext(
-            type=ContentType.handshake,
-            fragment=Handshake(
-                msg_type=HandshakeType.encrypted_extensions,
-                msg=EncryptedExtensions(extensions=[]) ))
-
-        print(encrypted_extensions)
-        print(hexdump(encrypted_extensions.to_bytes()))
-        encrypted_extensions_cipher = \
-            TLSCiphertext.create(encrypted_extensions, crypto=s_traffic_crypto)
-        print(encrypted_extensions_cipher)
-        print(hexdump(encrypted_extensions_cipher.to_bytes()))
-        server_conn.send_msg(encrypted_extensions_cipher.to_bytes())
-        messages += encrypted_extensions.fragment.to_bytes()
-
-        # >>> server Certificate >>>
-
-        with open('.ssh/server.crt', 'r') as f:
-            import ssl
-            bytes_DER_encoded = ssl.PEM_cert_to_DER_cert(f.read())
-            cert_data = bytes_DER_encoded
-
-        certificate = TLSPlaintext(
-            type=ContentType.handshake,
-            fragment=Handshake(
-                msg_type=HandshakeType.certificate,
-                msg=Certificate(
-                    certificate_request_context=b'',
-                    certificate_list=[
-                        CertificateEntry(cert_data=cert_data)
-                    ])))
-
-        print("=== Certificate ===")
-        print(certificate)
-        print(hexdump(certificate.to_bytes()))
-        certificate_cipher = TLSCiphertext.create(certificate, crypto=s_traffic_crypto)
-        print(hexdump(certificate_cipher.to_bytes()))
-        server_conn.send_msg(certificate_cipher.to_bytes())
-        messages += certificate.fragment.to_bytes()
-
-        # >>> CertificateVerify >>>
-
-        # デジタル署名アルゴリズム
-        # 秘密鍵 .ssh/server.key を使って署名する
-        from Crypto.Hash import SHA256
-        from Crypto.PublicKey import RSA
-        key = RSA.importKey(open('.ssh/server.key').read())
-        if SignatureScheme.rsa_pss_pss_sha256 in client_signature_scheme_list:
-            server_signature_scheme = SignatureScheme.rsa_pss_pss_sha256
-            from Crypto.Signature import PKCS1_PSS
-            message = b'\x20' * 64 + b'TLS 1.3, server CertificateVerify' + b'\x00' + cryptomath.transcript_hash(messages, hash_algo)
-            print("message:")
-            print(hexdump(message))
-            h = SHA256.new(message)
-            certificate_signature = PKCS1_PSS.new(key).sign(h)
+    def recv(self):
+        # 0-RTT で受け取った early data があれば先に返す
+        if len(self.early_data) > 0:
+            data, self.early_data = self.early_data, b''
+            _trace.log(INFO, "[recv] early data")
+            _trace.log(DEBUG, "%s", data)
+            return data
+
+        # 受信したレコードは self.tls が処理する（KeyUpdate を受け取ったら鍵を更新する）
+        if self.pipeline is not None:
+            data = self.pipeline.recv()
         else:
-            raise NotImplementedError()
-
-        cert_verify = TLSPlaintext(
-            type=ContentType.handshake,
-            fragment=Handshake(
-                msg_type=HandshakeType.certificate_verify,
-                msg=CertificateVerify(
-                    algorithm=server_signature_scheme,
-                    signature=certificate_signature )))
-
-        print("=== CertificateVerify ===")
-        print(cert_verify)
-        # server_conn.send_msg(cert_verify.to_bytes())
-        cert_verify_cipher = TLSCiphertext.create(cert_verify, crypto=s_traffic_crypto)
-        server_conn.send_msg(cert_verify_cipher.to_bytes())
-        # messages.append(cert_verify.fragment)
-        messages += cert_verify.fragment.to_bytes()
-
-        # >>> Finished >>>
-
-        # server_handshake_traffic_secret を使って finished_key を作成する
-        hash_algo = CipherSuite.get_hash_algo_name(cipher_suite)
-        hash_size = CipherSuite.get_hash_algo_size(cipher_suite)
-        Hash.set_size(hash_size)
-        finished_key = cryptomath.HKDF_expand_label(
-            server_handshake_traffic_secret, b'finished', b'', hash_size, hash_algo)
-        verify_data = cryptomath.secureHMAC(
-            finished_key, cryptomath.transcript_hash(messages, hash_algo), hash_algo)
-        finished = TLSPlaintext(
-            type=ContentType.handshake,
-            fragment=Handshake(
-                msg_type=HandshakeType.finished,
-                msg=Finished(verify_data=verify_data) ))
-
-        print("=== Finished ===")
-        print(finished)
-        print(hexdump(finished.to_bytes()))
-        finished_cipher = TLSCiphertext.create(finished, crypto=s_traffic_crypto)
-        server_conn.send_msg(finished_cipher.to_bytes())
-        messages += finished.fragment.to_bytes()
-
-        # print(hexdump(messages))
-        client_application_traffic_secret = \
-            cryptomath.derive_secret(secret, b"c ap traffic", messages)
-        server_application_traffic_secret = \
-            cryptomath.derive_secret(secret, b"s ap traffic", messages)
-
-        server_app_write_key, server_app_write_iv = \
-            cryptomath.gen_key_and_iv(server_application_traffic_secret,
-                    key_size, nonce_size, hash_algo)
-        server_app_data_crypto = cipher_class(
-                key=server_app_write_key, nonce=server_app_write_iv)
-        client_app_write_key, client_app_write_iv = \
-            cryptomath.gen_key_and_iv(client_application_traffic_secret,
-                    key_size, nonce_size, hash_algo)
-        client_app_data_crypto = cipher_class(
-                key=client_app_write_key, nonce=client_app_write_iv)
-
-        self.server_app_data_crypto = server_app_data_crypto
-        self.client_app_data_crypto = client_app_data_crypto
-
-        print('client_application_traffic_secret =', client_application_traffic_secret.hex())
-        print('server_application_traffic_secret =', server_application_traffic_secret.hex())
-        print('server_app_write_key =', server_app_write_key.hex())
-        print('server_app_write_iv =', server_app_write_iv.hex())
-
-        print('client_app_write_key =', client_app_write_key.hex())
-        print('client_app_write_iv =', client_app_write_iv.hex())
-
-        # import sys
-        # sys.exit(0)
-
-        # <<< recv Finished <<<
-        print("=== recv Finished ===")
-        hash_size = CipherSuite.get_hash_algo_size(cipher_suite)
-        data = server_conn.recv_msg()
-        print(hexdump(data))
-        if len(data) == 7: # Alertのとき
-            print(TLSPlaintext.from_bytes(data))
-            raise RuntimeError("Alert!")
-        # TODO: 複数のメッセージ（例えば ChangeCipherSpec + Finished）が
-        #       同時に送られて来たときの処理が必要
-        if data[6:] == b'\x14\x03\x03\x00\x01\x01':
-            print("remove: change cipher spec")
-            trimed_data = data[6:] # change cipher spec (14 03 03 00 01 01) を取り除く
+            data = self.server_conn.recv_app_data(self.tls)
+        if len(data) == 0:
+            raise ConnectionError("connection closed")
+        _trace.log(INFO, "[recv] app_data")
+        if _trace.debug:
+            _trace.log(DEBUG, "%s", hexdump(data))
+
+        return data
+
+    def send(self, data):
+        """
+        data（bytes，bytes のイテラブル，ファイルオブジェクト）を 2^14 byte 以下の
+        レコードに分けて送信し，送信したバイト数を返す．
+        """
+        if self.pipeline is not None:
+            written = self.pipeline.send(data)
         else:
-            trimed_data = data
-        print(hexdump(trimed_data))
-
-        # # recved_finished = TLSPlaintext.from_bytes(data)
-        # Cipher.Cipher.seq_number = 0
-        # recved_finished = TLSCiphertext.restore(trimed_data, crypto=c_traffic_crypto)
-        # # messages.append(recved_finished.fragment)
-        # messages += recved_finished.fragment.to_bytes()
-        # print(recved_finished)
-        # assert isinstance(recved_finished.fragment.msg, Finished)
-        recved_finished = TLSRawtext.from_bytes(trimed_data)
-        print(recved_finished)
-
-        from ..protocol.ticket import NewSessionTicket
-        # dummy
-        new_session_ticket = TLSPlaintext(
-            type=ContentType.handshake,
-            fragment=Handshake(
-                msg_type=HandshakeType.new_session_ticket,
-                msg=NewSessionTicket(
-                    ticket_lifetime=Uint32(0),
-                    ticket_age_add=Uint32(0),
-                    ticket_nonce=b'nonce',
-                    ticket=b'foobar',
-                    extensions=[] )))
-
-        Cipher.Cipher.seq_number = 0
-
-        print("=== NewSessionTicket ===")
-        print(new_session_ticket)
-        new_session_ticket_cipher = TLSCiphertext.create(
-                new_session_ticket, crypto=server_app_data_crypto)
-        server_conn.send_msg(new_session_ticket_cipher.to_bytes())
-        # messages += new_session_ticket.fragment.to_bytes()
-
-
-    def recv(self):
-        while True:
-            data = self.server_conn.recv_msg()
-            if len(data) != 0:
-                break
-            time.sleep(0.5)
-
-        print("* [recv] raw")
-        print(hexdump(data))
-        recved_app_data = TLSCiphertext.restore(data,
-                crypto=self.client_app_data_crypto,
-                mode=ContentType.application_data)
-        print("* [recv] app_data")
-        print(recved_app_data)
-        print(str(recved_app_data.raw))
-
-        return recved_app_data.raw
-
-    def send(self, send_bytes):
-        app_data = TLSPlaintext(
-            type=ContentType.application_data,
-            fragment=Data(send_bytes))
-        app_data_cipher = TLSCiphertext.create(app_data,
-            crypto=self.server_app_data_crypto)
-        self.server_conn.send_msg(app_data_cipher.to_bytes())
-        print("* [send]")
-        print(hexdump(app_data_cipher.to_bytes()))
-
-        return len(app_data_cipher)
+            written = self.make_writer().write(data)
+        _trace.log(INFO, "[send] %d bytes", written)
+        return written
+
+    def make_writer(self):
+        state = self.server_conn.state
+        return RecordWriter(self.server_conn, None, state=state,
+                            max_fragment_size=state.max_fragment_size,
+                            sizer=self.record_sizer)
+
+    def close(self):
+        """
+        パイプラインで送信待ちのデータを送り終えてから接続を閉じる．
+        """
+        try:
+            if self.pipeline is not None:
+                self.pipeline.close()
+        finally:
+            self.server_conn.close()
 
 
 def server_cmd(argv):
-    print("server_cmd({})".format(", ".join(argv)))
-
     # from http.server import HTTPServer, SimpleHTTPRequestHandler
     # http_server = HTTPServer(('localhost', 50007), SimpleHTTPRequestHandler)
     #
@@ -389,29 +124,106 @@ def server_cmd(argv):
     # http_server.socket = wrap_socket(http_server.sock)
     # http_server.serve_forever()
 
-    server_conn = connection.ServerConnection()
-    server = TLSServer(server_conn)
-
-    # while True:
+    parser = argparse.ArgumentParser(prog='main.py server')
+    parser.add_argument('-n', '--connections', type=int, default=1,
+                        help='number of connections to accept')
+    parser.add_argument('--ticket-key-file', default=None,
+                        help='file to share session ticket keys between '
+                             'processes and restarts')
+    parser.add_argument('--psk', action='append', default=[],
+                        metavar='IDENTITY:HEXKEY[:HASH]',
+                        help='accept an external PSK (can be repeated)')
+    parser.add_argument('--psk-file', default=None,
+                        help='file with one IDENTITY:HEXKEY[:HASH] per line')
+    parser.add_argument('--pack-handshake', action='store_true',
+                        help='pack the encrypted handshake messages of a flight '
+                             'into as few records as possible')
+    parser.add_argument('--record-size-limit', type=int,
+                        default=RECORD_SIZE_LIMIT,
+                        help='largest protected record the server accepts, '
+                             'advertised with record_size_limit '
+                             '(default: %(default)s)')
+    parser.add_argument('--no-dynamic-record-size', action='store_true',
+                        help='always send records of the maximum size')
+    parser.add_argument('--key-update-records', type=int,
+                        default=KeyUpdatePolicy.max_records,
+                        help='send KeyUpdate after this many records with the '
+                             'same keys (default: %(default)s)')
+    parser.add_argument('--key-update-bytes', type=int, default=None,
+                        help='send KeyUpdate after this many bytes of '
+                             'application data with the same keys')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='encrypt and decrypt application data in '
+                             'separate threads')
+    parser.add_argument('--ktls', action='store_true',
+                        help='hand the application traffic keys to the Linux '
+                             'kernel (kTLS) when it supports them')
+    parser.add_argument('--trace', default='info', metavar='SPEC',
+                        help='trace levels, e.g. "debug" or '
+                             '"info,record=debug,secret=debug" '
+                             '(default: %(default)s)')
+    parser.add_argument('--trace-file', default=None,
+                        help='write the trace to this file instead of stderr')
+    args = parser.parse_args(argv)
+    tracer.setup(args.trace, args.trace_file)
+    _trace.log(INFO, "server_cmd(%s)", ", ".join(argv))
+    if args.record_size_limit < RecordSizeLimit.min_limit:
+        parser.error('--record-size-limit must be at least %d' %
+                     RecordSizeLimit.min_limit)
+
+    # 外部 PSK の表
+    if args.psk_file is not None:
+        external_psks = ExternalPskTable.load(args.psk_file)
+    else:
+        external_psks = ExternalPskTable()
+    for spec in args.psk:
+        external_psks.add(ExternalPsk.from_string(spec))
+
+    # チケットの鍵と anti-replay の記録は接続をまたいで共有する
+    ticket_key_ring = TicketKeyRing(path=args.ticket_key_file,
+                                    rotation_interval=TICKET_LIFETIME // 2)
+    anti_replay = AntiReplayFilter()
+    key_update_policy = KeyUpdatePolicy(max_records=args.key_update_records,
+                                        max_bytes=args.key_update_bytes)
+
+    listen_sock = None
+    for _ in range(args.connections):
+        server_conn = connection.ServerConnection(sock=listen_sock)
+        listen_sock = server_conn.sock
+        server = TLSServer(server_conn,
+                           ticket_key_ring=ticket_key_ring,
+                           anti_replay=anti_replay,
+                           external_psks=external_psks,
+                           pack_handshake=args.pack_handshake,
+                           record_size_limit=args.record_size_limit,
+                           dynamic_record_size=not args.no_dynamic_record_size,
+                           key_update_policy=key_update_policy,
+                           pipeline=args.pipeline,
+                           kernel_tls=args.ktls)
+        handle_request(server)
+        server.close()
+        print("[metrics]", server_conn.stats)
+
+
+def handle_request(server):
     data = server.recv()
 
     try:
         params = http_parser.parse(data.decode())
         filename = params['request_url']
-        print("filename:", filename)
+        _trace.log(INFO, "filename: %s", filename)
     except Exception as e:
-        print("[-] invalid request")
-        print(e)
+        _trace.log(ERROR, "invalid request: %s", e)
         data = b'HTTP/1.1 404 Not Found\r\n\r\n'
         server.send(data)
         return
 
     try:
         # TODO: insecure!
-        with open(filename, 'r') as f:
-            data = f.read().encode()
-    except FileNotFoundError as e:
-        print("[-] file not found: %s" % filename)
+        # ファイルは全体を読み込まずに少しずつ暗号化して送る
+        with open(filename, 'rb') as f:
+            server.send(f)
+    except FileNotFoundError:
+        _trace.log(ERROR, "file not found: %s", filename)
         data = b'HTTP/1.1 404 Not Found\r\n\r\n'
-
-    server.send(data)
+        server.send(data)
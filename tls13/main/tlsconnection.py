@@ -0,0 +1,1227 @@
+
+# ソケットを持たない TLS 1.3 の接続（sans-I/O）
+#
+# ハンドシェイクとレコード層の処理を，受信したバイト列を入れてイベントを受け取り，
+# 送るバイト列を取り出すだけの状態機械にする．ソケットの読み書きは呼び出す側が行うので，
+# 同じコードをソケット，テストのメモリ上の接続，イベントループのどれからでも使える．
+#
+#     tls = ClientTLSConnection()
+#     tls.start_handshake()
+#     sock.sendall(tls.data_to_send())
+#     while True:
+#         events = tls.receive_data(sock.recv(4096))
+#         sock.sendall(tls.data_to_send())
+#         ...
+#
+# receive_data にはレコードの途中で切れたバイト列を渡してもよい．
+# ソケットで動かすときは utils.connection.Connection.drive を使う．
+
+__all__ = [
+    'TLSConnection', 'ClientTLSConnection', 'ServerTLSConnection',
+    'HandshakeCompleted', 'DataReceived', 'EarlyDataReceived',
+    'SessionTicketReceived', 'ConnectionClosed', 'get_cipher_params',
+]
+
+import secrets
+import ssl
+from ..utils import cryptomath
+from ..utils.antireplay import AntiReplayFilter
+from ..utils.psk import ExternalPskTable
+from ..utils.trace import tracer, ERROR, INFO, DEBUG
+from ..protocol import *
+from ..metastruct import *
+
+# Crypto
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, \
+    X25519PublicKey
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+from ..encryption.ffdhe import FFDHE
+from ..encryption import Cipher
+
+_trace = tracer.category('handshake')
+# 鍵や secret の値
+_secret = tracer.category('secret')
+
+
+# NewSessionTicket で発行するチケットの有効期限 [sec]
+TICKET_LIFETIME = 7200
+# 0-RTT で受け取る early data の最大バイト数
+MAX_EARLY_DATA_SIZE = 2**14
+# record_size_limit で広告する受信できるレコードの大きさ
+RECORD_SIZE_LIMIT = RecordSizeLimit.max_limit
+# サーバの証明書と秘密鍵
+CERTIFICATE_FILE = '.ssh/server.crt'
+PRIVATE_KEY_FILE = '.ssh/server.key'
+
+
+class Event:
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, ", ".join(
+            "%s=%r" % item for item in vars(self).items()))
+
+
+class HandshakeCompleted(Event):
+    """
+    ハンドシェイクが終わった．psk_accepted は PSK（チケットか外部 PSK）で
+    認証したか，early_data_accepted は 0-RTT の early data を受け入れたか．
+    """
+    def __init__(self, cipher_suite, psk_accepted=False, early_data_accepted=False):
+        self.cipher_suite = cipher_suite
+        self.psk_accepted = psk_accepted
+        self.early_data_accepted = early_data_accepted
+
+
+class DataReceived(Event):
+    """
+    ハンドシェイクの後のアプリケーションデータを1レコード分受け取った．
+    """
+    def __init__(self, data):
+        self.data = data
+
+
+class EarlyDataReceived(Event):
+    """
+    サーバが 0-RTT の early data を1レコード分受け取った．
+    """
+    def __init__(self, data):
+        self.data = data
+
+
+class SessionTicketReceived(Event):
+    """
+    クライアントが NewSessionTicket を受け取った．session は次の接続で使う SessionTicket．
+    """
+    def __init__(self, session):
+        self.session = session
+
+
+class ConnectionClosed(Event):
+    """
+    相手から close_notify を受け取った．
+    """
+
+
+class _SendBuffer:
+    # HandshakeFlight と RecordWriter が送るレコードを溜めておく（Connection の代わり）
+    def __init__(self):
+        self.data = bytearray()
+
+    def send_buffers(self, buffers):
+        for buffer in buffers:
+            self.data += buffer
+
+
+class TLSConnection:
+    """
+    1つの TLS 接続のハンドシェイクとレコード層の状態機械．
+    ClientTLSConnection と ServerTLSConnection で使う．
+
+    state にソケットの接続（utils.connection.Connection）の ConnectionState を渡すと，
+    ハンドシェイクで決まった鍵とシーケンス番号をその接続でもそのまま使える．
+    """
+    def __init__(self, side, state=None, record_size_limit=RECORD_SIZE_LIMIT):
+        self.state = state or ConnectionState(side)
+        self.framer = RecordFramer()
+        self.handshake = HandshakeReassembler()
+        # 自分が広告する record_size_limit と，相手も広告して受信に適用したか
+        self.record_size_limit = record_size_limit
+        self.record_size_limit_negotiated = False
+        self.record_sizer = None
+        self.handshake_complete = False
+        self.closed = False
+        self.resumption_master_secret = None
+        # Transcript-Hash を計算するハンドシェイクメッセージ
+        self.messages = bytearray(0)
+        self._outgoing = _SendBuffer()
+        self._events = []
+        # 次に受け取るハンドシェイクメッセージの種類と，それを処理するメソッド
+        self._expected = None
+
+    @classmethod
+    def established(cls, state):
+        """
+        鍵とシーケンス番号が入った state（ハンドシェイクを済ませた ConnectionState）で，
+        ハンドシェイクが終わった状態の接続を作る．
+        """
+        tls = cls(state.side, state=state)
+        tls.handshake_complete = True
+        return tls
+
+    def data_to_send(self) -> bytes:
+        """
+        相手に送るバイト列を返す．返した分は送信待ちから取り除く．
+        """
+        data = bytes(self._outgoing.data)
+        self._outgoing.data = bytearray()
+        return data
+
+    def receive_data(self, data) -> list:
+        """
+        相手から受信したバイト列を処理して，起きたイベントのリストを返す．
+        完全なレコードになっていない残りは次に受信したバイト列とつなげて処理する．
+        """
+        self.framer.feed(data)
+        events = self._events = []
+        for record in self.framer:
+            self._receive_record(record)
+        return events
+
+    def receive_record(self, record) -> list:
+        """
+        完全なレコードを1つ処理して，起きたイベントのリストを返す．
+        ソケットで受信してレコードを切り出した後（Connection.recv_events）に使い，
+        receive_data にレコードの途中までを渡した後には使わない．
+        """
+        events = self._events = []
+        self._receive_record(record)
+        return events
+
+    def receive_content(self, type, content) -> list:
+        """
+        kTLS でカーネルが復号したレコードの (ContentType, content) を処理して，
+        起きたイベントのリストを返す．
+        """
+        events = self._events = []
+        if type != ContentType.change_cipher_spec:
+            self._receive_content(type, content)
+        return events
+
+    def send_data(self, data) -> int:
+        """
+        data（bytes，bytes のイテラブル，ファイルオブジェクト）をアプリケーションデータの
+        レコードにして送信待ちに入れ，そのバイト数を返す．
+        """
+        if not self.handshake_complete:
+            raise RuntimeError("handshake is not complete")
+        state = self.state
+        writer = RecordWriter(self._outgoing, None, state=state,
+                              max_fragment_size=state.max_fragment_size,
+                              sizer=self.record_sizer)
+        return writer.write(data)
+
+    def send_key_update(self, request_update=False):
+        """
+        KeyUpdate を送信待ちに入れて送信の鍵を次の世代にする．
+        """
+        if not self.handshake_complete:
+            raise RuntimeError("handshake is not complete")
+        self._outgoing.data += self.state.seal_key_update(request_update)
+        if _trace.info:
+            _trace.log(INFO, "KeyUpdate: write keys updated")
+
+    def close(self):
+        """
+        close_notify を送信待ちに入れる．
+        """
+        alert = Alert(level=AlertLevel.warning,
+                      description=AlertDescription.close_notify)
+        if self.state.write_crypto is not None:
+            self._outgoing.data += protect(alert.to_bytes(), self.state.write_crypto,
+                                           ContentType.alert)
+        else:
+            self._outgoing.data += TLSPlaintext(
+                type=ContentType.alert, fragment=alert).to_bytes()
+        self.closed = True
+
+    def _set_record_size_limit(self):
+        # 自分が広告した record_size_limit を超えるレコードを受信したら record_overflow
+        # AEAD による増加分は 255 byte まで (RFC 8449 5.2)
+        self.framer.max_fragment_size = \
+            min(self.record_size_limit, 2**14 + 1) + 255
+        self.record_size_limit_negotiated = True
+
+    def _receive_record(self, record):
+        type = Uint8(record[0])
+        # 互換モードの ChangeCipherSpec は読み捨てる
+        if type == ContentType.change_cipher_spec:
+            return
+        if type == ContentType.alert:
+            if _trace.error:
+                _trace.log(ERROR, "%s", TLSPlaintext.from_bytes(bytes(record)))
+            raise RuntimeError("Alert!")
+        if self.state.read_crypto is None:
+            content = record[5:]
+        else:
+            result = self._unprotect(record)
+            if result is None:
+                return
+            type, content = result
+        self._receive_content(type, content)
+
+    def _receive_content(self, type, content):
+        if type == ContentType.handshake:
+            self.handshake.feed(content)
+            while True:
+                message = self.handshake.next_message()
+                if message is None:
+                    break
+                self._receive_handshake(message)
+        elif type == ContentType.application_data:
+            self._receive_application_data(bytes(content))
+        elif type == ContentType.alert:
+            alert = Alert.from_bytes(bytes(content))
+            if alert.description != AlertDescription.close_notify:
+                if _trace.error:
+                    _trace.log(ERROR, "%s", alert)
+                raise RuntimeError("Alert!")
+            self.closed = True
+            self._events.append(ConnectionClosed())
+        else:
+            raise RuntimeError("unexpected_message: %s" % ContentType.label(type))
+
+    def _unprotect(self, record):
+        """
+        レコードを復号して (ContentType, content) を返す．
+        None を返したときはそのレコードを読み捨てる．
+        """
+        return unprotect(record, self.state.read_crypto)
+
+    def _receive_handshake(self, message):
+        if self.handshake_complete:
+            self._receive_post_handshake(message)
+            return
+        msg_type = Uint8(message[0])
+        if self._expected is None or msg_type != self._expected[0]:
+            raise RuntimeError("unexpected_message: %s" %
+                               HandshakeType.labels().get(msg_type, msg_type))
+        self._expected[1](message)
+
+    def _receive_post_handshake(self, message):
+        handshake = Handshake.from_bytes(message, self.state)
+        if handshake.msg_type != HandshakeType.key_update:
+            raise RuntimeError("unexpected_message: %s" %
+                               HandshakeType.label(handshake.msg_type))
+        # KeyUpdate の後のレコードは次の世代の鍵で送られてくる
+        self.state.update_read_crypto()
+        if _trace.info:
+            _trace.log(INFO, "KeyUpdate: read keys updated")
+        if handshake.msg.request_update == KeyUpdateRequest.update_requested:
+            # 次のアプリケーションデータを送るときに自分の鍵も更新する
+            self.state.key_update_requested = True
+
+    def _receive_application_data(self, data):
+        if not self.handshake_complete:
+            raise RuntimeError("unexpected_message: application_data")
+        self._events.append(DataReceived(data))
+
+    # -- 鍵スケジュール (7.1) ---
+
+    def _make_crypto(self, secret, cipher_suite=None):
+        cipher_suite = cipher_suite or self.state.cipher_suite
+        cipher_class, key_size, nonce_size = get_cipher_params(cipher_suite)
+        key, iv = cryptomath.gen_key_and_iv(
+            secret, key_size, nonce_size,
+            CipherSuite.get_hash_algo_name(cipher_suite))
+        if _secret.debug:
+            _secret.log(DEBUG, 'write_key = %s', key.hex())
+            _secret.log(DEBUG, 'write_iv = %s', iv.hex())
+        return cipher_class(key=key, nonce=iv)
+
+    def _derive_handshake_secrets(self, early_secret, shared_key):
+        """
+        ServerHello までのメッセージから handshake traffic secret と master secret を作る．
+        """
+        hash_algo = self.state.hash_algo
+        if _trace.debug:
+            _trace.log(DEBUG, "messages hash = %s",
+                       cryptomath.secureHash(self.messages, 'sha256').hex())
+        if _secret.debug:
+            _secret.log(DEBUG, "shared_key: %s", hexstr(shared_key))
+        secret = cryptomath.derive_secret(early_secret, b"derived", b"")
+        secret = cryptomath.HKDF_extract(secret, shared_key, hash_algo)
+        if _secret.debug:
+            _secret.log(DEBUG, 'handshake secret = %s', secret.hex())
+        self._client_handshake_traffic_secret = \
+            cryptomath.derive_secret(secret, b"c hs traffic", self.messages)
+        self._server_handshake_traffic_secret = \
+            cryptomath.derive_secret(secret, b"s hs traffic", self.messages)
+        if _secret.debug:
+            _secret.log(DEBUG, 'client_handshake_traffic_secret = %s',
+                        self._client_handshake_traffic_secret.hex())
+            _secret.log(DEBUG, 'server_handshake_traffic_secret = %s',
+                        self._server_handshake_traffic_secret.hex())
+        secret = cryptomath.derive_secret(secret, b"derived", b"")
+        self._master_secret = cryptomath.HKDF_extract(
+            secret, bytearray(self.state.hash_size), hash_algo)
+        if _secret.debug:
+            _secret.log(DEBUG, 'master secret = %s', self._master_secret.hex())
+
+    def _derive_application_secrets(self):
+        """
+        server Finished までのメッセージから
+        (client_application_traffic_secret, server_application_traffic_secret) を作る．
+        """
+        client_secret = cryptomath.derive_secret(
+            self._master_secret, b"c ap traffic", self.messages)
+        server_secret = cryptomath.derive_secret(
+            self._master_secret, b"s ap traffic", self.messages)
+        if _secret.debug:
+            _secret.log(DEBUG, 'client_application_traffic_secret = %s',
+                        client_secret.hex())
+            _secret.log(DEBUG, 'server_application_traffic_secret = %s',
+                        server_secret.hex())
+        return client_secret, server_secret
+
+    def _derive_resumption_master_secret(self):
+        # client Finished までのメッセージから作る
+        self.resumption_master_secret = cryptomath.derive_secret(
+            self._master_secret, b"res master", self.messages)
+        if _secret.debug:
+            _secret.log(DEBUG, 'resumption_master_secret = %s',
+                        self.resumption_master_secret.hex())
+
+    def _add_message(self, handshake) -> list:
+        """
+        送る handshake をトランスクリプトに加え，バッファのリスト（to_segments）で返す．
+        """
+        segments = handshake.to_segments()
+        for segment in segments:
+            self.messages += segment
+        return segments
+
+    def _make_finished(self, base_key) -> bytes:
+        verify_data = cryptomath.gen_verify_data(
+            base_key, self.messages, self.state.hash_algo)
+        finished = Handshake(
+            msg_type=HandshakeType.finished,
+            msg=Finished(verify_data=verify_data))
+        _trace.log(INFO, "=== Finished ===")
+        _trace.log(DEBUG, "%s", finished)
+        data = finished.to_bytes()
+        self.messages += data
+        return data
+
+    def _verify_finished(self, message, base_key):
+        _trace.log(INFO, "=== recv Finished ===")
+        finished = Handshake.from_bytes(message, self.state)
+        _trace.log(DEBUG, "%s", finished)
+        expected_verify_data = cryptomath.gen_verify_data(
+            base_key, self.messages, self.state.hash_algo)
+        if not Cipher.Cipher.ct_compare_digest(
+                finished.msg.verify_data, expected_verify_data):
+            raise RuntimeError("Finished: verify_data is not match!")
+        self.messages += message
+
+
+class ClientTLSConnection(TLSConnection):
+    """
+    クライアントの TLSConnection．session（SessionTicket）を与えるとセッションを
+    再開し，external_psk を与えると証明書の代わりに外部 PSK で認証する．
+    psk_ke_mode が psk_ke のときは外部 PSK で鍵共有もしない．
+
+    ハンドシェイクが終わると HandshakeCompleted を，その後に NewSessionTicket を
+    受け取ると SessionTicketReceived を返す．
+    """
+    cipher_suites = [
+        CipherSuite.TLS_CHACHA20_POLY1305_SHA256,
+    ]
+    supported_signature_algorithms = [
+        SignatureScheme.rsa_pss_pss_sha256,
+        SignatureScheme.rsa_pss_pss_sha384,
+        SignatureScheme.rsa_pss_pss_sha512,
+        SignatureScheme.rsa_pss_rsae_sha256,
+        SignatureScheme.rsa_pss_rsae_sha384,
+        SignatureScheme.rsa_pss_rsae_sha512,
+        SignatureScheme.ecdsa_secp256r1_sha256,
+        SignatureScheme.ecdsa_secp384r1_sha384,
+        SignatureScheme.ecdsa_secp512r1_sha512,
+        SignatureScheme.ed25519,
+        SignatureScheme.ed448,
+    ]
+
+    def __init__(self, session=None, external_psk=None,
+                 psk_ke_mode=PskKeyExchangeMode.psk_dhe_ke,
+                 record_size_limit=RECORD_SIZE_LIMIT, state=None):
+        super().__init__('client', state=state, record_size_limit=record_size_limit)
+        if external_psk is not None:
+            session = None
+        if session is not None and \
+           (session.is_expired() or session.cipher_suite not in self.cipher_suites):
+            session = None
+        self.session = session
+        self.external_psk = external_psk
+        self.psk_ke_mode = psk_ke_mode
+        self.psk_accepted = False
+        self.early_data_accepted = False
+        self._early_data_sent = False
+
+    def start_handshake(self, early_data=b''):
+        """
+        ClientHello を送信待ちに入れる．セッションを再開するときは early_data を
+        0-RTT で ClientHello の後に続けて送る．
+        """
+        session = self.session
+        external_psk = self.external_psk
+
+        # 外部 PSK のときはサーバの対応するグループが分かっているので x25519 だけを送る．
+        # psk_ke のときは鍵共有をしないので key_share を送らない
+        if external_psk is None:
+            named_group_list = [ NamedGroup.x25519, NamedGroup.ffdhe2048 ]
+            ke_modes = [ PskKeyExchangeMode.psk_dhe_ke ]
+        elif self.psk_ke_mode == PskKeyExchangeMode.psk_dhe_ke:
+            named_group_list = [ NamedGroup.x25519 ]
+            ke_modes = [ PskKeyExchangeMode.psk_dhe_ke ]
+        else:
+            named_group_list = []
+            ke_modes = [ PskKeyExchangeMode.psk_ke ]
+        self._ke_modes = ke_modes
+
+        client_shares = []
+        if NamedGroup.x25519 in named_group_list:
+            self._x25519 = X25519PrivateKey.generate()
+            client_shares.append(KeyShareEntry(
+                group=NamedGroup.x25519,
+                key_exchange=self._x25519.public_key().public_bytes(
+                    Encoding.Raw, PublicFormat.Raw)))
+        if NamedGroup.ffdhe2048 in named_group_list:
+            self._ffdhe2048 = FFDHE(NamedGroup.ffdhe2048)
+            client_shares.append(KeyShareEntry(
+                group=NamedGroup.ffdhe2048,
+                key_exchange=self._ffdhe2048.gen_public_key()))
+
+        send_early_data = session is not None and \
+            0 < len(early_data) <= session.max_early_data_size
+
+        # ClientHello で提案する PSK
+        if external_psk is not None:
+            psk_hash_algo = external_psk.hash_algo
+            psk_hash_size = external_psk.hash_size
+            psk_identity = PskIdentity(
+                identity=external_psk.identity,
+                obfuscated_ticket_age=Uint32(0))
+            self._psk_key = external_psk.key
+            # 外部 PSK の early secret と binder_key は計算済み
+            early_secret = external_psk.early_secret
+            binder_key = external_psk.binder_key
+        elif session is not None:
+            psk_hash_algo = CipherSuite.get_hash_algo_name(session.cipher_suite)
+            psk_hash_size = CipherSuite.get_hash_algo_size(session.cipher_suite)
+            psk_identity = PskIdentity(
+                identity=session.ticket,
+                obfuscated_ticket_age=session.get_obfuscated_ticket_age())
+            self._psk_key = session.psk
+            early_secret = cryptomath.HKDF_extract(
+                bytearray(psk_hash_size), self._psk_key, psk_hash_algo)
+            binder_key = cryptomath.gen_binder_key(early_secret, hash_algo=psk_hash_algo)
+        self._offer_psk = external_psk is not None or session is not None
+
+        # >>> ClientHello >>>
+
+        extensions = [
+            # supported_versions
+            Extension(
+                extension_type=ExtensionType.supported_versions,
+                extension_data=SupportedVersions(
+                    msg_type=HandshakeType.client_hello,
+                    versions=[ ProtocolVersion.TLS13,
+                               ProtocolVersion.TLS13_DRAFT26 ] )),
+
+            # signature_algorithms
+            Extension(
+                extension_type=ExtensionType.signature_algorithms,
+                extension_data=SignatureSchemeList(
+                    supported_signature_algorithms=
+                    self.supported_signature_algorithms)),
+
+            # record_size_limit
+            Extension(
+                extension_type=ExtensionType.record_size_limit,
+                extension_data=RecordSizeLimit(
+                    record_size_limit=Uint16(self.record_size_limit) )),
+        ]
+
+        if len(client_shares) > 0:
+            # supported_groups
+            extensions.append(Extension(
+                extension_type=ExtensionType.supported_groups,
+                extension_data=NamedGroupList(
+                    named_group_list=named_group_list )))
+
+            # key_share
+            extensions.append(Extension(
+                extension_type=ExtensionType.key_share,
+                extension_data=KeyShareClientHello(
+                    client_shares=client_shares )))
+
+        if self._offer_psk:
+            # psk_key_exchange_modes
+            extensions.append(Extension(
+                extension_type=ExtensionType.psk_key_exchange_modes,
+                extension_data=PskKeyExchangeModes(
+                    ke_modes=ke_modes )))
+
+            # early_data
+            if send_early_data:
+                extensions.append(Extension(
+                    extension_type=ExtensionType.early_data,
+                    extension_data=EarlyDataIndication(
+                        msg_type=HandshakeType.client_hello )))
+
+            # pre_shared_key（必ず最後の拡張にする）
+            # binder は ClientHello を作った後に計算するので，ここでは同じ長さの仮の値を入れておく
+            offered_psks = OfferedPsks(
+                identities=[ psk_identity ],
+                binders=[
+                    PskBinderEntry(binder=bytes(psk_hash_size)) ])
+            extensions.append(Extension(
+                extension_type=ExtensionType.pre_shared_key,
+                extension_data=PreSharedKeyExtension(
+                    msg_type=HandshakeType.client_hello,
+                    offered_psks=offered_psks )))
+
+        clienthello = Handshake(
+            msg_type=HandshakeType.client_hello,
+            msg=ClientHello(
+                cipher_suites=self.cipher_suites,
+                extensions=extensions ))
+
+        if self._offer_psk:
+            # binder は binders を取り除いた ClientHello から計算する
+            truncated_clienthello = clienthello.to_bytes() \
+                [:-offered_psks.get_binders_length()]
+            offered_psks.binders[0].binder = \
+                cryptomath.gen_binder(binder_key, truncated_clienthello, psk_hash_algo)
+
+        # ClientHello と early data は1つのフライトとしてまとめて送る
+        flight = HandshakeFlight(self._outgoing)
+        _trace.log(DEBUG, "%s", clienthello)
+        data = clienthello.to_bytes()
+        flight.add(data)
+        self.messages += data
+
+        # >>> early data >>>
+        if send_early_data:
+            _trace.log(INFO, "=== early data ===")
+            client_early_traffic_secret = \
+                cryptomath.derive_secret(early_secret, b"c e traffic", self.messages)
+            if _secret.debug:
+                _secret.log(DEBUG, 'client_early_traffic_secret = %s',
+                            client_early_traffic_secret.hex())
+            self._c_early_traffic_crypto = self._make_crypto(
+                client_early_traffic_secret, session.cipher_suite)
+            flight.add(early_data, crypto=self._c_early_traffic_crypto,
+                       type=ContentType.application_data)
+        flight.flush()
+        self._early_data_sent = send_early_data
+        self._expected = (HandshakeType.server_hello, self._receive_server_hello)
+
+    def _receive_server_hello(self, message):
+        # <<< ServerHello <<<
+        serverhello = Handshake.from_bytes(message).msg
+        self.messages += message
+        _trace.log(DEBUG, "%s", serverhello)
+
+        # psk_ke のときは key_share が無い
+        server_key_share = serverhello.get_extension(ExtensionType.key_share)
+
+        # サーバが PSK を選んだかどうか
+        server_pre_shared_key = serverhello.get_extension(ExtensionType.pre_shared_key)
+        self.psk_accepted = server_pre_shared_key is not None
+        if self.psk_accepted:
+            # 提案した PSK は1つだけなので selected_identity は 0 でなければならない
+            if not self._offer_psk or \
+               server_pre_shared_key.selected_identity != Uint16(0):
+                raise RuntimeError("illegal_parameter: selected_identity %s" %
+                                   server_pre_shared_key.selected_identity)
+            _trace.log(INFO, "PSK is accepted")
+        else:
+            self.session = None
+
+        # ネゴシエーションの結果は接続ごとの state に持つ
+        state = self.state
+        state.set_cipher_suite(serverhello.cipher_suite)
+        secret_size = state.hash_size
+
+        # shared_key の作成
+        if server_key_share is None:
+            if not self.psk_accepted or \
+               PskKeyExchangeMode.psk_ke not in self._ke_modes:
+                raise RuntimeError("missing_extension: key_share")
+            shared_key = bytearray(secret_size)
+        elif server_key_share.get_group() == NamedGroup.ffdhe2048:
+            shared_key = self._ffdhe2048.gen_shared_key(
+                server_key_share.get_key_exchange())
+        elif server_key_share.get_group() == NamedGroup.x25519:
+            shared_key = self._x25519.exchange(
+                X25519PublicKey.from_public_bytes(server_key_share.get_key_exchange()))
+        else:
+            raise NotImplementedError()
+
+        # -- HKDF ---
+        psk = self._psk_key if self.psk_accepted else bytearray(secret_size)
+        early_secret = cryptomath.HKDF_extract(
+            bytearray(secret_size), psk, state.hash_algo)
+        if _secret.debug:
+            _secret.log(DEBUG, 'early secret = %s', early_secret.hex())
+        self._derive_handshake_secrets(early_secret, shared_key)
+        self._c_traffic_crypto = self._make_crypto(self._client_handshake_traffic_secret)
+        state.set_crypto(
+            read_crypto=self._make_crypto(self._server_handshake_traffic_secret),
+            write_crypto=self._c_traffic_crypto)
+        self._expected = (HandshakeType.encrypted_extensions,
+                          self._receive_encrypted_extensions)
+
+    def _receive_encrypted_extensions(self, message):
+        # <<< EncryptedExtensions <<<
+        _trace.log(INFO, "=== EncryptedExtensions ===")
+        encrypted_extensions = Handshake.from_bytes(message).msg
+        self.messages += message
+        _trace.log(DEBUG, "%s", encrypted_extensions)
+        self.early_data_accepted = self._early_data_sent and \
+            encrypted_extensions.get_extension(ExtensionType.early_data) is not None
+        _trace.log(INFO, "early_data_accepted: %s", self.early_data_accepted)
+        server_record_size_limit = \
+            encrypted_extensions.get_extension(ExtensionType.record_size_limit)
+        if server_record_size_limit is not None:
+            self.state.max_fragment_size = \
+                server_record_size_limit.get_max_fragment_size()
+            self._set_record_size_limit()
+        _trace.log(INFO, "max_fragment_size: %s", self.state.max_fragment_size)
+
+        # PSK を使うときは証明書を受け取らない
+        if self.psk_accepted:
+            self._expected = (HandshakeType.finished, self._receive_finished)
+        else:
+            self._expected = (HandshakeType.certificate, self._receive_certificate)
+
+    def _receive_certificate(self, message):
+        # <<< server Certificate <<<
+        _trace.log(INFO, "=== server Certificate ===")
+        if _trace.debug:
+            _trace.log(DEBUG, "%s", hexdump(message))
+        _trace.log(DEBUG, "%s", Handshake.from_bytes(message))
+        self.messages += message
+        self._expected = (HandshakeType.certificate_verify,
+                          self._receive_certificate_verify)
+
+    def _receive_certificate_verify(self, message):
+        # <<< server CertificateVerify <<<
+        _trace.log(INFO, "=== CertificateVerify ===")
+        _trace.log(DEBUG, "%s", Handshake.from_bytes(message))
+        self.messages += message
+        self._expected = (HandshakeType.finished, self._receive_finished)
+
+    def _receive_finished(self, message):
+        # <<< recv Finished <<<
+        self._verify_finished(message, self._server_handshake_traffic_secret)
+        state = self.state
+        client_secret, server_secret = self._derive_application_secrets()
+        # サーバは Finished の後から application_traffic_secret で送ってくる
+        state.set_crypto(read_crypto=self._make_crypto(server_secret),
+                         read_secret=server_secret)
+
+        # EndOfEarlyData と Finished は1つのフライトとしてまとめて送る
+        flight = HandshakeFlight(self._outgoing, max_fragment_size=state.max_fragment_size)
+
+        # >>> EndOfEarlyData >>>
+        # early data を受け入れてもらえたときは early data の終わりを知らせる
+        if self.early_data_accepted:
+            end_of_early_data = Handshake(
+                msg_type=HandshakeType.end_of_early_data,
+                msg=EndOfEarlyData() )
+            _trace.log(DEBUG, "%s", end_of_early_data)
+            data = end_of_early_data.to_bytes()
+            flight.add(data, crypto=self._c_early_traffic_crypto)
+            self.messages += data
+
+        # >>> Finished >>>
+        # client_handshake_traffic_secret を使って finished_key を作成する
+        flight.add(self._make_finished(self._client_handshake_traffic_secret),
+                   crypto=self._c_traffic_crypto)
+        flight.flush()
+        # クライアントは Finished を送った後から application_traffic_secret で送る
+        state.set_crypto(write_crypto=self._make_crypto(client_secret),
+                         write_secret=client_secret)
+        self._derive_resumption_master_secret()
+
+        self.handshake_complete = True
+        self._expected = None
+        self._events.append(HandshakeCompleted(
+            state.cipher_suite, psk_accepted=self.psk_accepted,
+            early_data_accepted=self.early_data_accepted))
+
+    def _receive_post_handshake(self, message):
+        if Uint8(message[0]) != HandshakeType.new_session_ticket:
+            super()._receive_post_handshake(message)
+            return
+        # <<< recv NewSessionTicket <<<
+        _trace.log(INFO, "=== NewSessionTicket ===")
+        new_session_ticket = Handshake.from_bytes(message).msg
+        _trace.log(DEBUG, "%s", new_session_ticket)
+        session = SessionTicket.from_new_session_ticket(
+            new_session_ticket, self.resumption_master_secret,
+            self.state.cipher_suite)
+        self._events.append(SessionTicketReceived(session))
+
+
+class ServerTLSConnection(TLSConnection):
+    """
+    サーバの TLSConnection．複数の接続でセッション再開できるように，
+    ticket_key_ring と anti_replay は接続の間で共有するものを渡す．
+
+    early data を受け入れたときは EarlyDataReceived を返し，ハンドシェイクが
+    終わると NewSessionTicket を送信待ちに入れて HandshakeCompleted を返す．
+    """
+    def __init__(self, ticket_key_ring=None, anti_replay=None,
+                 max_early_data_size=MAX_EARLY_DATA_SIZE, external_psks=None,
+                 pack_handshake=False, record_size_limit=RECORD_SIZE_LIMIT,
+                 dynamic_record_size=True, certificate_file=CERTIFICATE_FILE,
+                 private_key_file=PRIVATE_KEY_FILE, state=None):
+        super().__init__('server', state=state, record_size_limit=record_size_limit)
+        self.ticket_key_ring = ticket_key_ring or TicketKeyRing()
+        self.anti_replay = anti_replay or AntiReplayFilter()
+        self.external_psks = external_psks or ExternalPskTable()
+        self.max_early_data_size = max_early_data_size
+        self.pack_handshake = pack_handshake
+        self.dynamic_record_size = dynamic_record_size
+        self.certificate_file = certificate_file
+        self.private_key_file = private_key_file
+        self.psk_accepted = False
+        self.early_data_accepted = False
+        # early data を受け取っている間（EndOfEarlyData まで）True
+        self._receiving_early_data = False
+        # early data を拒否して，復号できないレコードを読み捨てている間 True
+        self._skipping_early_data = False
+        self._early_data_size = 0
+        self._client_record_size_limit = None
+        self._expected = (HandshakeType.client_hello, self._receive_client_hello)
+
+    def _receive_client_hello(self, message):
+        # <<< ClientHello <<<
+        # ClientHello の後ろには 0-RTT の early data が続いていることがある
+        clienthello = Handshake.from_bytes(message).msg
+        self.messages += message
+        _trace.log(DEBUG, "%s", clienthello)
+
+        # >>> ServerHello >>>
+
+        # psk_ke モードのクライアントは key_share を送らないことがある
+        client_key_share = clienthello.get_extension(ExtensionType.key_share)
+        client_key_share_groups = \
+            client_key_share.get_groups() if client_key_share else []
+
+        # 暗号化：受け取ったClientHelloの暗号スイートから選ぶ
+        if CipherSuite.TLS_CHACHA20_POLY1305_SHA256 in clienthello.cipher_suites:
+            cipher_suite = CipherSuite.TLS_CHACHA20_POLY1305_SHA256
+        else:
+            raise NotImplementedError()
+
+        # ネゴシエーションの結果は接続ごとの state に持つ
+        state = self.state
+        state.set_cipher_suite(cipher_suite)
+        hash_algo   = state.hash_algo
+        secret_size = state.hash_size
+
+        can_use_dhe = NamedGroup.ffdhe2048 in client_key_share_groups or \
+                      NamedGroup.x25519 in client_key_share_groups
+
+        # PSK：ClientHello の pre_shared_key にある外部 PSK の identity かチケットを
+        # 探して binder を検証する
+        selected_identity, ticket_state, external_psk, use_dhe = \
+            self.select_psk(clienthello, message, cipher_suite, can_use_dhe)
+        self.psk_accepted = selected_identity is not None
+        # 鍵共有をしないのは psk_ke で PSK を受け入れたときだけ．
+        # HelloRetryRequest は送らないので，鍵共有ができなければ中断する
+        if not use_dhe and not self.psk_accepted:
+            if client_key_share is None:
+                raise RuntimeError("missing_extension: key_share")
+            raise RuntimeError("handshake_failure: no supported key_share group")
+        if external_psk is not None:
+            # 外部 PSK の early secret は計算済みのものを使う
+            early_secret = external_psk.early_secret
+            _trace.log(INFO, "external PSK: identity = %s", external_psk.identity)
+        elif ticket_state is not None:
+            early_secret = cryptomath.HKDF_extract(
+                bytearray(secret_size), ticket_state.psk, hash_algo)
+            _trace.log(INFO, "resumption: selected_identity = %s", selected_identity)
+        else:
+            early_secret = cryptomath.HKDF_extract(
+                bytearray(secret_size), bytearray(secret_size), hash_algo)
+        if _secret.debug:
+            _secret.log(DEBUG, 'early secret = %s', early_secret.hex())
+
+        # 鍵共有：ClientHelloのKeyShareEntryを見てどの方法で鍵共有するか決めてから、
+        # パラメータ（group, key_exchange）を決める
+        # psk_ke モードでは鍵共有をせず，shared_key は 0 のバイト列にする
+        if not use_dhe:
+            server_share_group = None
+            shared_key = bytearray(secret_size)
+        elif NamedGroup.ffdhe2048 in client_key_share_groups:
+            server_share_group = NamedGroup.ffdhe2048
+            client_key_exchange = client_key_share.get_key_exchange(server_share_group)
+            ffdhe2048 = FFDHE(server_share_group)
+            server_key_share_key_exchange = ffdhe2048.gen_public_key()
+            shared_key = ffdhe2048.gen_shared_key(client_key_exchange)
+        elif NamedGroup.x25519 in client_key_share_groups:
+            server_share_group = NamedGroup.x25519
+            client_key_exchange = client_key_share.get_key_exchange(server_share_group)
+            x25519 = X25519PrivateKey.generate()
+            server_key_share_key_exchange = \
+                x25519.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+            shared_key = \
+                x25519.exchange(X25519PublicKey.from_public_bytes(client_key_exchange))
+        else:
+            raise NotImplementedError()
+
+        # 0-RTT：early data を受け入れるか決める
+        client_early_data = clienthello.get_extension(ExtensionType.early_data)
+        self.early_data_accepted = client_early_data is not None and \
+            ticket_state is not None and \
+            self.accept_early_data(clienthello, selected_identity, ticket_state)
+        _trace.log(INFO, "accept_early_data: %s", self.early_data_accepted)
+
+        serverhello_extensions = [
+            # supported_versions
+            Extension(
+                extension_type=ExtensionType.supported_versions,
+                extension_data=SupportedVersions(
+                    msg_type=HandshakeType.server_hello,
+                    selected_version=ProtocolVersion.TLS13 )),
+        ]
+        if use_dhe:
+            # key_share
+            serverhello_extensions.append(Extension(
+                extension_type=ExtensionType.key_share,
+                extension_data=KeyShareServerHello(
+                    server_share=KeyShareEntry(
+                        group=server_share_group,
+                        key_exchange=server_key_share_key_exchange ))))
+        if self.psk_accepted:
+            # pre_shared_key
+            serverhello_extensions.append(Extension(
+                extension_type=ExtensionType.pre_shared_key,
+                extension_data=PreSharedKeyExtension(
+                    msg_type=HandshakeType.server_hello,
+                    selected_identity=Uint16(selected_identity) )))
+
+        serverhello = Handshake(
+            msg_type=HandshakeType.server_hello,
+            msg=ServerHello(
+                legacy_session_id_echo=clienthello.legacy_session_id,
+                cipher_suite=cipher_suite,
+                extensions=serverhello_extensions ))
+
+        # ServerHello から Finished までは1つのフライトとしてまとめて送る
+        # クライアントの record_size_limit を超えないように送る
+        self._client_record_size_limit = \
+            clienthello.get_extension(ExtensionType.record_size_limit)
+        if self._client_record_size_limit is not None:
+            state.max_fragment_size = \
+                self._client_record_size_limit.get_max_fragment_size()
+        _trace.log(INFO, "max_fragment_size: %s", state.max_fragment_size)
+        # 応答の最初は小さなレコードで送り，後から最大サイズのレコードにする
+        if self.dynamic_record_size:
+            self.record_sizer = RecordSizer(max_size=state.max_fragment_size)
+
+        flight = HandshakeFlight(self._outgoing, pack=self.pack_handshake,
+                                 max_fragment_size=state.max_fragment_size)
+
+        _trace.log(DEBUG, "%s", serverhello)
+        flight.add(self._add_message(serverhello))
+
+        # -- HKDF ---
+        self._derive_handshake_secrets(early_secret, shared_key)
+        s_traffic_crypto = self._make_crypto(self._server_handshake_traffic_secret)
+        self._c_traffic_crypto = self._make_crypto(self._client_handshake_traffic_secret)
+
+        # client_early_traffic_secret は ClientHello までのメッセージから作る
+        if self.early_data_accepted:
+            client_early_traffic_secret = cryptomath.derive_secret(
+                early_secret, b"c e traffic", message)
+            if _secret.debug:
+                _secret.log(DEBUG, 'client_early_traffic_secret = %s',
+                            client_early_traffic_secret.hex())
+            state.set_crypto(read_crypto=self._make_crypto(client_early_traffic_secret),
+                             write_crypto=s_traffic_crypto)
+            self._receiving_early_data = True
+        else:
+            state.set_crypto(read_crypto=self._c_traffic_crypto,
+                             write_crypto=s_traffic_crypto)
+            # 拒否した early data は handshake の鍵では復号できないので読み捨てる
+            self._skipping_early_data = client_early_data is not None
+
+        # >>> EncryptedExtensions >>>
+
+        encrypted_extensions_extensions = []
+        if self._client_record_size_limit is not None:
+            # record_size_limit (RFC 8449)
+            encrypted_extensions_extensions.append(Extension(
+                extension_type=ExtensionType.record_size_limit,
+                extension_data=RecordSizeLimit(
+                    record_size_limit=Uint16(self.record_size_limit) )))
+        if self.early_data_accepted:
+            # early_data
+            encrypted_extensions_extensions.append(Extension(
+                extension_type=ExtensionType.early_data,
+                extension_data=EarlyDataIndication(
+                    msg_type=HandshakeType.encrypted_extensions )))
+
+        encrypted_extensions = Handshake(
+            msg_type=HandshakeType.encrypted_extensions,
+            msg=EncryptedExtensions(
+                extensions=encrypted_extensions_extensions ))
+
+        _trace.log(DEBUG, "%s", encrypted_extensions)
+        flight.add(self._add_message(encrypted_extensions), crypto=s_traffic_crypto)
+
+        # PSK を使うときは証明書による認証をしない
+        if not self.psk_accepted:
+            for segments in self._make_certificate(clienthello):
+                flight.add(segments, crypto=s_traffic_crypto)
+
+        # >>> Finished >>>
+        # server_handshake_traffic_secret を使って finished_key を作成する
+        flight.add(self._make_finished(self._server_handshake_traffic_secret),
+                   crypto=s_traffic_crypto)
+        num_records = flight.flush()
+        _trace.log(INFO, "flight: %d records", num_records)
+
+        self._client_application_traffic_secret, server_secret = \
+            self._derive_application_secrets()
+        # サーバは Finished を送った後から application_traffic_secret で送る
+        state.set_crypto(write_crypto=self._make_crypto(server_secret),
+                         write_secret=server_secret)
+
+        if self.early_data_accepted:
+            _trace.log(INFO, "=== recv early data ===")
+            self._expected = (HandshakeType.end_of_early_data,
+                              self._receive_end_of_early_data)
+        else:
+            self._expected = (HandshakeType.finished, self._receive_finished)
+
+    def _make_certificate(self, clienthello):
+        """
+        Certificate と CertificateVerify をそれぞれバッファのリスト（to_segments）で返す．
+        証明書のバイト列はコピーしない．
+        """
+        client_signature_scheme_list = clienthello \
+            .get_extension(ExtensionType.signature_algorithms) \
+            .supported_signature_algorithms
+
+        # >>> server Certificate >>>
+
+        with open(self.certificate_file, 'r') as f:
+            cert_data = ssl.PEM_cert_to_DER_cert(f.read())
+
+        certificate = Handshake(
+            msg_type=HandshakeType.certificate,
+            msg=Certificate(
+                certificate_request_context=b'',
+                certificate_list=[
+                    CertificateEntry(cert_data=cert_data)
+                ]))
+
+        _trace.log(INFO, "=== Certificate ===")
+        _trace.log(DEBUG, "%s", certificate)
+        certificate_segments = self._add_message(certificate)
+
+        # >>> CertificateVerify >>>
+
+        # デジタル署名アルゴリズム
+        # 秘密鍵 private_key_file を使って署名する
+        from Crypto.Hash import SHA256
+        from Crypto.PublicKey import RSA
+        with open(self.private_key_file) as f:
+            key = RSA.importKey(f.read())
+        if SignatureScheme.rsa_pss_pss_sha256 in client_signature_scheme_list:
+            server_signature_scheme = SignatureScheme.rsa_pss_pss_sha256
+            from Crypto.Signature import PKCS1_PSS
+            message = b'\x20' * 64 + b'TLS 1.3, server CertificateVerify' + b'\x00' + \
+                cryptomath.transcript_hash(self.messages, self.state.hash_algo)
+            if _trace.debug:
+                _trace.log(DEBUG, "message:\n%s", hexdump(message))
+            certificate_signature = PKCS1_PSS.new(key).sign(SHA256.new(message))
+        else:
+            raise NotImplementedError()
+
+        cert_verify = Handshake(
+            msg_type=HandshakeType.certificate_verify,
+            msg=CertificateVerify(
+                algorithm=server_signature_scheme,
+                signature=certificate_signature ))
+
+        _trace.log(INFO, "=== CertificateVerify ===")
+        _trace.log(DEBUG, "%s", cert_verify)
+        return [certificate_segments, self._add_message(cert_verify)]
+
+    def select_psk(self, clienthello, clienthello_bytes, cipher_suite, can_use_dhe):
+        """
+        ClientHello の pre_shared_key から使える PSK を選び，
+        (selected_identity, TicketState, ExternalPsk, use_dhe) を返す．
+        外部 PSK を選んだときは TicketState が，チケットを選んだときは ExternalPsk が None．
+        PSK を使えないときは (None, None, None, can_use_dhe)．
+        """
+        pre_shared_key = clienthello.get_extension(ExtensionType.pre_shared_key)
+        psk_key_exchange_modes = \
+            clienthello.get_extension(ExtensionType.psk_key_exchange_modes)
+        if pre_shared_key is None or psk_key_exchange_modes is None:
+            return (None, None, None, can_use_dhe)
+        # 鍵共有ができるときは forward secrecy のある psk_dhe_ke を優先する
+        ke_modes = psk_key_exchange_modes.ke_modes
+        if PskKeyExchangeMode.psk_dhe_ke in ke_modes and can_use_dhe:
+            use_dhe = True
+        elif PskKeyExchangeMode.psk_ke in ke_modes:
+            use_dhe = False
+        else:
+            return (None, None, None, can_use_dhe)
+
+        hash_algo = CipherSuite.get_hash_algo_name(cipher_suite)
+        secret_size = CipherSuite.get_hash_algo_size(cipher_suite)
+        offered_psks = pre_shared_key.offered_psks
+        # binder の計算には binders を取り除いた ClientHello を使う
+        truncated_clienthello = \
+            clienthello_bytes[:-offered_psks.get_binders_length()]
+
+        for i, identity in enumerate(offered_psks.identities):
+            external_psk = self.external_psks.get(identity.identity)
+            ticket_state = None
+            if external_psk is not None:
+                if not external_psk.is_usable_with(cipher_suite):
+                    continue
+                binder_key = external_psk.binder_key
+            else:
+                ticket_state = self.ticket_key_ring.open(identity.identity)
+                if ticket_state is None or ticket_state.is_expired():
+                    continue
+                if ticket_state.cipher_suite != cipher_suite:
+                    continue
+                early_secret = cryptomath.HKDF_extract(
+                    bytearray(secret_size), ticket_state.psk, hash_algo)
+                binder_key = cryptomath.gen_binder_key(early_secret, hash_algo=hash_algo)
+            binder = cryptomath.gen_binder(binder_key, truncated_clienthello, hash_algo)
+            if not Cipher.Cipher.ct_compare_digest(
+                    binder, offered_psks.binders[i].binder):
+                raise RuntimeError("PSK binder is not match!")
+            return (i, ticket_state, external_psk, use_dhe)
+
+        return (None, None, None, can_use_dhe)
+
+    def accept_early_data(self, clienthello, selected_identity, ticket_state):
+        """
+        early data を受け入れるときに True を返す．
+        最初の PSK が選ばれていて，チケットが新しく，同じ ClientHello を
+        受け取っていないときだけ受け入れる．
+        """
+        if selected_identity != 0 or self.max_early_data_size == 0:
+            return False
+        if int(ticket_state.max_early_data_size) == 0:
+            return False
+
+        offered_psks = clienthello \
+            .get_extension(ExtensionType.pre_shared_key).offered_psks
+        obfuscated_ticket_age = \
+            int(offered_psks.identities[0].obfuscated_ticket_age)
+        client_ticket_age = \
+            (obfuscated_ticket_age - int(ticket_state.ticket_age_add)) % 2**32
+        if not self.anti_replay.is_fresh(client_ticket_age,
+                                         ticket_state.get_expected_age()):
+            _trace.log(INFO, "early data: ticket age is out of window")
+            return False
+
+        if not self.anti_replay.check_and_add(offered_psks.binders[0].binder):
+            _trace.log(INFO, "early data: replayed ClientHello")
+            return False
+
+        return True
+
+    def _count_early_data(self, size):
+        self._early_data_size += size
+        if self._early_data_size > self.max_early_data_size:
+            raise RuntimeError("early data exceeds max_early_data_size")
+
+    def _unprotect(self, record):
+        if not self._skipping_early_data:
+            return super()._unprotect(record)
+        # early data を拒否したときは，handshake の鍵で復号できるレコード
+        # （client Finished）が来るまで受信したレコードを読み捨てる
+        crypto = self.state.read_crypto
+        seq_number = crypto.seq_number
+        try:
+            result = unprotect(record, crypto)
+        except RuntimeError:
+            # 復号に失敗しても seq_number が進むので戻す
+            crypto.seq_number = seq_number
+            self._count_early_data(len(record))
+            return None
+        self._skipping_early_data = False
+        return result
+
+    def _receive_application_data(self, data):
+        if not self._receiving_early_data:
+            super()._receive_application_data(data)
+            return
+        self._count_early_data(len(data))
+        self._events.append(EarlyDataReceived(data))
+
+    def _receive_end_of_early_data(self, message):
+        # <<< EndOfEarlyData <<<
+        _trace.log(DEBUG, "%s", Handshake.from_bytes(message))
+        self.messages += message
+        self._receiving_early_data = False
+        self.state.set_crypto(read_crypto=self._c_traffic_crypto)
+        self._expected = (HandshakeType.finished, self._receive_finished)
+
+    def _receive_finished(self, message):
+        # <<< recv Finished <<<
+        self._verify_finished(message, self._client_handshake_traffic_secret)
+        state = self.state
+        client_secret = self._client_application_traffic_secret
+        state.set_crypto(read_crypto=self._make_crypto(client_secret),
+                         read_secret=client_secret)
+        if self._client_record_size_limit is not None:
+            self._set_record_size_limit()
+        self._derive_resumption_master_secret()
+
+        self._send_new_session_ticket()
+        self.handshake_complete = True
+        self._expected = None
+        self._events.append(HandshakeCompleted(
+            state.cipher_suite, psk_accepted=self.psk_accepted,
+            early_data_accepted=self.early_data_accepted))
+
+    def _send_new_session_ticket(self):
+        # >>> NewSessionTicket >>>
+        hash_algo = self.state.hash_algo
+        max_early_data_size = self.max_early_data_size
+        ticket_nonce = secrets.token_bytes(8)
+        ticket_age_add = secrets.randbits(32)
+        new_ticket_state = TicketState(
+            cipher_suite=self.state.cipher_suite,
+            ticket_age_add=Uint32(ticket_age_add),
+            ticket_lifetime=Uint32(TICKET_LIFETIME),
+            max_early_data_size=Uint32(max_early_data_size),
+            psk=cryptomath.gen_resumption_psk(
+                self.resumption_master_secret, ticket_nonce, hash_algo))
+
+        new_session_ticket_extensions = []
+        if max_early_data_size > 0:
+            # early_data
+            new_session_ticket_extensions.append(Extension(
+                extension_type=ExtensionType.early_data,
+                extension_data=EarlyDataIndication(
+                    msg_type=HandshakeType.new_session_ticket,
+                    max_early_data_size=Uint32(max_early_data_size) )))
+
+        new_session_ticket = Handshake(
+            msg_type=HandshakeType.new_session_ticket,
+            msg=NewSessionTicket(
+                ticket_lifetime=Uint32(TICKET_LIFETIME),
+                ticket_age_add=Uint32(ticket_age_add),
+                ticket_nonce=ticket_nonce,
+                ticket=self.ticket_key_ring.seal(new_ticket_state),
+                extensions=new_session_ticket_extensions ))
+
+        _trace.log(INFO, "=== NewSessionTicket ===")
+        _trace.log(DEBUG, "%s", new_session_ticket)
+        self._outgoing.data += protect(new_session_ticket.to_bytes(),
+                                       self.state.write_crypto, ContentType.handshake)
+
+
+def get_cipher_params(cipher_suite):
+    if cipher_suite == CipherSuite.TLS_CHACHA20_POLY1305_SHA256:
+        cipher_class = Cipher.Chacha20Poly1305
+        key_size     = Cipher.Chacha20Poly1305.key_size
+        nonce_size   = Cipher.Chacha20Poly1305.nonce_size
+    else:
+        raise NotImplementedError()
+    return (cipher_class, key_size, nonce_size)
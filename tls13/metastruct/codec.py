@@ -1,10 +1,16 @@
 
-__all__ = ['Reader', 'Writer']
+__all__ = ['Reader', 'Writer', 'SegmentWriter']
 
+import struct
 from typing import List
 
 from .type import Uint, Type
 
+# 整数の大きさ -> struct の書式
+_int_formats = {1: 'B', 2: 'H', 4: 'I'}
+_int_structs = {size: struct.Struct('>' + format).unpack_from
+                for size, format in _int_formats.items()}
+
 
 class ReaderParseError(Exception):
     pass
@@ -13,49 +19,81 @@ class ReaderParseError(Exception):
 class Reader:
     """
     Byte string reader
+
+    data は memoryview を通して読むので，バイト列を返すメソッドは既定ではコピーせずに
+    data の一部を指す memoryview を返す．入れ子になったメッセージ（Certificate の中の
+    CertificateEntry など）は，この memoryview からさらに Reader を作ればコピーせずに読める．
+    構造体のフィールドに入れるなど，data より長く残す値は copy=True で bytes にする．
+    Reader(data, copy=True) とすると全てのメソッドが bytes を返す．
+
+    可変長のバイト列とリストは min_length, max_length（RFC の <min..max>）を与えると，
+    長さを読んだところで範囲を調べ，範囲外ならバイト列をコピーする前にエラーにする．
     """
-    def __init__(self, data):
+    def __init__(self, data, copy=False):
         self.bytes = data
+        self.view = memoryview(data)
+        if self.view.format != 'B':
+            self.view = self.view.cast('B')
         self.index = 0
+        self.copy = copy
 
-    def get(self, type, length_t=None) -> int or Uint:
+    def get(self, type, length_t=None, copy=None,
+            min_length=0, max_length=None) -> int or Uint:
         from .metastruct import Listof, Struct
 
         if isinstance(type, int):
             return self.get_int(type)
 
         if isinstance(type, Listof):
-            elem_len = type.subtype._size
-            length_len = length_t._size
-            fun = lambda x: x
             # Listof(Type) のときはリストの要素を UintN に変換する
             if issubclass(type.subtype, (Uint, Type)):
-                fun = Uint.get_type(type.subtype._size)
-            return [fun(x) for x in self.get_var_list(elem_len, length_len)]
+                return self.get_uint_var_list(Uint.get_type(type.subtype._size),
+                                              length_t._size,
+                                              min_length, max_length)
+            return self.get_var_list(type.subtype._size, length_t._size,
+                                     min_length, max_length)
 
         if issubclass(type, Uint):
             return self.get_uint(type)
 
         if issubclass(type, (bytes, Struct)):
             if hasattr(type, '_size'):
-                return self.get_fix_bytes(type._size)
+                return self.get_fix_bytes(type._size, copy)
             if length_t:
-                return self.get_var_bytes(length_t._size)
-            return self.get_rest()
+                return self.get_var_bytes(length_t._size, copy,
+                                          min_length, max_length)
+            return self.get_rest(copy, min_length, max_length)
 
         raise NotImplementedError()
 
+    def _check(self, length):
+        if length < 0 or self.index + length > len(self.view):
+            raise ReaderParseError()
+
+    @staticmethod
+    def _check_limits(length, min_length, max_length):
+        if length < min_length or (max_length is not None and length > max_length):
+            raise ReaderParseError()
+
+    def _slice(self, length, copy):
+        self._check(length)
+        view = self.view[self.index : self.index+length]
+        self.index += length
+        if self.copy if copy is None else copy:
+            return bytes(view)
+        return view
+
     def get_int(self, length) -> int:
         """
         Read a single big-endian integer value in 'length' bytes.
         """
-        if self.index + length > len(self.bytes):
-            raise ReaderParseError()
-        x = 0
-        for _ in range(length):
-            x <<= 8
-            x |= self.bytes[self.index]
-            self.index += 1
+        self._check(length)
+        unpack = _int_structs.get(length)
+        if unpack is None:
+            x = int.from_bytes(self.view[self.index : self.index+length], 'big')
+        else:
+            (x,) = unpack(self.view, self.index)
+        self.index += length
         return x
 
     def get_uint(self, uint) -> Uint:
@@ -63,61 +101,63 @@ class Reader:
         x = self.get_int(length)
         return uint(x)
 
-    def get_fix_bytes(self, bytes_length) -> bytearray:
+    def get_fix_bytes(self, bytes_length, copy=None) -> memoryview or bytes:
         """
         Read a string of bytes encoded in 'bytes_length' bytes.
         """
-        if self.index + bytes_length > len(self.bytes):
-            raise ReaderParseError()
-        bytes = self.bytes[self.index : self.index+bytes_length]
-        self.index += bytes_length
-        return bytes
+        return self._slice(bytes_length, copy)
 
-    def get_var_bytes(self, length_length) -> bytearray:
+    def get_var_bytes(self, length_length, copy=None,
+                      min_length=0, max_length=None) -> memoryview or bytes:
         """
         Read a variable length string with a fixed length.
         """
         bytes_length = self.get(length_length)
-        return self.get_fix_bytes(bytes_length)
+        self._check_limits(bytes_length, min_length, max_length)
+        return self._slice(bytes_length, copy)
 
     def get_fix_list(self, elem_length, list_length) -> List[int]:
         """
         Read a list of static length with same-sized ints.
         """
-        l = [0] * list_length
-        for x in range(list_length):
-            l[x] = self.get(elem_length)
+        self._check(elem_length * list_length)
+        if elem_length not in _int_formats:
+            return [self.get_int(elem_length) for _ in range(list_length)]
+        l = list(struct.unpack_from(
+            '>%d%s' % (list_length, _int_formats[elem_length]),
+            self.view, self.index))
+        self.index += elem_length * list_length
         return l
 
-    def get_var_list(self, elem_length, length_length) -> List[int]:
+    def get_var_list(self, elem_length, length_length,
+                     min_length=0, max_length=None) -> List[int]:
         """
         Read a variable length list of same-sized integers.
         """
         list_length = self.get(length_length)
+        self._check_limits(list_length, min_length, max_length)
         if list_length % elem_length != 0:
             raise SyntaxError()
-        list_length = list_length // elem_length
-        l = [0] * list_length
-        for x in range(list_length):
-            l[x] = self.get(elem_length)
-        return l
+        return self.get_fix_list(elem_length, list_length // elem_length)
 
-    def get_uint_var_list(self, elem, length_length):
+    def get_uint_var_list(self, elem, length_length,
+                          min_length=0, max_length=None):
         uint = elem
         elem_length = uint._size
         assert issubclass(uint, Uint)
-        return [uint(x) for x in self.get_var_list(elem_length, length_length)]
+        return [uint(x) for x in self.get_var_list(elem_length, length_length,
+                                                   min_length, max_length)]
 
-    def get_rest(self):
+    def get_rest(self, copy=None, min_length=0, max_length=None) -> memoryview or bytes:
         """
         Read a rest of the data.
         """
-        rest_bytes = self.bytes[self.index:]
-        self.index = len(self.bytes)
-        return rest_bytes
+        length = len(self.view) - self.index
+        self._check_limits(length, min_length, max_length)
+        return self._slice(length, copy)
 
     def get_rest_length(self):
-        return len(self.bytes) - self.index
+        return len(self.view) - self.index
 
 
 
@@ -162,5 +202,63 @@ class Writer:
         長さの型が Uint16 のとき，最終的に追加されるバイト列は次のようになる．
             b'\x00\x06\x03\x04\x03\x03\x03\x02'
         """
+        data = b''.join([x.to_bytes() for x in a_list])
+        self.bytes += length_t(len(data)).to_bytes()
+        self.bytes += data
+
+
+class SegmentWriter(Writer):
+    """
+    Scatter-gather writer
+    バイト列を1つにつなげる代わりに，バッファのリスト（segments）を作る．
+    min_segment_size 以上のバイト列（証明書やアプリケーションデータなど）はコピーしないで
+    そのまま segments に入れ，それより小さいヘッダなどは self.bytes にまとめる．
+    segments は socket.sendmsg（Connection.send_buffers）などにそのまま渡せる．
+
+        writer = SegmentWriter()
+        certificate.write_segments(writer)
+        conn.send_buffers(writer.get_segments())
+    """
+    min_segment_size = 256
+
+    def __init__(self, min_segment_size=None):
+        super().__init__()
+        self.segments = []
+        if min_segment_size is not None:
+            self.min_segment_size = min_segment_size
+
+    def _flush(self):
+        if self.bytes:
+            self.segments.append(bytes(self.bytes))
+            self.bytes = bytearray(0)
+
+    def add_segment(self, data):
+        """
+        バイト列 data を追加する．大きなバイト列はコピーしないで参照を持つ．
+        """
+        if len(data) < self.min_segment_size:
+            self.bytes += data
+        else:
+            self._flush()
+            self.segments.append(data)
+
+    def add_bytes(self, obj, length_t=None):
+        if length_t:
+            self.bytes += length_t(len(obj)).to_bytes()
+        if hasattr(obj, 'write_segments'):
+            obj.write_segments(self)
+        else:
+            self.add_segment(self._get_bytes(obj))
+
+    def add_list(self, a_list, length_t):
         self.bytes += length_t(sum(map(len, a_list))).to_bytes()
-        self.bytes += b''.join(x.to_bytes() for x in a_list)
+        for x in a_list:
+            self.add_bytes(x)
+
+    def get_segments(self) -> list:
+        """
+        追加したバイト列を順に並べたバッファのリストを返す．
+        b''.join(segments) は Writer で作ったバイト列と同じになる．
+        """
+        self._flush()
+        return self.segments
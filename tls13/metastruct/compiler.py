@@ -0,0 +1,527 @@
+
+# クラス変数 members から構造体のメソッドを生成する
+#
+#     class KeyShareEntry(Struct):
+#         members = [
+#             Member(NamedGroup, 'group'),
+#             Member(bytes, 'key_exchange', length_t=Uint16),
+#         ]
+#
+# と書くと，クラスを作るときに次のようなメソッドを生成して KeyShareEntry に追加する．
+#
+#     def to_bytes(self):
+#         b1 = self.key_exchange
+#         return b''.join((_pack0(self.group.value, len(b1)), b1))
+#
+#     def __len__(self):
+#         return 4 + len(self.key_exchange)
+#
+#     def _decode(cls, data, pos, end):
+#         (v0, n1) = _unpack0(data, pos)
+#         ...
+#
+# Members と違い，構造はクラスに1度だけ書けばよく，呼び出すたびに Member の種類を
+# isinstance で調べることもない．連続する固定長のフィールドと長さは
+# 1回の struct.pack / struct.unpack_from でまとめて読み書きする．
+#
+# Member に min_length, max_length, max_count を書いたフィールドは，_decode で
+# 長さを読んだ直後に範囲を調べるので，範囲外のときはバイト列もリストも作らない．
+
+__all__ = ['compile_struct']
+
+import collections
+import inspect
+import struct
+
+from .codec import ReaderParseError
+from .type import Uint, Type
+from .repr import make_format
+
+# 整数の大きさ -> struct の書式．uint24 は uint8 と uint16 に分けて読み書きする
+_formats = {1: 'B', 2: 'H', 3: 'BH', 4: 'I'}
+
+# set_args で引数が無いことを表す
+_missing = object()
+
+
+class _Field:
+    """
+    Member の種類を調べた結果．
+
+    kind は次のどれか
+      'uint'    整数（Uint や Type）            size バイト
+      'fixed'   固定長のバイト列（Random など）  size バイト
+      'bytes'   バイト列
+      'struct'  構造体
+      'uints'   整数のリスト
+      'structs' 構造体のリスト
+    length_t が無い 'bytes' と 'struct' は残りのバイト列全体になる．
+    """
+    def __init__(self, index, member):
+        from .metastruct import Listof, Struct
+        self.index = index
+        self.member = member
+        self.name = member.name
+        self.length_t = member.length_t
+        self.min_length = member.min_length
+        self.max_length = member.max_length
+        self.max_count = member.max_count
+        type = member.type
+
+        if isinstance(type, Listof):
+            subtype = type.subtype
+            if issubclass(subtype, (Uint, Type)):
+                self.kind = 'uints'
+                self.size = subtype._size
+                self.uint = Uint.get_type(subtype._size)
+                # 整数のリストの要素の数はバイト長で制限できる
+                if self.max_count is not None:
+                    max_length = self.max_count * self.size
+                    if self.max_length is None or max_length < self.max_length:
+                        self.max_length = max_length
+            else:
+                self.kind = 'structs'
+                self.subtype = subtype
+        elif issubclass(type, (Uint, Type)):
+            self.kind = 'uint'
+            self.size = type._size
+            self.uint = type if issubclass(type, Uint) else Uint.get_type(type._size)
+        elif issubclass(type, Struct):
+            self.kind = 'struct'
+            self.subtype = type
+        elif hasattr(type, '_size'):
+            self.kind = 'fixed'
+            self.size = type._size
+        else:
+            self.kind = 'bytes'
+
+    @property
+    def limits(self):
+        # 長さ stop - pos が範囲外になる条件の式
+        conditions = []
+        if self.min_length:
+            conditions.append('stop - pos < %d' % self.min_length)
+        if self.max_length is not None:
+            conditions.append('stop - pos > %d' % self.max_length)
+        return ' or '.join(conditions)
+
+    @property
+    def is_fixed(self):
+        return self.kind in ('uint', 'fixed')
+
+    @property
+    def fixed_size(self):
+        return self.size if self.is_fixed else self.length_t._size
+
+    @property
+    def format(self):
+        if self.kind == 'fixed':
+            return '%ds' % self.size
+        return _formats[self.fixed_size]
+
+
+def _pack_uints(values, size):
+    if size == 3:
+        return b''.join(x.to_bytes() for x in values)
+    return struct.pack('>%d%s' % (len(values), _formats[size]),
+                       *[x.value for x in values])
+
+
+def _unpack_uints(data, pos, length, uint):
+    size = uint._size
+    if length % size != 0:
+        raise ReaderParseError()
+    if size == 3:
+        return [uint(int.from_bytes(data[i:i+3], 'big'))
+                for i in range(pos, pos + length, 3)]
+    return [uint(x) for x in struct.unpack_from(
+        '>%d%s' % (length // size, _formats[size]), data, pos)]
+
+
+def _write_uints(values, size, buf, offset):
+    if size == 3:
+        data = _pack_uints(values, size)
+        buf[offset:offset + len(data)] = data
+        return offset + len(data)
+    struct.pack_into('>%d%s' % (len(values), _formats[size]), buf, offset,
+                     *[x.value for x in values])
+    return offset + len(values) * size
+
+
+def _write_into(obj, buf, offset):
+    # Member(Struct, ...) にはバイト列が入ることもある
+    write_into = getattr(obj, 'write_into', None)
+    if write_into is not None:
+        return write_into(buf, offset)
+    buf[offset:offset + len(obj)] = obj
+    return offset + len(obj)
+
+
+def _write_segments(obj, writer):
+    # Member(Struct, ...) にはバイト列が入ることもある
+    write_segments = getattr(obj, 'write_segments', None)
+    if write_segments is not None:
+        write_segments(writer)
+    else:
+        writer.add_segment(obj)
+
+
+def _to_bytes(obj):
+    # Member(Struct, ...) にはバイト列が入ることもある
+    if hasattr(obj, 'to_bytes') and callable(obj.to_bytes):
+        return obj.to_bytes()
+    return obj
+
+
+class _Group:
+    """
+    まとめて pack / unpack する連続した固定長のフィールド（と次の可変長フィールドの長さ）
+    """
+    def __init__(self, index):
+        self.index = index
+        self.format = '>'
+        self.size = 0
+        self.args = []   # pack の引数の式
+        self.names = []  # unpack した値を入れる変数名
+
+    def add(self, field, arg, name):
+        self.format += field.format
+        self.size += field.fixed_size
+        if field.format == 'BH':
+            # uint24 は上位1バイトと下位2バイトに分ける
+            self.args += ['(%s) >> 16' % arg, '(%s) & 0xffff' % arg]
+            self.names += ['%s_hi' % name, '%s_lo' % name]
+        else:
+            self.args.append(arg)
+            self.names.append(name)
+
+    def __bool__(self):
+        return self.size > 0
+
+
+def _split(fields):
+    # フィールドを [(group, field or None), ...] に分ける．
+    # group には field の前にある固定長のフィールドと field の長さが入る
+    result = []
+    group = _Group(0)
+    for field in fields:
+        if field.is_fixed:
+            group.add(field, 'self.%s%s' % (field.name,
+                      '.value' if field.kind == 'uint' else ''), 'v%d' % field.index)
+            continue
+        if field.length_t:
+            group.add(field, 'n%d' % field.index, 'n%d' % field.index)
+        result.append((group, field))
+        group = _Group(len(result))
+    result.append((group, None))
+    return result
+
+
+def _compile_to_bytes(fields, namespace):
+    lines = ['def to_bytes(self):']
+    parts = []
+    for group, field in _split(fields):
+        if field is not None:
+            i = field.index
+            value = 'self.%s' % field.name
+            if field.kind == 'bytes':
+                lines.append('    b%d = %s' % (i, value))
+            elif field.kind == 'struct':
+                lines.append('    b%d = _to_bytes(%s)' % (i, value))
+            elif field.kind == 'uints':
+                lines.append('    b%d = _pack_uints(%s, %d)' % (i, value, field.size))
+            elif field.kind == 'structs':
+                lines.append("    b%d = b''.join([x.to_bytes() for x in %s])" %
+                             (i, value))
+            if field.length_t:
+                lines.append('    n%d = len(b%d)' % (i, i))
+        if group:
+            namespace['_pack%d' % group.index] = struct.Struct(group.format).pack
+            parts.append('_pack%d(%s)' % (group.index, ', '.join(group.args)))
+        if field is not None:
+            parts.append('b%d' % field.index)
+
+    if len(parts) == 0:
+        lines.append("    return b''")
+    elif len(parts) == 1:
+        lines.append('    return %s' % parts[0])
+    else:
+        lines.append("    return b''.join((%s,))" % ', '.join(parts))
+    return lines
+
+
+def _compile_write_into(fields, namespace):
+    # 可変長のフィールドを先に書いてから，その前にある固定長のフィールドと
+    # 長さを書く．長さは書いた位置から分かるので len() をもう一度計算しない
+    lines = ['def write_into(self, buf, offset):']
+    for group, field in _split(fields):
+        if group:
+            lines += ['    start%d = offset' % group.index,
+                      '    offset += %d' % group.size]
+        if field is not None:
+            i = field.index
+            value = 'self.%s' % field.name
+            if field.length_t:
+                lines.append('    s%d = offset' % i)
+            if field.kind == 'bytes':
+                lines += ['    x = %s' % value,
+                          '    n = len(x)',
+                          '    buf[offset:offset + n] = x',
+                          '    offset += n']
+            elif field.kind == 'struct':
+                lines.append('    offset = _write_into(%s, buf, offset)' % value)
+            elif field.kind == 'uints':
+                lines.append('    offset = _write_uints(%s, %d, buf, offset)' %
+                             (value, field.size))
+            elif field.kind == 'structs':
+                lines += ['    for x in %s:' % value,
+                          '        offset = x.write_into(buf, offset)']
+            if field.length_t:
+                lines.append('    n%d = offset - s%d' % (i, i))
+        if group:
+            namespace['_pack_into%d' % group.index] = \
+                struct.Struct(group.format).pack_into
+            lines.append('    _pack_into%d(buf, start%d, %s)' %
+                         (group.index, group.index, ', '.join(group.args)))
+    lines.append('    return offset')
+    return lines
+
+
+def _length_term(field, value):
+    if field.kind == 'uints':
+        return 'len(%s) * %d' % (value, field.size)
+    if field.kind == 'structs':
+        return 'sum(map(len, %s))' % value
+    return 'len(%s)' % value
+
+
+def _compile_write_segments(fields, namespace):
+    # 固定長のフィールドと長さは小さいので writer.bytes にまとめ，
+    # バイト列のフィールドはコピーしないで writer.add_segment に渡す
+    lines = ['def write_segments(self, writer):']
+    for group, field in _split(fields):
+        if field is not None:
+            i = field.index
+            lines.append('    v%d = self.%s' % (i, field.name))
+            if field.length_t:
+                lines.append('    n%d = %s' % (i, _length_term(field, 'v%d' % i)))
+        if group:
+            namespace['_pack%d' % group.index] = struct.Struct(group.format).pack
+            lines.append('    writer.bytes += _pack%d(%s)' %
+                         (group.index, ', '.join(group.args)))
+        if field is not None:
+            value = 'v%d' % field.index
+            if field.kind == 'bytes':
+                lines.append('    writer.add_segment(%s)' % value)
+            elif field.kind == 'struct':
+                lines.append('    _write_segments(%s, writer)' % value)
+            elif field.kind == 'uints':
+                lines.append('    writer.bytes += _pack_uints(%s, %d)' %
+                             (value, field.size))
+            elif field.kind == 'structs':
+                lines += ['    for x in %s:' % value,
+                          '        x.write_segments(writer)']
+    if len(lines) == 1:
+        lines.append('    pass')
+    return lines
+
+
+def _compile_len(fields):
+    size = 0
+    terms = []
+    for field in fields:
+        if field.is_fixed:
+            size += field.size
+            continue
+        if field.length_t:
+            size += field.length_t._size
+        terms.append(_length_term(field, 'self.%s' % field.name))
+    return ['def __len__(self):',
+            '    return %s' % ' + '.join([str(size)] + terms)]
+
+
+def _is_decodable(fields):
+    for field in fields:
+        if field.kind in ('struct', 'structs') and \
+           not hasattr(field.subtype, '_decode'):
+            return False
+        if field.kind == 'bytes' and not field.length_t and \
+           field is not fields[-1]:
+            return False
+    return True
+
+
+def _compile_decode(fields, namespace):
+    lines = ['def _decode(cls, data, pos, end):']
+    args = []
+    for group, field in _split(fields):
+        if group:
+            namespace['_unpack%d' % group.index] = \
+                struct.Struct(group.format).unpack_from
+            lines += ['    try:',
+                      '        (%s,) = _unpack%d(data, pos)' %
+                      (', '.join(group.names), group.index),
+                      '    except _error:',
+                      '        raise ReaderParseError()',
+                      '    pos += %d' % group.size]
+            for name in group.names:
+                if name.endswith('_hi'):
+                    lines.append('    %s = (%s << 16) | %s_lo' %
+                                 (name[:-3], name, name[:-3]))
+        if field is None:
+            continue
+        i = field.index
+        if field.length_t:
+            lines += ['    stop = pos + n%d' % i,
+                      '    if stop > end:',
+                      '        raise ReaderParseError()']
+        else:
+            lines.append('    stop = end')
+        if field.limits:
+            lines += ['    if %s:' % field.limits,
+                      '        raise ReaderParseError()']
+        if field.kind == 'bytes':
+            lines.append('    b%d = bytes(data[pos:stop])' % i)
+        elif field.kind == 'uints':
+            namespace['_Uint%d' % i] = field.uint
+            lines.append('    b%d = _unpack_uints(data, pos, stop - pos, _Uint%d)' %
+                         (i, i))
+        elif field.kind == 'struct':
+            namespace['_Struct%d' % i] = field.subtype
+            lines.append('    b%d, p = _Struct%d._decode(data, pos, stop)' % (i, i))
+            if not field.length_t:
+                lines.append('    stop = p')
+        elif field.kind == 'structs':
+            namespace['_Struct%d' % i] = field.subtype
+            lines += ['    b%d = []' % i,
+                      '    while pos < stop:']
+            if field.max_count is not None:
+                lines += ['        if len(b%d) == %d:' % (i, field.max_count),
+                          '            raise ReaderParseError()']
+            lines += ['        x, pos = _Struct%d._decode(data, pos, stop)' % i,
+                      '        b%d.append(x)' % i]
+        lines.append('    pos = stop')
+
+    for field in fields:
+        i = field.index
+        if field.kind == 'uint':
+            namespace['_Uint%d' % i] = field.uint
+            args.append('%s=_Uint%d(v%d)' % (field.name, i, i))
+        elif field.kind == 'fixed':
+            args.append('%s=v%d' % (field.name, i))
+        else:
+            args.append('%s=b%d' % (field.name, i))
+    lines += ['    if pos > end:',
+              '        raise ReaderParseError()',
+              '    return (cls(%s), pos)' % ', '.join(args)]
+    return lines
+
+
+def _compile_set_args(fields, namespace):
+    from .metastruct import Listof, StructAssert
+    lines = ['def set_args(self, **kwargs):',
+             '    get = kwargs.get']
+    for field in fields:
+        i = field.index
+        member = field.member
+        namespace['_member%d' % i] = member
+        lines += ['    x = get(%r, _missing)' % field.name,
+                  '    if x is _missing:']
+        if member.default_factory is not None:
+            namespace['_factory%d' % i] = member.default_factory
+            lines.append('        x = _factory%d()' % i)
+        elif member.default is not None:
+            namespace['_default%d' % i] = member.default
+            if isinstance(member.type, Listof):
+                lines.append('        x = list(_default%d)' % i)
+            else:
+                lines.append('        x = _default%d' % i)
+        elif isinstance(member.type, Listof):
+            lines.append('        x = []')
+        else:
+            lines.append('        x = None')
+
+        if isinstance(member.type, Listof):
+            namespace['_assert_listof'] = StructAssert.assert_listof
+            lines.append('    _assert_listof(_member%d, x)' % i)
+        elif inspect.isclass(member.type) and issubclass(member.type, Type):
+            namespace['_values%d' % i] = member.type.values()
+            lines += ['    if x not in _values%d:' % i,
+                      "        raise RuntimeError('value \"%s\" is not in \"%%s\"'"
+                      " %% _member%d.type)" % (field.name, i)]
+        lines.append('    self.%s = x' % field.name)
+    return lines
+
+
+def _from_bytes(cls, data=b'', reader=None):
+    # 入れ子の構造体やリストの要素は data の memoryview から読み，
+    # フィールドのバイト列だけを bytes にコピーする
+    if reader is not None:
+        obj, reader.index = cls._decode(reader.view, reader.index,
+                                        len(reader.view))
+        return (obj, reader)
+    if not isinstance(data, bytes):
+        data = memoryview(data)
+    obj, _ = cls._decode(data, 0, len(data))
+    return obj
+
+
+def _define(cls, name, value):
+    # クラスに直接書いたメソッドは上書きしない
+    if name not in cls.__dict__:
+        setattr(cls, name, value)
+
+
+def compile_struct(cls):
+    """
+    cls.members から to_bytes, write_into, write_segments, __len__, __repr__,
+    set_args を生成して cls に追加する．
+    全てのフィールドをバイト列から読めるときは from_bytes と _decode も追加する．
+    """
+    fields = [_Field(i, member) for i, member in enumerate(cls.members)]
+    namespace = {
+        '_error': struct.error,
+        '_missing': _missing,
+        '_pack_uints': _pack_uints,
+        '_unpack_uints': _unpack_uints,
+        '_to_bytes': _to_bytes,
+        '_write_into': _write_into,
+        '_write_uints': _write_uints,
+        '_write_segments': _write_segments,
+        'ReaderParseError': ReaderParseError,
+    }
+    sources = [_compile_to_bytes(fields, namespace),
+               _compile_write_into(fields, namespace),
+               _compile_write_segments(fields, namespace),
+               _compile_len(fields),
+               _compile_set_args(fields, namespace)]
+    decodable = _is_decodable(fields)
+    if decodable:
+        sources.append(_compile_decode(fields, namespace))
+
+    source = '\n'.join('\n'.join(lines) for lines in sources)
+    code = compile(source, '<struct %s>' % cls.__qualname__, 'exec')
+    exec(code, namespace)
+
+    props = collections.OrderedDict(
+        (member.name, list if field.kind in ('uints', 'structs') else member.type)
+        for field, member in zip(fields, cls.members))
+
+    def __repr__(self):
+        return make_format(self, props)
+
+    cls._props = props
+    cls._source = source
+    # クラスに書いたメソッドから，生成したものを呼べるようにしておく
+    cls._generated = {name: namespace[name] for name in
+                      ('to_bytes', 'write_into', 'write_segments', '__len__')}
+    _define(cls, 'to_bytes', namespace['to_bytes'])
+    _define(cls, 'write_into', namespace['write_into'])
+    _define(cls, 'write_segments', namespace['write_segments'])
+    _define(cls, '__len__', namespace['__len__'])
+    _define(cls, '__repr__', __repr__)
+    _define(cls, 'set_args', namespace['set_args'])
+    if decodable:
+        _define(cls, '_decode', classmethod(namespace['_decode']))
+        _define(cls, 'from_bytes', classmethod(_from_bytes))
+    return cls
@@ -1,9 +1,9 @@
 
-__all__ = ['Struct', 'Members', 'Member', 'Listof']
+__all__ = ['Struct', 'StructMeta', 'Members', 'Member', 'Listof']
 
 import collections
 
-from .codec import Reader, Writer
+from .codec import Reader, Writer, SegmentWriter
 from .type import Uint, Type
 from .repr import make_format
 
@@ -24,7 +24,43 @@ from .repr import make_format
 
 # 全てのTLSの構造体はStructクラスを継承して、フィールドに self.struct を定義する。
 # self.struct には Members, Member, Listof を使ってTLS構造体の構造を記述する。
-class Struct:
+#
+# 構造がインスタンスごとに変わらないときは、代わりにクラス変数 members に書く。
+# クラスを作るときに members から to_bytes, __len__, from_bytes, set_args が
+# 生成される（compiler.py）。
+#
+#     class KeyShareEntry(Struct):
+#         members = [
+#             Member(NamedGroup, 'group'),
+#             Member(bytes, 'key_exchange', length_t=Uint16),
+#         ]
+#
+#         def __init__(self, **kwargs):
+#             self.set_args(**kwargs)
+#
+# クラス変数 members に書いたフィールドは __slots__ に入れて，インスタンスが __dict__ を
+# 持たないようにする。members 以外の属性を使うときはクラスに __slots__ を書き足す。
+# フィールドと同じ名前の property をクラスに書いたときは，そのフィールドのスロットは作らない。
+class StructMeta(type):
+    def __new__(mcls, name, bases, namespace, **kwargs):
+        if 'members' in namespace:
+            # property などでクラスに定義した名前はスロットにしない
+            slots = [member.name for member in namespace['members']
+                     if member.name not in namespace]
+            slots += [x for x in namespace.get('__slots__', ()) if x not in slots]
+            namespace['__slots__'] = tuple(slots)
+        return super().__new__(mcls, name, bases, namespace, **kwargs)
+
+
+class Struct(metaclass=StructMeta):
+    __slots__ = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'members' in cls.__dict__:
+            from .compiler import compile_struct
+            compile_struct(cls)
+
     def __repr__(self):
         props = self.struct.get_props()
         return make_format(self, props)
@@ -35,12 +71,33 @@ class Struct:
     def to_bytes(self):
         return self.struct.get_bytes()
 
+    # バッファ buf の offset の位置にバイト列を書き，書き終わった位置を返す．
+    # members から生成したクラスは，入れ子の構造体も含めて buf に直接書く．
+    def write_into(self, buf, offset):
+        data = self.to_bytes()
+        buf[offset:offset + len(data)] = data
+        return offset + len(data)
+
+    # SegmentWriter にバイト列を追加する．members から生成したクラスは，大きな
+    # バイト列のフィールドをコピーしないで writer に渡す．
+    def write_segments(self, writer):
+        writer.add_segment(self.to_bytes())
+
+    def to_segments(self):
+        """
+        バイト列を b''.join(segments) == self.to_bytes() となるバッファのリストで返す．
+        """
+        writer = SegmentWriter()
+        self.write_segments(writer)
+        return writer.get_segments()
+
 
 class Members:
     def __init__(self, obj, members=[]):
         self.obj = obj
         self.members = members
         self.members_default = {}
+        self.members_factory = {}
 
     # __init__のために引数をフィールドに設定するメソッド
     # 例えば次のように書くと、引数に与えられた extension_type と extension_data を
@@ -64,6 +121,11 @@ class Members:
     #         # このプログラムは以下と同じ
     #         #   self.extension_type = kwargs['extension_type'] or Uint16(0x0123)
     #
+    # 乱数などデフォルト値を作るのに手間がかかるときは，引数の無い関数を factory に渡す。
+    # factory は kwargs に値が無いときだけ呼ばれる。
+    #
+    #         self.struct.set_default('random', factory=lambda: secrets.token_bytes(32))
+    #
     def set_args(self, **kwargs):
         for member in self.members:
             key = member.name
@@ -71,14 +133,25 @@ class Members:
                 value = kwargs[key]
             elif key in self.members_default.keys():
                 value = self.members_default[key]
+            elif key in self.members_factory.keys():
+                value = self.members_factory[key]()
+            elif member.default_factory is not None:
+                value = member.default_factory()
+            elif member.default is not None:
+                value = member.default
+                if isinstance(member.type, Listof):
+                    value = list(value)
             else:
                 value = self._get_default_from_type(member.type)
 
             StructAssert.my_assert(member, value)
             setattr(self.obj, key, value)
 
-    def set_default(self, attr_name, default_value):
-        self.members_default[attr_name] = default_value
+    def set_default(self, attr_name, default_value=None, factory=None):
+        if factory is not None:
+            self.members_factory[attr_name] = factory
+        else:
+            self.members_default[attr_name] = default_value
 
     def _get_default_from_type(self, type):
         if isinstance(type, Listof):
@@ -164,23 +237,39 @@ class Members:
     def get_props_from_bytes(self, data):
         import inspect
         props = {}
-        reader = Reader(data)
+        reader = Reader(data, copy=True)
         for member in self.members:
             length_t = getattr(member, 'length_t', None)
             type = member.type
             if inspect.isclass(member.type) and issubclass(member.type, Type):
                 type = Uint.get_type(member.type._size)
-            value = reader.get(type, length_t=length_t)
+            value = reader.get(type, length_t=length_t,
+                               min_length=member.min_length,
+                               max_length=member.max_length)
             props[member.name] = value
 
         return props
 
 
+# 可変長のフィールドには RFC の <min..max> を min_length, max_length に書いておく。
+# デコードするときは長さを読んだところで範囲を調べ，範囲外なら値を作る前にエラーにする。
+# 構造体のリストは max_count で要素の数も制限できる（相手が送る大量の要素を作らないため）。
+#
+#     Member(bytes, 'legacy_session_id', length_t=Uint8, max_length=32)
+#     Member(Listof(KeyShareEntry), 'client_shares', length_t=Uint16, max_count=16)
+#
 class Member:
-    def __init__(self, type, name, length_t=None):
+    def __init__(self, type, name, length_t=None, default=None,
+                 default_factory=None, min_length=0, max_length=None,
+                 max_count=None):
         self.type = type # class
         self.name = name # str
         self.length_t = length_t # UintN
+        self.default = default # 引数が無いときの値
+        self.default_factory = default_factory # 引数が無いときに値を作る関数
+        self.min_length = min_length # バイト長の下限
+        self.max_length = max_length # バイト長の上限 (None は長さの型の上限)
+        self.max_count = max_count # リストの要素の数の上限
 
     def __repr__(self):
         return "<Member type={} name={} length_t={}>" \
@@ -50,8 +50,8 @@ def make_format(obj, props):
             repr_str += textwrap.indent(pprint.pformat(item), prefix="    ")
             if prop_type == list: repr_str += "\n"
         elif issubclass(prop_type, Type):
-            # TLSの定数のとき => 定数名を付けて表示
-            const_name = prop_type.label(item)
+            # TLSの定数のとき => 定数名を付けて表示（知らない値は unknown）
+            const_name = prop_type.labels().get(item, 'unknown')
             repr_str += "|%s: %s == %s\n" % (prop, item, const_name)
         elif issubclass(prop_type, Uint):
             # Uintのとき => 10進数に変換したものを付けて表示
@@ -1,13 +1,35 @@
-
 __all__ = ['Uint', 'Uint8', 'Uint16', 'Uint24', 'Uint32', 'Type']
 
 from struct import pack
 
 class Uint:
-    def __init__(self, value):
+    # Uint は値を変更しないので，同じ値のインスタンスは共有する（flyweight）．
+    # 0〜255 の値と Type の定数は UintN(x) を呼ぶと作っておいたインスタンスを返す．
+    # インスタンスは value だけを持ち，__dict__ を持たない．
+    __slots__ = ('value',)
+
+    # 作っておく小さい値の範囲
+    _interned_range = range(256)
+    _interned = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._interned = {}
+        for value in cls._interned_range:
+            cls._interned[value] = cls(value)
+
+    def __new__(cls, value):
+        obj = cls._interned.get(value)
+        if obj is not None and type(value) is int:
+            return obj
         assert type(value) is int
-        assert self.__class__ != Uint  # Uint is abstract class
-        self.value = value
+        assert cls != Uint  # Uint is abstract class
+        obj = super().__new__(cls)
+        obj.value = value
+        return obj
+
+    def __reduce__(self):
+        return (self.__class__, (self.value,))
 
     def __repr__(self):
         return "{}(0x{:0{width}x})" \
@@ -25,6 +47,13 @@ class Uint:
     def __eq__(self, other):
         return hasattr(other, 'value') and self.value == other.value
 
+    @staticmethod
+    def intern(obj):
+        """
+        obj を共有するインスタンスにして返す．既に同じ値のものがあればそれを返す．
+        """
+        return obj.__class__._interned.setdefault(obj.value, obj)
+
     @staticmethod
     def size(size):
         return Uint.get_type(size)
@@ -40,6 +69,7 @@ class Uint:
 
 class Uint8(Uint):
     """an unsigned byte"""
+    __slots__ = ()
     _size = 1
     def to_bytes(self):
         return pack('>B', self.value)
@@ -47,6 +77,7 @@ class Uint8(Uint):
 
 class Uint16(Uint):
     """ uint8 uint24[2]; """
+    __slots__ = ()
     _size = 2
     def to_bytes(self):
         return pack('>H', self.value)
@@ -54,6 +85,7 @@ class Uint16(Uint):
 
 class Uint24(Uint):
     """ uint8 uint24[3]; """
+    __slots__ = ()
     _size = 3
     def to_bytes(self):
         return pack('>BH', self.value >> 16, self.value & 0xffff)
@@ -61,6 +93,7 @@ class Uint24(Uint):
 
 class Uint32(Uint):
     """ uint8 uint32[4]; """
+    __slots__ = ()
     _size = 4
     def to_bytes(self):
         return pack('>I', self.value)
@@ -75,6 +108,15 @@ class Type:
     # また、 HandshakeType に values() が追加されると次のように
     # ある値が定数群の中に含まれているか確認することができる。
     #     self.msg_type in HandshakeType.values() # => True or False
+    #
+    # 定数は Uint の共有するインスタンスに登録するので，バイト列から読んだ Uint16(0x1301) は
+    # CipherSuite.TLS_AES_128_GCM_SHA256 と同じオブジェクトになる。
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name, value in list(cls.__dict__.items()):
+            if not name.startswith('_') and isinstance(value, Uint):
+                setattr(cls, name, Uint.intern(value))
 
     @classmethod
     def label(cls, value):
@@ -5,3 +5,5 @@ from .ciphersuite import *
 from .handshake import *
 from .recordlayer import *
 from .ticket import *
+from .keyupdate import *
+from .state import *
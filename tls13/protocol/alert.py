@@ -66,16 +66,10 @@ class Alert(Struct):
       AlertDescription description;
     } Alert;
     """
-    def __init__(self, **kwargs):
-        self.struct = Members(self, [
-            Member(AlertLevel, 'level'),
-            Member(AlertDescription, 'description'),
-        ])
-        self.struct.set_args(**kwargs)
+    members = [
+        Member(AlertLevel, 'level'),
+        Member(AlertDescription, 'description'),
+    ]
 
-    @classmethod
-    def from_bytes(cls, data):
-        reader = Reader(data)
-        level       = reader.get(Uint8)
-        description = reader.get(Uint8)
-        return cls(level=level, description=description)
+    def __init__(self, **kwargs):
+        self.set_args(**kwargs)
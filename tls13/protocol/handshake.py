@@ -5,6 +5,7 @@
 __all__ = ['HandshakeType', 'Handshake']
 
 from ..metastruct import *
+from ..metastruct.codec import ReaderParseError
 
 class HandshakeType(Type):
     """
@@ -49,42 +50,121 @@ class Handshake(Struct):
       };
     } Handshake;
     """
+    members = [
+        Member(HandshakeType, 'msg_type'),
+        Member(Uint24, 'length'),
+        Member(Struct, 'msg'),
+    ]
+    # from_bytes で作ったときは受信したバイト列を _raw に残しておき，
+    # msg は最初に参照されたときにデコードする（_body と _state はそのときに使う）
+    __slots__ = ('_msg', '_raw', '_body', '_state')
+    _decoders = None
+    # 受け取るハンドシェイクメッセージの本体の最大サイズ．長い証明書チェーンが入る
+    # 大きさにして，それより大きいメッセージは受信しきる前にエラーにする
+    max_message_size = 2**17
+
     def __init__(self, **kwargs):
-        msg = kwargs.get('msg', b'')
-        self.struct = Members(self, [
-            Member(HandshakeType, 'msg_type'),
-            Member(Uint24, 'length'),
-            Member(Struct, 'msg'),
-        ])
-        self.struct.set_default('legacy_record_version', Uint16(0x0303))
-        self.struct.set_default('length', Uint24(len(kwargs['msg'] or b'')))
-        self.struct.set_args(**kwargs)
-
-        assert self.msg_type in HandshakeType.values()
+        # length は msg を設定したときに計算する
+        self.set_args(**kwargs)
+
+    @property
+    def msg(self):
+        if self._msg is None and self._body is not None:
+            self._msg = self._decode_msg(self.msg_type, self._body, self._state)
+            self._body = self._state = None
+        return self._msg
+
+    @msg.setter
+    def msg(self, value):
+        # msg を置き換えたら受信したバイト列とは異なるので，次からはエンコードする
+        self._msg = value
+        self._raw = self._body = self._state = None
+        self.length = Uint24(len(value or b''))
+
+    @property
+    def raw(self):
+        """
+        from_bytes に与えたバイト列．msg を置き換えたときや自分で作ったときは None．
+        """
+        return self._raw
+
+    def to_bytes(self):
+        # 受信したメッセージはデコードもエンコードもしないで元のバイト列を返す．
+        # トランスクリプトハッシュには相手が送ったとおりのバイト列を使う必要がある
+        if self._raw is not None:
+            return self._raw
+        return self._generated['to_bytes'](self)
+
+    def write_into(self, buf, offset):
+        if self._raw is not None:
+            buf[offset:offset + len(self._raw)] = self._raw
+            return offset + len(self._raw)
+        return self._generated['write_into'](self, buf, offset)
+
+    def write_segments(self, writer):
+        if self._raw is not None:
+            writer.add_segment(self._raw)
+        else:
+            self._generated['write_segments'](self, writer)
+
+    def __len__(self):
+        if self._raw is not None:
+            return len(self._raw)
+        return self._generated['__len__'](self)
 
     @classmethod
-    def from_bytes(cls, data):
-        from .keyexchange.messages import ClientHello, ServerHello
-        from .keyexchange.serverparameters import EncryptedExtensions
-        from .keyexchange.authentication import Certificate, CertificateVerify,\
-            Finished
+    def from_bytes(cls, data, state=None):
         reader = Reader(data)
         msg_type = reader.get(Uint8)
         length   = reader.get(Uint24)
-        msg      = reader.get(bytes)
+        if length.value > cls.max_message_size:
+            raise RuntimeError("illegal_parameter: handshake message is too large "
+                               "(%d bytes)" % length.value)
+        if length.value != reader.get_rest_length():
+            raise ReaderParseError()
+        data = bytes(data)
+        msg = memoryview(data)[4:]
 
-        assert length.value == len(msg)
+        if not msg_type in cls._get_decoders():
+            raise NotImplementedError()
+        self = cls.__new__(cls)
+        self.msg_type = msg_type
+        self.length = length
+        self._msg = None
+        self._raw = data
+        self._body = msg
+        # Finished の長さは接続のハッシュ長で決まる
+        self._state = state if msg_type == HandshakeType.finished else None
+        return self
 
-        from_bytes_mapper = {
+    @classmethod
+    def _get_decoders(cls):
+        # msg_type から msg の from_bytes を引く表．各メッセージのモジュールは
+        # handshake を import するので，最初に使うときに1回だけ作る
+        if Handshake._decoders is not None:
+            return Handshake._decoders
+        from .keyexchange.messages import ClientHello, ServerHello
+        from .keyexchange.serverparameters import EncryptedExtensions
+        from .keyexchange.authentication import Certificate, CertificateVerify,\
+            Finished
+        from .ticket import NewSessionTicket
+        from .keyupdate import EndOfEarlyData, KeyUpdate
+        Handshake._decoders = {
             HandshakeType.client_hello         : ClientHello.from_bytes,
             HandshakeType.server_hello         : ServerHello.from_bytes,
             HandshakeType.encrypted_extensions : EncryptedExtensions.from_bytes,
             HandshakeType.certificate          : Certificate.from_bytes,
             HandshakeType.certificate_verify   : CertificateVerify.from_bytes,
             HandshakeType.finished             : Finished.from_bytes,
+            HandshakeType.new_session_ticket   : NewSessionTicket.from_bytes,
+            HandshakeType.end_of_early_data    : EndOfEarlyData.from_bytes,
+            HandshakeType.key_update           : KeyUpdate.from_bytes,
         }
+        return Handshake._decoders
 
-        if not msg_type in from_bytes_mapper.keys():
-            raise NotImplementedError()
-        from_bytes = from_bytes_mapper[msg_type]
-        return cls(msg_type=msg_type, msg=from_bytes(msg))
+    @classmethod
+    def _decode_msg(cls, msg_type, body, state):
+        from_bytes = cls._get_decoders()[msg_type]
+        if msg_type == HandshakeType.finished:
+            return from_bytes(body, state=state)
+        return from_bytes(body)
@@ -37,12 +37,13 @@ class CertificateEntry(Struct):
       Extension extensions<0..2^16-1>;
     } CertificateEntry;
     """
+    members = [
+        Member(bytes, 'cert_data', length_t=Uint24, min_length=1),
+        Member(Listof(Extension), 'extensions', length_t=Uint16),
+    ]
+
     def __init__(self, **kwargs):
-        self.struct = Members(self, [
-            Member(bytes, 'cert_data', length_t=Uint24),
-            Member(Listof(Extension), 'extensions', length_t=Uint16),
-        ])
-        self.struct.set_args(**kwargs)
+        self.set_args(**kwargs)
 
     @classmethod
     def from_bytes(cls, data=b'', reader=None):
@@ -50,7 +51,7 @@ class CertificateEntry(Struct):
         if not is_given_reader:
             reader = Reader(data)
 
-        cert_data  = reader.get(bytes, length_t=Uint24)
+        cert_data  = reader.get(bytes, length_t=Uint24, copy=True, min_length=1)
         extensions = reader.get(bytes, length_t=Uint16)
 
         # extensions に入る拡張は status_request か signed_certificate_timestamp
@@ -70,18 +71,18 @@ class Certificate(Struct):
       CertificateEntry certificate_list<0..2^24-1>;
     } Certificate;
     """
+    members = [
+        Member(bytes, 'certificate_request_context', length_t=Uint8, default=b''),
+        Member(Listof(CertificateEntry), 'certificate_list', length_t=Uint24),
+    ]
+
     def __init__(self, **kwargs):
-        self.struct = Members(self, [
-            Member(bytes, 'certificate_request_context', length_t=Uint8),
-            Member(Listof(CertificateEntry), 'certificate_list', length_t=Uint24),
-        ])
-        self.struct.set_default('certificate_request_context', b'')
-        self.struct.set_args(**kwargs)
+        self.set_args(**kwargs)
 
     @classmethod
     def from_bytes(cls, data):
         reader = Reader(data)
-        certificate_request_context = reader.get(bytes, length_t=Uint8)
+        certificate_request_context = reader.get(bytes, length_t=Uint8, copy=True)
         certificate_list_bytes = reader.get(bytes, length_t=Uint24)
         certificate_list = []
 
@@ -102,27 +103,19 @@ class CertificateVerify(Struct):
       opaque signature<0..2^16-1>;
     } CertificateVerify;
     """
-    def __init__(self, **kwargs):
-        self.struct = Members(self, [
-            Member(SignatureScheme, 'algorithm'),
-            Member(bytes, 'signature', length_t=Uint16),
-        ])
-        self.struct.set_args(**kwargs)
+    members = [
+        Member(SignatureScheme, 'algorithm'),
+        Member(bytes, 'signature', length_t=Uint16),
+    ]
 
-    @classmethod
-    def from_bytes(cls, data):
-        reader = Reader(data)
-        algorithm = reader.get(Uint16)
-        signature = reader.get(bytes, length_t=Uint16)
-        return cls(algorithm=algorithm, signature=signature)
+    def __init__(self, **kwargs):
+        self.set_args(**kwargs)
 
 
 class Hash(bytes):
-    _size = 32
-
-    @classmethod
-    def set_size(cls, size):
-        cls._size = size
+    # Hash.length は暗号スイートによって変わるので固定の _size を持たない．
+    # 長さは接続ごとの ConnectionState.hash_size で決める
+    pass
 
 
 class Finished(Struct):
@@ -132,16 +125,21 @@ class Finished(Struct):
       opaque verify_data[Hash.length];
     } Finished;
     """
+    members = [
+        Member(Hash, 'verify_data'),
+    ]
+
     def __init__(self, **kwargs):
-        self.struct = Members(self, [
-            Member(Hash, 'verify_data'),
-        ])
-        self.struct.set_args(**kwargs)
+        self.set_args(**kwargs)
 
     @classmethod
-    def from_bytes(cls, data):
+    def from_bytes(cls, data, state=None):
         reader = Reader(data)
-        verify_data = reader.get(Hash)
+        verify_data = reader.get_rest(copy=True)
+        if state is not None and state.hash_size is not None and \
+           len(verify_data) != state.hash_size:
+            raise RuntimeError("decode_error: verify_data must be %d bytes" %
+                               state.hash_size)
         return cls(verify_data=verify_data)
 
     # TODO: ハッシュの求め方
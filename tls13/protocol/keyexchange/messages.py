@@ -7,19 +7,25 @@ __all__ = [
     'KeyShareEntry', 'KeyShareClientHello', 'KeyShareHelloRetryRequest',
     'KeyShareServerHello', 'UncompressedPointRepresentation',
     'PskKeyExchangeMode', 'PskKeyExchangeModes', 'Empty', 'EarlyDataIndication',
-    'PskIdentity', 'OfferedPsks', 'PreSharedKeyExtension'
+    'PskIdentity', 'PskBinderEntry', 'OfferedPsks', 'PreSharedKeyExtension',
+    'RecordSizeLimit',
 ]
 
-import sys
 import secrets
-import collections
-from .supportedgroups import NamedGroup
-from .version import ProtocolVersion
+import collections.abc
+from .supportedgroups import NamedGroup, NamedGroupList
+from .signature import SignatureSchemeList
+from .version import ProtocolVersion, SupportedVersions
+from ..handshake import HandshakeType
 from ..ciphersuite import CipherSuite
 from ...metastruct import *
+from ...metastruct.codec import ReaderParseError
+from ...utils.trace import tracer, INFO
+
+_trace = tracer.category('extension')
 
 def find(lst, cond):
-    assert isinstance(lst, collections.Iterable)
+    assert isinstance(lst, collections.abc.Iterable)
     return next((x for x in lst if cond(x)), None)
 
 
@@ -28,110 +34,70 @@ class Random(bytes):
     _size = 32
 
 
+def _random32():
+    # random と legacy_session_id のデフォルト値．from_bytes では呼ばれない
+    return secrets.token_bytes(32)
+
+
 class HasExtension:
     """
     Mixin class HasExtension implements common operation about extension.
     """
+    # from_bytes で作ったメッセージは extension_type から拡張を引く辞書を持つ
+    __slots__ = ('_extension_index',)
+
     def get_extension(self, extension_type):
         assert extension_type in ExtensionType.values()
-        ext = find(self.extensions, lambda ext: ext.extension_type == extension_type)
+        index = getattr(self, '_extension_index', None)
+        if index is None:
+            ext = find(self.extensions,
+                       lambda ext: ext.extension_type == extension_type)
+        else:
+            ext = index.get(extension_type)
         return getattr(ext, 'extension_data', None)
 
+    def index_extensions(self):
+        """
+        extensions から extension_type で引く辞書を作る．同じ種類の拡張が
+        複数あるときは最初のものを使う．作った後は extensions を変更しないこと．
+        """
+        index = {}
+        for ext in self.extensions:
+            index.setdefault(ext.extension_type, ext)
+        self._extension_index = index
+        return self
 
-class ClientHello(Struct, HasExtension):
-    """
-    struct {
-      ProtocolVersion legacy_version = 0x0303;    /* TLS v1.2 */
-      Random random;
-      opaque legacy_session_id<0..32>;
-      CipherSuite cipher_suites<2..2^16-2>;
-      opaque legacy_compression_methods<1..2^8-1>;
-      Extension extensions<8..2^16-1>;
-    } ClientHello;
-    """
-    def __init__(self, **kwargs):
-        self.struct = Members(self, [
-            Member(ProtocolVersion, 'legacy_version'),
-            Member(Random, 'random'),
-            Member(bytes, 'legacy_session_id', length_t=Uint8),
-            Member(Listof(CipherSuite), 'cipher_suites', length_t=Uint16),
-            Member(Listof(Uint8), 'legacy_compression_methods', length_t=Uint8),
-            Member(Listof(Extension), 'extensions', length_t=Uint16),
-        ])
-        self.struct.set_default('legacy_version', Uint16(0x0303))
-        self.struct.set_default('random', secrets.token_bytes(32))
-        self.struct.set_default('legacy_session_id', secrets.token_bytes(32))
-        self.struct.set_default('legacy_compression_methods', [Uint8(0x00)])
-        self.struct.set_args(**kwargs)
-
-    @classmethod
-    def from_bytes(cls, data):
-        from ..handshake import HandshakeType
-        reader = Reader(data)
-        legacy_version    = reader.get(Uint16)
-        random            = reader.get(Random)
-        legacy_session_id = reader.get(bytes, length_t=Uint8)
-        cipher_suites = reader.get(Listof(CipherSuite), length_t=Uint16)
-        legacy_compression_methods = reader.get(Listof(Uint8), length_t=Uint8)
 
-        # Read extensions
-        extensions = Extension.get_list_from_bytes(
-            reader.get_rest(),
-            msg_type=HandshakeType.client_hello)
-
-        return cls(legacy_version=legacy_version,
-                   random=random,
-                   legacy_session_id=legacy_session_id,
-                   cipher_suites=cipher_suites,
-                   extensions=extensions)
-
-
-class ServerHello(Struct, HasExtension):
+class ExtensionType(Type):
     """
-    struct {
-      ProtocolVersion legacy_version = 0x0303;    /* TLS v1.2 */
-      Random random;
-      opaque legacy_session_id_echo<0..32>;
-      CipherSuite cipher_suite;
-      uint8 legacy_compression_method = 0;
-      Extension extensions<6..2^16-1>;
-    } ServerHello;
+    enum { ... } ExtensionType
     """
-    def __init__(self, **kwargs):
-        self.struct = Members(self, [
-            Member(ProtocolVersion, 'legacy_version'),
-            Member(Random, 'random'),
-            Member(bytes, 'legacy_session_id_echo', length_t=Uint8),
-            Member(CipherSuite, 'cipher_suite'),
-            Member(Uint8, 'legacy_compression_method'),
-            Member(Listof(Extension), 'extensions', length_t=Uint16),
-        ])
-        self.struct.set_default('legacy_version', Uint16(0x0303))
-        self.struct.set_default('random', secrets.token_bytes(32))
-        self.struct.set_default('legacy_session_id_echo', secrets.token_bytes(32))
-        self.struct.set_default('legacy_compression_method', Uint8(0x00))
-        self.struct.set_args(**kwargs)
-
-    @classmethod
-    def from_bytes(cls, data):
-        from ..handshake import HandshakeType
-        reader = Reader(data)
-        legacy_version             = reader.get(Uint16)
-        random                     = reader.get(Random)
-        legacy_session_id_echo     = reader.get(bytes, length_t=Uint8)
-        cipher_suite               = reader.get(Uint16)
-        legacy_compression_methods = reader.get(Uint8)
-
-        # Read extensions
-        extensions = Extension.get_list_from_bytes(
-            reader.get_rest(),
-            msg_type=HandshakeType.server_hello)
-
-        return cls(legacy_version=legacy_version,
-                   random=random,
-                   legacy_session_id_echo=legacy_session_id_echo,
-                   cipher_suite=cipher_suite,
-                   extensions=extensions)
+    server_name = Uint16(0)
+    max_fragment_length = Uint16(1)
+    status_request = Uint16(5)
+    supported_groups = Uint16(10)
+    signature_algorithms = Uint16(13)
+    use_srtp = Uint16(14)
+    heartbeat = Uint16(15)
+    application_layer_protocol_negotiation = Uint16(16)
+    signed_certificate_timestamp = Uint16(18)
+    client_certificate_type = Uint16(19)
+    server_certificate_type = Uint16(20)
+    padding = Uint16(21)
+    record_size_limit = Uint16(28)
+    RESERVED = Uint16(40)
+    pre_shared_key = Uint16(41)
+    early_data = Uint16(42)
+    supported_versions = Uint16(43)
+    cookie = Uint16(44)
+    psk_key_exchange_modes = Uint16(45)
+    RESERVED = Uint16(46)
+    certificate_authorities = Uint16(47)
+    oid_filters = Uint16(48)
+    post_handshake_auth = Uint16(49)
+    signature_algorithms_cert = Uint16(50)
+    key_share = Uint16(51)
+    _size = 2 # byte
 
 
 class Extension(Struct):
@@ -141,12 +107,13 @@ class Extension(Struct):
       opaque extension_data<0..2^16-1>;
     } Extension;
     """
+    members = [
+        Member(ExtensionType, 'extension_type'),
+        Member(Struct, 'extension_data', length_t=Uint16),
+    ]
+
     def __init__(self, **kwargs):
-        self.struct = Members(self, [
-            Member(ExtensionType, 'extension_type'),
-            Member(Struct, 'extension_data', length_t=Uint16),
-        ])
-        self.struct.set_args(**kwargs)
+        self.set_args(**kwargs)
 
     @classmethod
     def from_bytes(cls, data=b'', msg_type=None, reader=None):
@@ -159,7 +126,8 @@ class Extension(Struct):
 
         ExtClass, kwargs = cls.get_extension_class(extension_type, msg_type)
         if ExtClass is None:
-            obj = None
+            # 知らない拡張は中身をバイト列のまま持っておく
+            obj = cls.raw(extension_type, bytes(extension_data))
         else:
             obj = cls(
                 extension_type=extension_type,
@@ -169,99 +137,166 @@ class Extension(Struct):
             return (obj, reader)
         return obj
 
+    # 1つのメッセージで受け取る拡張の数の上限．同じ種類の拡張は1つまで (4.2) なので，
+    # これより多いときは拡張のクラスで中身をデコードする前にエラーにする
+    max_extensions = 64
+
     # バイト列から再構築するときにそれぞれの拡張を配列に入れて返す関数。
     # ClientHello や ServerHello などのあらゆるメッセージでは拡張は複数あり、
     # それぞれの拡張のバイト長は異なるので、他の from_bytes のように実装は簡単ではない。
+    # min_length, max_length は extensions<min..max> のバイト長の範囲。
     @classmethod
-    def get_list_from_bytes(cls, data, msg_type=None):
+    def get_list_from_bytes(cls, data, msg_type=None, min_length=0, max_length=None):
         reader = Reader(data)
         extensions = []
         extensions_length = reader.get(2)
-        assert extensions_length == reader.get_rest_length()
+        if extensions_length != reader.get_rest_length():
+            raise ReaderParseError()
+        Reader._check_limits(extensions_length, min_length, max_length)
 
         # Read extensions
         while reader.get_rest_length() != 0:
+            if len(extensions) == cls.max_extensions:
+                raise ReaderParseError()
             ext, reader = cls.from_bytes(reader=reader, msg_type=msg_type)
-            if ext is None: continue
             extensions.append(ext)
 
         return extensions
 
+    @classmethod
+    def raw(cls, extension_type, extension_data):
+        """
+        extension_data をデコードしないでバイト列のまま持つ拡張を作る．
+        extension_type は ExtensionType に無い値でもよい．
+        """
+        obj = cls.__new__(cls)
+        obj.extension_type = extension_type
+        obj.extension_data = extension_data
+        return obj
+
     # 拡張の種類 extension_type から、それを構成するためのクラス ExtClass と kwargs を返す。
     # 辞書型 kwargs には、ExtClass.from_bytes を行うときにどちらの通信なのかを
     # 引数に与える必要がある場合、必要な引数を kwargs に入れて返す。
     # いくつかのクラスは client_hello か server_hello によって構造体の中身が変わるので、
     # どちらの通信なのかを引数 msg_type に設定する必要がある可能性がある。
     # もし必要なのに引数 msg_type が設定されていないときは RuntimeError を出す。
+    # 知らない拡張のときは (None, None) を返す。
     @classmethod
     def get_extension_class(self, extension_type, msg_type=None):
-        from ..handshake import HandshakeType
-        from .version import SupportedVersions
-        from .supportedgroups import NamedGroupList
-        from .signature import SignatureSchemeList
+        entry = _extension_classes.get((extension_type, msg_type)) or \
+            _extension_classes.get((extension_type, None))
+        if entry is None:
+            if extension_type in _msg_type_required:
+                raise RuntimeError("must be set msg_type to get_extension_class()")
+            if _trace.info:
+                output = 'unknown extension: %s' % extension_type
+                if extension_type in ExtensionType.labels():
+                    output += ' == %s' % ExtensionType.label(extension_type)
+                _trace.log(INFO, output)
+            return (None, None)
 
-        ExtClass = None
-        kwargs = {}
+        ExtClass, with_msg_type = entry
+        if not with_msg_type:
+            return (ExtClass, {})
+        if msg_type is None:
+            raise RuntimeError("must be set msg_type to get_extension_class()")
+        return (ExtClass, {'msg_type': msg_type})
 
-        if extension_type == ExtensionType.supported_versions:
-            if msg_type is None:
-                raise RuntimeError("must be set msg_type to get_extension_class()")
-            ExtClass = SupportedVersions
-            kwargs = {'msg_type': msg_type}
 
-        elif extension_type == ExtensionType.supported_groups:
-            ExtClass = NamedGroupList
+class ClientHello(Struct, HasExtension):
+    """
+    struct {
+      ProtocolVersion legacy_version = 0x0303;    /* TLS v1.2 */
+      Random random;
+      opaque legacy_session_id<0..32>;
+      CipherSuite cipher_suites<2..2^16-2>;
+      opaque legacy_compression_methods<1..2^8-1>;
+      Extension extensions<8..2^16-1>;
+    } ClientHello;
+    """
+    members = [
+        Member(ProtocolVersion, 'legacy_version', default=Uint16(0x0303)),
+        Member(Random, 'random', default_factory=_random32),
+        Member(bytes, 'legacy_session_id', length_t=Uint8,
+               default_factory=_random32, max_length=32),
+        Member(Listof(CipherSuite), 'cipher_suites', length_t=Uint16,
+               min_length=2, max_length=2**16-2),
+        Member(Listof(Uint8), 'legacy_compression_methods', length_t=Uint8,
+               default=[Uint8(0x00)], min_length=1),
+        Member(Listof(Extension), 'extensions', length_t=Uint16, min_length=8),
+    ]
 
-        elif extension_type == ExtensionType.signature_algorithms:
-            ExtClass = SignatureSchemeList
+    def __init__(self, **kwargs):
+        self.set_args(**kwargs)
 
-        elif extension_type == ExtensionType.key_share:
-            if msg_type == HandshakeType.client_hello:
-                ExtClass = KeyShareClientHello
-            elif msg_type == HandshakeType.server_hello:
-                ExtClass = KeyShareServerHello
-            else:
-                raise RuntimeError("must be set msg_type to get_extension_class()")
+    @classmethod
+    def from_bytes(cls, data):
+        reader = Reader(data)
+        legacy_version    = reader.get(Uint16)
+        random            = reader.get(Random, copy=True)
+        legacy_session_id = reader.get(bytes, length_t=Uint8, copy=True,
+                                       max_length=32)
+        cipher_suites = reader.get(Listof(CipherSuite), length_t=Uint16,
+                                   min_length=2, max_length=2**16-2)
+        legacy_compression_methods = reader.get(Listof(Uint8), length_t=Uint8,
+                                                min_length=1)
 
-        else:
-            output = 'Extension: unknown extension: %s' % extension_type
-            if extension_type in ExtensionType.labels():
-                output += ' == %s' % ExtensionType.label(extension_type)
-            print(output, file=sys.stdout)
-            return (None, None)
+        # Read extensions
+        extensions = Extension.get_list_from_bytes(
+            reader.get_rest(),
+            msg_type=HandshakeType.client_hello, min_length=8)
 
-        return (ExtClass, kwargs)
+        return cls(legacy_version=legacy_version,
+                   random=random,
+                   legacy_session_id=legacy_session_id,
+                   cipher_suites=cipher_suites,
+                   extensions=extensions).index_extensions()
 
 
-class ExtensionType(Type):
+class ServerHello(Struct, HasExtension):
     """
-    enum { ... } ExtensionType
+    struct {
+      ProtocolVersion legacy_version = 0x0303;    /* TLS v1.2 */
+      Random random;
+      opaque legacy_session_id_echo<0..32>;
+      CipherSuite cipher_suite;
+      uint8 legacy_compression_method = 0;
+      Extension extensions<6..2^16-1>;
+    } ServerHello;
     """
-    server_name = Uint16(0)
-    max_fragment_length = Uint16(1)
-    status_request = Uint16(5)
-    supported_groups = Uint16(10)
-    signature_algorithms = Uint16(13)
-    use_srtp = Uint16(14)
-    heartbeat = Uint16(15)
-    application_layer_protocol_negotiation = Uint16(16)
-    signed_certificate_timestamp = Uint16(18)
-    client_certificate_type = Uint16(19)
-    server_certificate_type = Uint16(20)
-    padding = Uint16(21)
-    RESERVED = Uint16(40)
-    pre_shared_key = Uint16(41)
-    early_data = Uint16(42)
-    supported_versions = Uint16(43)
-    cookie = Uint16(44)
-    psk_key_exchange_modes = Uint16(45)
-    RESERVED = Uint16(46)
-    certificate_authorities = Uint16(47)
-    oid_filters = Uint16(48)
-    post_handshake_auth = Uint16(49)
-    signature_algorithms_cert = Uint16(50)
-    key_share = Uint16(51)
-    _size = 2 # byte
+    members = [
+        Member(ProtocolVersion, 'legacy_version', default=Uint16(0x0303)),
+        Member(Random, 'random', default_factory=_random32),
+        Member(bytes, 'legacy_session_id_echo', length_t=Uint8,
+               default_factory=_random32, max_length=32),
+        Member(CipherSuite, 'cipher_suite'),
+        Member(Uint8, 'legacy_compression_method', default=Uint8(0x00)),
+        Member(Listof(Extension), 'extensions', length_t=Uint16, min_length=6),
+    ]
+
+    def __init__(self, **kwargs):
+        self.set_args(**kwargs)
+
+    @classmethod
+    def from_bytes(cls, data):
+        reader = Reader(data)
+        legacy_version             = reader.get(Uint16)
+        random                     = reader.get(Random, copy=True)
+        legacy_session_id_echo     = reader.get(bytes, length_t=Uint8, copy=True,
+                                                max_length=32)
+        cipher_suite               = reader.get(Uint16)
+        legacy_compression_methods = reader.get(Uint8)
+
+        # Read extensions
+        extensions = Extension.get_list_from_bytes(
+            reader.get_rest(),
+            msg_type=HandshakeType.server_hello, min_length=6)
+
+        return cls(legacy_version=legacy_version,
+                   random=random,
+                   legacy_session_id_echo=legacy_session_id_echo,
+                   cipher_suite=cipher_suite,
+                   extensions=extensions).index_extensions()
 
 
 class KeyShareEntry(Struct):
@@ -271,26 +306,13 @@ class KeyShareEntry(Struct):
       opaque key_exchange<1..2^16-1>;
     } KeyShareEntry;
     """
-    def __init__(self, **kwargs):
-        self.struct = Members(self, [
-            Member(NamedGroup, 'group'),
-            Member(bytes, 'key_exchange', length_t=Uint16),
-        ])
-        self.struct.set_args(**kwargs)
+    members = [
+        Member(NamedGroup, 'group'),
+        Member(bytes, 'key_exchange', length_t=Uint16, min_length=1),
+    ]
 
-    @classmethod
-    def from_bytes(cls, data=b'', reader=None):
-        is_given_reader = bool(reader)
-        if not is_given_reader:
-            reader = Reader(data)
-
-        group = reader.get(Uint16)
-        key_exchange = reader.get(bytes, length_t=Uint16)
-        obj = cls(group=group, key_exchange=key_exchange)
-
-        if is_given_reader:
-            return (obj, reader)
-        return obj
+    def __init__(self, **kwargs):
+        self.set_args(**kwargs)
 
 
 class KeyShareClientHello(Struct):
@@ -299,26 +321,14 @@ class KeyShareClientHello(Struct):
       KeyShareEntry client_shares<0..2^16-1>;
     } KeyShareClientHello;
     """
-    def __init__(self, **kwargs):
-        self.struct = Members(self, [
-            Member(Listof(KeyShareEntry), 'client_shares', length_t=Uint16),
-        ])
-        self.struct.set_args(**kwargs)
-
-    @classmethod
-    def from_bytes(cls, data):
-        reader = Reader(data)
-
-        # Read client_shares
-        client_shares = []
-        client_shares_length = reader.get(2)
-        assert client_shares_length == reader.get_rest_length()
-
-        while reader.get_rest_length() != 0:
-            entry, reader = KeyShareEntry.from_bytes(reader=reader)
-            client_shares.append(entry)
+    members = [
+        # 同じグループの鍵は1つまで (4.2.8) なので，グループの数より多くは受け取らない
+        Member(Listof(KeyShareEntry), 'client_shares', length_t=Uint16,
+               max_count=16),
+    ]
 
-        return cls(client_shares=client_shares)
+    def __init__(self, **kwargs):
+        self.set_args(**kwargs)
 
     def get_groups(self):
         return [client_share.group for client_share in self.client_shares]
@@ -346,18 +356,14 @@ class KeyShareServerHello(Struct):
       KeyShareEntry server_share;
     } KeyShareServerHello;
     """
+    members = [
+        Member(KeyShareEntry, 'server_share'),
+    ]
+
     def __init__(self, server_share):
         self.server_share = server_share
         assert isinstance(self.server_share, KeyShareEntry)
 
-        self.struct = Members(self, [
-            Member(KeyShareEntry, 'server_share'),
-        ])
-
-    @classmethod
-    def from_bytes(cls, data):
-        return cls(server_share=KeyShareEntry.from_bytes(data))
-
     def get_group(self):
         return self.server_share.group
 
@@ -384,23 +390,29 @@ class PskKeyExchangeMode(Type):
     _size = 1
 
 
-class PskKeyExchangeModes:
+class PskKeyExchangeModes(Struct):
     """
     struct {
       PskKeyExchangeMode ke_modes<1..255>;
     } PskKeyExchangeModes;
     """
-    def __init__(self, ke_modes=[]):
-        self.ke_modes = ke_modes
+    members = [
+        Member(Listof(PskKeyExchangeMode), 'ke_modes', length_t=Uint8,
+               min_length=1),
+    ]
+
+    def __init__(self, **kwargs):
+        self.set_args(**kwargs)
 
 
-class Empty:
+class Empty(Struct):
     """
     struct {} Empty;
     """
+    members = []
 
 
-class EarlyDataIndication:
+class EarlyDataIndication(Struct):
     """
     struct {
       select (Handshake.msg_type) {
@@ -410,33 +422,78 @@ class EarlyDataIndication:
       };
     } EarlyDataIndication;
     """
-    def __init__(self, msg_type, max_early_data_size=Empty()):
-        assert msg_type in HandshakeType.values
+    def __init__(self, msg_type, **kwargs):
         self.msg_type = msg_type
-        self.max_early_data_size = max_early_data_size
-        if msg_type == Handshake.new_session_ticket:
-            assert type(max_early_data_size) == Uint32
+        if self.msg_type == HandshakeType.new_session_ticket:
+            members = [Member(Uint32, 'max_early_data_size')]
+        elif self.msg_type in (HandshakeType.client_hello,
+                               HandshakeType.encrypted_extensions):
+            members = []
+        else:
+            raise RuntimeError("Unkown message type: %s" % msg_type)
 
+        self.struct = Members(self, members)
+        self.struct.set_args(**kwargs)
 
-class PskIdentity:
+    @classmethod
+    def from_bytes(cls, data, msg_type):
+        reader = Reader(data)
+        if msg_type == HandshakeType.new_session_ticket:
+            max_early_data_size = reader.get(Uint32)
+            return cls(msg_type=msg_type, max_early_data_size=max_early_data_size)
+        return cls(msg_type=msg_type)
+
+
+class PskIdentity(Struct):
     """
     struct {
       opaque identity<1..2^16-1>;
       uint32 obfuscated_ticket_age;
     } PskIdentity;
     """
+    members = [
+        Member(bytes, 'identity', length_t=Uint16, min_length=1),
+        Member(Uint32, 'obfuscated_ticket_age', default=Uint32(0)),
+    ]
+
+    def __init__(self, **kwargs):
+        self.set_args(**kwargs)
+
+
+class PskBinderEntry(Struct):
+    """
+    opaque PskBinderEntry<32..255>;
+    """
+    members = [
+        Member(bytes, 'binder', length_t=Uint8, min_length=32),
+    ]
+
+    def __init__(self, **kwargs):
+        self.set_args(**kwargs)
 
 
-class OfferedPsks:
+class OfferedPsks(Struct):
     """
     struct {
       PskIdentity identities<7..2^16-1>;
       PskBinderEntry binders<33..2^16-1>;
     } OfferedPsks;
     """
+    members = [
+        Member(Listof(PskIdentity), 'identities', length_t=Uint16, min_length=7),
+        Member(Listof(PskBinderEntry), 'binders', length_t=Uint16, min_length=33),
+    ]
 
+    def __init__(self, **kwargs):
+        self.set_args(**kwargs)
 
-class PreSharedKeyExtension:
+    def get_binders_length(self):
+        # ClientHello の末尾にある binders のバイト長（長さフィールドの2byteを含む）。
+        # binder の計算では ClientHello からこの長さだけ取り除いたものを使う。
+        return 2 + sum(map(len, self.binders))
+
+
+class PreSharedKeyExtension(Struct):
     """
     struct {
       select (Handshake.msg_type) {
@@ -445,3 +502,81 @@ class PreSharedKeyExtension:
       };
     } PreSharedKeyExtension;
     """
+    def __init__(self, msg_type, **kwargs):
+        self.msg_type = msg_type
+        if self.msg_type == HandshakeType.client_hello:
+            member = Member(OfferedPsks, 'offered_psks')
+        elif self.msg_type == HandshakeType.server_hello:
+            member = Member(Uint16, 'selected_identity')
+        else:
+            raise RuntimeError("Unkown message type: %s" % msg_type)
+
+        self.struct = Members(self, [member])
+        self.struct.set_args(**kwargs)
+
+    @classmethod
+    def from_bytes(cls, data, msg_type):
+        reader = Reader(data)
+        if msg_type == HandshakeType.client_hello:
+            offered_psks = OfferedPsks.from_bytes(reader.get_rest())
+            return cls(msg_type=msg_type, offered_psks=offered_psks)
+        elif msg_type == HandshakeType.server_hello:
+            selected_identity = reader.get(Uint16)
+            return cls(msg_type=msg_type, selected_identity=selected_identity)
+        else:
+            raise RuntimeError("Unkown message type: %s" % msg_type)
+
+
+class RecordSizeLimit(Struct):
+    """
+    uint16 RecordSizeLimit;  (RFC 8449)
+
+    相手に送ってよい保護されたレコードの平文（TLSInnerPlaintext の content type と
+    padding を含む）の最大サイズ．64 未満の値は illegal_parameter になる．
+    """
+    # TLS 1.3 の TLSInnerPlaintext の最大サイズ (2^14 + content type 1 byte)
+    max_limit = 2**14 + 1
+    min_limit = 64
+
+    members = [
+        Member(Uint16, 'record_size_limit'),
+    ]
+
+    def __init__(self, **kwargs):
+        self.set_args(**kwargs)
+
+    @classmethod
+    def from_bytes(cls, data):
+        reader = Reader(data)
+        record_size_limit = reader.get(Uint16)
+        if record_size_limit.value < cls.min_limit:
+            raise RuntimeError("illegal_parameter: record_size_limit %d" %
+                               record_size_limit.value)
+        return cls(record_size_limit=record_size_limit)
+
+    def get_max_fragment_size(self) -> int:
+        """
+        相手に送る TLSInnerPlaintext.content の最大サイズを返す．
+        プロトコルの上限より大きい値のときはプロトコルの上限を使う．
+        """
+        return min(self.record_size_limit.value, self.max_limit) - 1
+
+
+# (extension_type, msg_type) から (拡張のクラス, from_bytes に msg_type を渡すか) を引く表。
+# msg_type によらない拡張は msg_type を None で登録する。
+_extension_classes = {
+    (ExtensionType.supported_versions, None): (SupportedVersions, True),
+    (ExtensionType.supported_groups, None): (NamedGroupList, False),
+    (ExtensionType.signature_algorithms, None): (SignatureSchemeList, False),
+    (ExtensionType.key_share, HandshakeType.client_hello):
+        (KeyShareClientHello, False),
+    (ExtensionType.key_share, HandshakeType.server_hello):
+        (KeyShareServerHello, False),
+    (ExtensionType.psk_key_exchange_modes, None): (PskKeyExchangeModes, False),
+    (ExtensionType.pre_shared_key, None): (PreSharedKeyExtension, True),
+    (ExtensionType.early_data, None): (EarlyDataIndication, True),
+    (ExtensionType.record_size_limit, None): (RecordSizeLimit, False),
+}
+
+# msg_type が無いとクラスが決まらない拡張
+_msg_type_required = {ExtensionType.key_share}
@@ -7,7 +7,7 @@ __all__ = [
     'PostHandshakeAuth', 'EncryptedExtensions', 'CertificateRequest',
 ]
 
-from .messages import Extension
+from .messages import Extension, HasExtension
 from ...metastruct import *
 
 class CertificateAuthoritiesExtension:
@@ -26,31 +26,29 @@ class PostHandshakeAuth:
     pass
 
 
-class EncryptedExtensions(Struct):
+class EncryptedExtensions(Struct, HasExtension):
     """
     struct {
       Extension extensions<0..2^16-1>;
     } EncryptedExtensions;
     """
+    members = [
+        Member(Listof(Extension), 'extensions', length_t=Uint16),
+    ]
+
     def __init__(self, extensions):
         self.extensions = extensions
 
-        self.struct = Members(self, [
-            Member(Listof(Extension), 'extensions', length_t=Uint16),
-        ])
-
     @classmethod
     def from_bytes(cls, data):
         from ..handshake import HandshakeType
         reader = Reader(data)
 
-        # ServerHelloのExtension構造を流用しただけなので正しく動くか不明。
-        # 現在のところは extension=[] のように空の配列しか入らないので問題なく動く。
         extensions = Extension.get_list_from_bytes(
             reader.get_rest(),
-            msg_type=HandshakeType.server_hello)
+            msg_type=HandshakeType.encrypted_extensions)
 
-        return cls(extensions=extensions)
+        return cls(extensions=extensions).index_extensions()
 
 
 
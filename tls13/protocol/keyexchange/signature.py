@@ -61,16 +61,10 @@ class SignatureSchemeList(Struct):
       SignatureScheme supported_signature_algorithms<2..2^16-2>;
     } SignatureSchemeList;
     """
-    def __init__(self, **kwargs):
-        self.struct = Members(self, [
-            Member(Listof(SignatureScheme), 'supported_signature_algorithms',
-                   length_t=Uint16),
-        ])
-        self.struct.set_args(**kwargs)
+    members = [
+        Member(Listof(SignatureScheme), 'supported_signature_algorithms',
+               length_t=Uint16, min_length=2, max_length=2**16-2),
+    ]
 
-    @classmethod
-    def from_bytes(cls, data):
-        reader = Reader(data)
-        supported_signature_algorithms = reader.get(Listof(SignatureScheme),
-                                                    length_t=Uint16)
-        return cls(supported_signature_algorithms=supported_signature_algorithms)
+    def __init__(self, **kwargs):
+        self.set_args(**kwargs)
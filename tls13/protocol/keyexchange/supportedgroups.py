@@ -43,14 +43,10 @@ class NamedGroupList(Struct):
       NamedGroup named_group_list<2..2^16-1>;
     } NamedGroupList;
     """
+    members = [
+        Member(Listof(NamedGroup), 'named_group_list', length_t=Uint16,
+               min_length=2)
+    ]
+
     def __init__(self, **kwargs):
-        self.struct = Members(self, [
-            Member(Listof(NamedGroup), 'named_group_list', length_t=Uint16)
-        ])
-        self.struct.set_args(**kwargs)
-
-    @classmethod
-    def from_bytes(cls, data):
-        reader = Reader(data)
-        named_group_list = reader.get(Listof(NamedGroup), length_t=Uint16)
-        return cls(named_group_list=named_group_list)
+        self.set_args(**kwargs)
@@ -37,7 +37,8 @@ class SupportedVersions(Struct):
     def __init__(self, msg_type, **kwargs):
         self.msg_type = msg_type
         if self.msg_type == HandshakeType.client_hello:
-            member = Member(Listof(ProtocolVersion), 'versions', length_t=Uint8)
+            member = Member(Listof(ProtocolVersion), 'versions', length_t=Uint8,
+                            min_length=2, max_length=254)
         elif self.msg_type == HandshakeType.server_hello:
             member = Member(ProtocolVersion, 'selected_version')
         else:
@@ -50,7 +51,8 @@ class SupportedVersions(Struct):
     def from_bytes(cls, data, msg_type):
         reader = Reader(data)
         if msg_type == HandshakeType.client_hello:
-            versions = reader.get(Listof(ProtocolVersion), length_t=Uint8)
+            versions = reader.get(Listof(ProtocolVersion), length_t=Uint8,
+                                  min_length=2, max_length=254)
             return cls(msg_type=msg_type, versions=versions)
         elif msg_type == HandshakeType.server_hello:
             selected_version = reader.get(Uint16)
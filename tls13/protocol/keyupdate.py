@@ -0,0 +1,48 @@
+# B.3.5.  Updating Keys
+# https://tools.ietf.org/html/draft-ietf-tls-tls13-26#appendix-B.3.5
+
+__all__ = ['EndOfEarlyData', 'KeyUpdateRequest', 'KeyUpdate']
+
+from ..metastruct import *
+
+class EndOfEarlyData(Struct):
+    # 0-RTT で送った early data の終わりをサーバに知らせるときに使う
+    """
+    struct {} EndOfEarlyData;
+    """
+    members = []
+
+
+class KeyUpdateRequest(Type):
+    """
+    enum { ... } KeyUpdateRequest;
+    """
+    update_not_requested = Uint8(0)
+    update_requested = Uint8(1)
+    _size = 1 # byte
+
+
+class KeyUpdate(Struct):
+    # 送信に使う鍵を次の世代に更新したことを相手に知らせるときに使う (4.6.3)．
+    # request_update が update_requested のときは相手にも鍵の更新を求める
+    """
+    struct {
+      KeyUpdateRequest request_update;
+    } KeyUpdate;
+    """
+    members = [
+        Member(KeyUpdateRequest, 'request_update',
+               default=KeyUpdateRequest.update_not_requested),
+    ]
+
+    def __init__(self, **kwargs):
+        self.set_args(**kwargs)
+
+    @classmethod
+    def from_bytes(cls, data):
+        reader = Reader(data)
+        request_update = reader.get(Uint8)
+        if request_update not in KeyUpdateRequest.values():
+            raise RuntimeError("illegal_parameter: request_update %s" %
+                               request_update)
+        return cls(request_update=request_update)
@@ -4,14 +4,22 @@
 
 __all__ = [
     'ContentType', 'TLSPlaintext', 'TLSInnerPlaintext', 'TLSCiphertext',
-    'Data', 'TLSRawtext',
+    'Data', 'TLSRawtext', 'RecordFramer', 'HandshakeReassembler',
+    'RecordSizer', 'RecordWriter', 'HandshakeFlight', 'protect',
+    'protect_segments', 'unprotect',
 ]
 
+import time
+import struct
 import collections
 
 from .keyexchange.version import ProtocolVersion
+from .handshake import Handshake
 from .alert import Alert
 from ..metastruct import *
+from ..utils.trace import tracer, ERROR, DEBUG
+
+_trace = tracer.category('record')
 
 # @Type.add_labels_and_values
 class ContentType(Type):
@@ -35,17 +43,18 @@ class TLSPlaintext(Struct):
       opaque fragment[TLSPlaintext.length];
     } TLSPlaintext;
     """
+    members = [
+        Member(ContentType, 'type'),
+        Member(ProtocolVersion, 'legacy_record_version', default=Uint16(0x0303)),
+        Member(Uint16, 'length'),
+        Member(Struct, 'fragment'),
+    ]
+
     def __init__(self, **kwargs):
-        fragment = kwargs.get('fragment', b'')
-        self.struct = Members(self, [
-            Member(ContentType, 'type'),
-            Member(ProtocolVersion, 'legacy_record_version'),
-            Member(Uint16, 'length'),
-            Member(Struct, 'fragment'),
-        ])
-        self.struct.set_default('legacy_record_version', Uint16(0x0303))
-        self.struct.set_default('length', Uint16(len(fragment)))
-        self.struct.set_args(**kwargs)
+        # length は引数に無いときだけ計算する
+        if 'length' not in kwargs:
+            kwargs['length'] = Uint16(len(kwargs.get('fragment', b'')))
+        self.set_args(**kwargs)
 
     def __getattr__(self, name):
         """
@@ -61,7 +70,7 @@ class TLSPlaintext(Struct):
         return getattr(self.fragment.msg, name)
 
     @classmethod
-    def from_bytes(cls, data, mode=None):
+    def from_bytes(cls, data, mode=None, state=None):
         from .handshake import Handshake
         reader = Reader(data)
         type                  = reader.get(Uint8)
@@ -72,16 +81,29 @@ class TLSPlaintext(Struct):
         if mode:
             type = mode # e.g. mode=ContentType.handshake
 
-        print("[+] type:", type, ContentType.label(type))
+        if _trace.debug:
+            _trace.log(DEBUG, "type: %s %s", type, ContentType.label(type))
         if type == ContentType.handshake:
-            return cls(type=type, fragment=Handshake.from_bytes(fragment))
+            return cls(type=type, length=length,
+                       fragment=Handshake.from_bytes(fragment, state))
         elif type == ContentType.application_data:
-            return cls(type=type, fragment=Data(fragment))
+            return cls(type=type, length=length, fragment=Data(bytes(fragment)))
         elif type == ContentType.alert:
-            return cls(type=type, fragment=Alert.from_bytes(fragment))
+            return cls(type=type, length=length,
+                       fragment=Alert.from_bytes(fragment))
         else:
             raise NotImplementedError()
 
+    @classmethod
+    def from_handshake_bytes(cls, data, state=None):
+        """
+        レコードから取り出したハンドシェイクメッセージ1つのバイト列から作る．
+        state (ConnectionState) を与えたときは Finished の長さを確認する．
+        """
+        from .handshake import Handshake
+        return cls(type=ContentType.handshake,
+                   fragment=Handshake.from_bytes(data, state))
+
 
 class TLSInnerPlaintext(Struct):
     """
@@ -91,18 +113,19 @@ class TLSInnerPlaintext(Struct):
       uint8 zeros[length_of_padding];
     } TLSInnerPlaintext;
     """
+    members = [
+        Member(bytes, 'content'),
+        Member(ContentType, 'type'),
+        Member(bytes, 'zeros'),
+    ]
+    __slots__ = ('_length_of_padding',)
+
     def __init__(self, content, type, length_of_padding):
         self.content = content # TLSPlaintext.fragment
         self.type = type
         self.zeros = b'\x00' * length_of_padding
         self._length_of_padding = length_of_padding
 
-        self.struct = Members(self, [
-            Member(bytes, 'content'),
-            Member(ContentType, 'type'),
-            Member(bytes, 'zeros'),
-        ])
-
     @classmethod
     def from_bytes(cls, data):
         content, type, zeros = cls.split_pad(data)
@@ -110,10 +133,12 @@ class TLSInnerPlaintext(Struct):
 
     @staticmethod
     def split_pad(data):
-        for pos, value in zip(reversed(range(len(data))), reversed(data)):
-            if value != 0:
-                break
-        return (data[:pos], Uint8(value), data[pos+1:]) # content, type, zeros
+        content = bytes(data).rstrip(b'\x00')
+        if len(content) == 0:
+            # 0 でない type が無い (5.4)
+            raise RuntimeError("unexpected_message: no content type")
+        type = _content_type(content[-1])
+        return (content[:-1], type, data[len(content):]) # content, type, zeros
 
     @classmethod
     def create(cls, tlsplaintext, length_of_padding=None):
@@ -134,25 +159,25 @@ class TLSCiphertext(Struct):
       opaque encrypted_record[TLSCiphertext.length];
     } TLSCiphertext;
     """
+    members = [
+        Member(ContentType, 'opaque_type', default=ContentType.application_data),
+        Member(ProtocolVersion, 'legacy_record_version',
+               default=ProtocolVersion.TLS12),
+        Member(Uint16, 'length'),
+        Member(bytes, 'encrypted_record'),
+    ]
+
     def __init__(self, **kwargs):
-        encrypted_record = kwargs.get('encrypted_record', b'')
-        self.struct = Members(self, [
-            Member(ContentType, 'opaque_type'),
-            Member(ProtocolVersion, 'legacy_record_version'),
-            Member(Uint16, 'length'),
-            Member(bytes, 'encrypted_record'),
-        ])
-        self.struct.set_default('opaque_type', ContentType.application_data)
-        self.struct.set_default('legacy_record_version', ProtocolVersion.TLS12)
-        self.struct.set_default('length', Uint16(len(encrypted_record)))
-        self.struct.set_args(**kwargs)
+        if 'length' not in kwargs:
+            kwargs['length'] = Uint16(len(kwargs.get('encrypted_record', b'')))
+        self.set_args(**kwargs)
 
     @classmethod
     def from_bytes(cls, data):
         reader = Reader(data)
         opaque_type           = reader.get(Uint8)
         legacy_record_version = reader.get(Uint16)
-        encrypted_record      = reader.get(bytes, length_t=Uint16)
+        encrypted_record      = reader.get(bytes, length_t=Uint16, copy=True)
         length = Uint16(len(encrypted_record))
         return cls(length=length, encrypted_record=encrypted_record)
 
@@ -164,18 +189,35 @@ class TLSCiphertext(Struct):
         # additional_data =
         #   TLSCiphertext.opaque_type || .legacy_record_version || .length
         length = len(crypto.encrypt(app_data_inner.to_bytes(), nonce=crypto.iv)) + 16
-        print("[+] length:", length)
         aad = b'\x17\x03\x03' + Uint16(length).to_bytes()
-        print('[+] AAD:', aad.hex())
 
         encrypted_record = crypto.aead_encrypt(aad, app_data_inner.to_bytes())
-        print('[+] encrypted_record:')
-        print(encrypted_record.hex())
+        if _trace.debug:
+            _trace.log(DEBUG, "AAD: %s\nencrypted_record:\n%s",
+                       aad.hex(), encrypted_record.hex())
         app_data_cipher = TLSCiphertext(encrypted_record=encrypted_record)
         return app_data_cipher
 
+    # AEAD の認証タグの長さ
+    tag_size = 16
+
+    @classmethod
+    def encrypt(cls, content, type, crypto, length_of_padding=0) -> bytes:
+        """
+        content を TLSInnerPlaintext に入れて暗号化し，1つのレコードのバイト列を返す．
+        """
+        return protect(content, crypto, type, length_of_padding)
+
     @classmethod
-    def restore(cls, data, crypto, mode=None) -> TLSPlaintext:
+    def decrypt(cls, data, crypto):
+        """
+        1つのレコードを復号して (ContentType, content) を返す．
+        additional_data には受信したレコードのヘッダをそのまま使う．
+        """
+        return unprotect(data, crypto)
+
+    @classmethod
+    def restore(cls, data, crypto, mode=None, state=None) -> TLSPlaintext:
         from .handshake import Handshake
         recved_app_data_cipher = TLSCiphertext.from_bytes(data)
         # print("[+] recved_app_data_cipher:")
@@ -184,35 +226,37 @@ class TLSCiphertext(Struct):
         # additional_data =
         #   TLSCiphertext.opaque_type || .legacy_record_version || .length
         length = recved_app_data_cipher.length.value
-        print("[+] length:", length)
         aad = b'\x17\x03\x03' + Uint16(length).to_bytes()
-        print('[+] AAD:', aad.hex())
-        # print('encrypted_record:', recved_app_data_cipher.encrypted_record.hex())
 
         # length から Alert かどうか判断する
         if length == 2:
-            print("[-] Alert!")
-            print(TLSPlaintext.from_bytes(data))
+            if _trace.error:
+                _trace.log(ERROR, "Alert!\n%s", TLSPlaintext.from_bytes(data))
             raise RuntimeError("Alert!")
 
-        print("[+] restore before:", recved_app_data_cipher.encrypted_record.hex())
+        if _trace.debug:
+            _trace.log(DEBUG, "restore before: %s",
+                       recved_app_data_cipher.encrypted_record.hex())
         recved_app_data_inner_bytes = \
             crypto.aead_decrypt(aad, recved_app_data_cipher.encrypted_record)
         if recved_app_data_inner_bytes is None:
             raise RuntimeError('aead_decrypt Error')
-        # print("restore after:", recved_app_data_inner_bytes.hex())
-        print("[+] restore after:")
-        print(hexdump(recved_app_data_inner_bytes))
+        if _trace.debug:
+            _trace.log(DEBUG, "restore after:\n%s",
+                       hexdump(recved_app_data_inner_bytes))
         if mode == ContentType.application_data:
             content, type, zeros = \
                 TLSInnerPlaintext.split_pad(recved_app_data_inner_bytes)
-            print("content, type, zeros: ", content, type, zeros)
             return TLSRawtext(raw=content)
 
         recved_app_data_inner = \
             TLSInnerPlaintext.from_bytes(recved_app_data_inner_bytes)
-        print("[+] recved_app_data_inner.content:")
-        print(recved_app_data_inner.content.hex())
+        # 0-RTT のときは early data（application_data）と EndOfEarlyData（handshake）が
+        # 同じ鍵で送られてくるので，TLSInnerPlaintext.type で区別する
+        if recved_app_data_inner.type == ContentType.application_data:
+            return TLSPlaintext(
+                type=ContentType.application_data,
+                fragment=Data(recved_app_data_inner.content))
         # TODO:
         # この時点ではTLSInnerPlaintextのバイト列しかないので、
         # TLSPlaintext を作るには handshake の 0x16 とバージョンの 0x0303 と
@@ -223,7 +267,7 @@ class TLSCiphertext(Struct):
 
         recved_data = TLSPlaintext(
             type=ContentType.handshake,
-            fragment=Handshake.from_bytes(recved_app_data_inner.content))
+            fragment=Handshake.from_bytes(recved_app_data_inner.content, state))
         return recved_data
 
 
@@ -236,22 +280,22 @@ class TLSRawtext(Struct):
       opaque raw[TLSCiphertext.length];
     } TLSCiphertext;
     """
+    members = [
+        Member(ContentType, 'opaque_type', default=ContentType.application_data),
+        Member(ProtocolVersion, 'legacy_record_version',
+               default=ProtocolVersion.TLS12),
+        Member(bytes, 'raw', length_t=Uint16),
+    ]
+
     def __init__(self, **kwargs):
-        self.struct = Members(self, [
-            Member(ContentType, 'opaque_type'),
-            Member(ProtocolVersion, 'legacy_record_version'),
-            Member(bytes, 'raw', length_t=Uint16),
-        ])
-        self.struct.set_default('opaque_type', ContentType.application_data)
-        self.struct.set_default('legacy_record_version', ProtocolVersion.TLS12)
-        self.struct.set_args(**kwargs)
+        self.set_args(**kwargs)
 
     @classmethod
     def from_bytes(cls, data):
         reader = Reader(data)
         opaque_type           = reader.get(Uint8)
         legacy_record_version = reader.get(Uint16)
-        raw                   = reader.get(bytes, length_t=Uint16)
+        raw                   = reader.get(bytes, length_t=Uint16, copy=True)
         return cls(raw=raw)
 
 
@@ -282,6 +326,554 @@ class Data(Struct):
     def to_bytes(self):
         return self.data
 
+    def write_segments(self, writer):
+        writer.add_segment(self.data)
+
     @classmethod
     def from_bytes(self, data):
         return data
+
+
+# ハンドシェイクの後のレコードの暗号化・復号
+#
+# アプリケーションデータのレコードは TLSPlaintext / TLSInnerPlaintext /
+# TLSCiphertext の構造体を作らずに，ヘッダを struct で直接読み書きする．
+# ハンドシェイクメッセージは今まで通り構造体で扱う．
+
+_record_header = struct.Struct('!BHH') # opaque_type, legacy_record_version, length
+_application_data = ContentType.application_data.value
+_legacy_record_version = ProtocolVersion.TLS12.value
+_max_ciphertext_length = 2**14 + 256
+
+# 受信した type の値から ContentType の定数を引く（レコードごとに Uint8 を作らない）
+_content_types = {
+    type.value: type for type in (
+        ContentType.change_cipher_spec, ContentType.alert,
+        ContentType.handshake, ContentType.application_data)
+}
+
+def _content_type(value):
+    type = _content_types.get(value)
+    if type is None:
+        type = Uint8(value)
+    return type
+
+def protect(content, crypto, type=ContentType.application_data,
+            length_of_padding=0) -> bytes:
+    """
+    content を暗号化して TLSCiphertext のバイト列を返す．
+    """
+    return b''.join(protect_segments(content, crypto, type, length_of_padding))
+
+def protect_segments(content, crypto, type=ContentType.application_data,
+                     length_of_padding=0) -> list:
+    """
+    content を暗号化して TLSCiphertext を [ヘッダ, 暗号文] の2つのバッファで返す．
+    ヘッダと暗号文をつなげないで Connection.send_buffers に渡すときに使う．
+    content はバッファのリスト（Struct.to_segments の結果など）でもよい．
+    """
+    # content（memoryview のこともある）は TLSInnerPlaintext を作るときに1回だけコピーする
+    if isinstance(content, list):
+        inner = b''.join(content + [bytes((type.value,)), bytes(length_of_padding)])
+    else:
+        inner = b''.join((content, bytes((type.value,)), bytes(length_of_padding)))
+    header = _record_header.pack(_application_data, _legacy_record_version,
+                                 len(inner) + TLSCiphertext.tag_size)
+    return [header, crypto.aead_encrypt(header, inner)]
+
+def unprotect(record, crypto):
+    """
+    1つの TLSCiphertext のバイト列を復号して (ContentType, content) を返す．
+    additional_data には受信したレコードのヘッダをそのまま使う．
+    content は復号した平文の memoryview．
+    """
+    opaque_type, _, length = _record_header.unpack_from(record)
+    if opaque_type != _application_data:
+        raise RuntimeError("unexpected_message: opaque_type %d" % opaque_type)
+    if length > _max_ciphertext_length or length != len(record) - 5:
+        raise RuntimeError("record_overflow: length %d" % length)
+    # ヘッダと暗号文はコピーせずに record の memoryview のまま渡す
+    view = memoryview(record)
+    inner = crypto.aead_decrypt(view[:5], view[5:])
+    if inner is None:
+        raise RuntimeError('aead_decrypt Error')
+    # 末尾の 0 のパディングを飛ばすと，最後のバイトが type
+    end = len(inner) - 1
+    while end >= 0 and inner[end] == 0:
+        end -= 1
+    if end < 0:
+        raise RuntimeError("unexpected_message: no content type")
+    return (_content_type(inner[end]), memoryview(inner)[:end])
+
+
+class RecordFramer:
+    """
+    受信したバイト列からレコードを切り出す．
+    TCP ではレコードが複数のセグメントに分かれて届いたり，複数のレコードが
+    まとめて届いたりするので，受信バッファに溜めておき完全なレコードだけを返す．
+
+        framer = RecordFramer()
+        while True:
+            record = framer.next_record()
+            if record is None:
+                framer.recv_into(sock)
+                continue
+            ...
+
+    返す memoryview は受信バッファを直接指している（コピーしない）ので，
+    次に recv_into か feed を呼ぶまでに使い終わること．
+    """
+    header_size = 5
+    # TLSCiphertext.length は 2^14 + 256 を超えてはいけない (5.2)
+    max_fragment_size = 2**14 + 256
+
+    def __init__(self, buffer_size=2**15):
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0 # 未処理のデータの先頭
+        self.end = 0   # 受信したデータの末尾
+
+    def __len__(self):
+        return self.end - self.start
+
+    def _reserve(self, size):
+        """
+        バッファの末尾に size バイト以上の空きを作る．
+        """
+        if len(self.buffer) - self.end >= size:
+            return
+        pending = self.end - self.start
+        if len(self.buffer) - pending >= size:
+            # 処理済みのデータを捨てて未処理のデータを先頭に詰める
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+        else:
+            buffer = bytearray(max(2 * len(self.buffer), pending + size))
+            buffer[:pending] = self.buffer[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = pending
+
+    def _get_record_size(self):
+        if self.end - self.start < self.header_size:
+            return None
+        length = (self.buffer[self.start + 3] << 8) | self.buffer[self.start + 4]
+        if length > self.max_fragment_size:
+            raise RuntimeError("record_overflow")
+        return self.header_size + length
+
+    def recv_into(self, sock) -> int:
+        """
+        ソケットから受信バッファに直接読み込み，受信したバイト数を返す．
+        0 のときは相手が接続を閉じた．
+        """
+        if self.start == self.end:
+            self.start = self.end = 0
+        # 次のレコード全体が入る空きを用意する
+        record_size = self._get_record_size() or 0
+        self._reserve(max(self.header_size + self.max_fragment_size,
+                          record_size - (self.end - self.start)))
+        n = sock.recv_into(self.view[self.end:])
+        self.end += n
+        return n
+
+    def feed(self, data):
+        if self.start == self.end:
+            self.start = self.end = 0
+        self._reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def next_record(self) -> memoryview or None:
+        """
+        完全なレコード（ヘッダを含む）があれば返し，無ければ None を返す．
+        """
+        record_size = self._get_record_size()
+        if record_size is None or self.end - self.start < record_size:
+            return None
+        record = self.view[self.start:self.start + record_size]
+        self.start += record_size
+        return record
+
+    def buffered_records(self) -> int or None:
+        """
+        受信バッファにある完全なレコードの数を返す．
+        途中までしか受信していないレコードがあるときは None を返す．
+        """
+        count = 0
+        pos = self.start
+        while pos < self.end:
+            if self.end - pos < self.header_size:
+                return None
+            length = (self.buffer[pos + 3] << 8) | self.buffer[pos + 4]
+            pos += self.header_size + length
+            if pos > self.end:
+                return None
+            count += 1
+        return count
+
+    def __iter__(self):
+        while True:
+            record = self.next_record()
+            if record is None:
+                return
+            yield record
+
+
+class HandshakeReassembler:
+    """
+    レコードの中身からハンドシェイクメッセージを取り出す．
+    1つのレコードに複数のメッセージが入っていることも，1つのメッセージが
+    複数のレコードに分かれていることもある (5.1)．
+
+    max_message_size を超える長さのメッセージはヘッダを受け取ったときにエラーにし，
+    バッファが max_buffer_size を超えるときも残りを待たないでエラーにする．
+    """
+    header_size = 4 # msg_type (1 byte) + length (3 bytes)
+    max_message_size = Handshake.max_message_size
+
+    def __init__(self, max_message_size=max_message_size, max_buffer_size=None):
+        self.buffer = bytearray()
+        self.max_message_size = max_message_size
+        if max_buffer_size is None:
+            # 途中まで受信したメッセージ1つと，次のレコード1つ分
+            max_buffer_size = self.header_size + max_message_size + \
+                RecordFramer.max_fragment_size
+        self.max_buffer_size = max_buffer_size
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def feed(self, fragment):
+        if len(self.buffer) + len(fragment) > self.max_buffer_size:
+            raise RuntimeError("unexpected_message: too much handshake data "
+                               "(%d bytes)" % (len(self.buffer) + len(fragment)))
+        self.buffer += fragment
+        self._get_message_size()
+
+    def _get_message_size(self):
+        if len(self.buffer) < self.header_size:
+            return None
+        length = int.from_bytes(self.buffer[1:4], 'big')
+        if length > self.max_message_size:
+            raise RuntimeError("illegal_parameter: handshake message is too large "
+                               "(%d bytes)" % length)
+        return self.header_size + length
+
+    def next_message(self) -> bytes or None:
+        """
+        完全なハンドシェイクメッセージ（Handshake 構造体のバイト列）があれば返す．
+        """
+        size = self._get_message_size()
+        if size is None or len(self.buffer) < size:
+            return None
+        message = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return message
+
+
+class RecordSizer:
+    """
+    送信するレコードの大きさを動的に決める．
+    応答の最初は1つの TCP セグメント（MSS）に収まる小さなレコードで送り，受信側が
+    レコード全体を待たずに最初のバイトを復号できるようにする（time-to-first-byte）．
+    boost_threshold バイト送った後か，送り始めてから boost_after 秒経った後は
+    最大サイズのレコードにして，レコードごとのヘッダと AEAD のオーバーヘッドを
+    減らす（throughput）．
+    idle_timeout 秒送信しなかったときは輻輳ウィンドウが縮むので，小さなレコードに戻す．
+
+        sizer = RecordSizer(max_size=peer_record_size_limit.get_max_fragment_size())
+        writer = RecordWriter(server_conn, crypto, sizer=sizer)
+    """
+    # ヘッダ (5) + content type (1) + AEAD のタグ (16)
+    record_overhead = 5 + 1 + 16
+    # IPv6 と TCP オプションを考慮して 1500 byte の MTU に収まる大きさにする
+    initial_size = 1400 - record_overhead
+    max_size = 2**14
+    boost_threshold = 128 * 1024
+    boost_after = 1.0
+    idle_timeout = 1.0
+
+    def __init__(self, initial_size=initial_size, max_size=max_size,
+                 boost_threshold=boost_threshold, boost_after=boost_after,
+                 idle_timeout=idle_timeout, clock=time.monotonic):
+        assert 0 < initial_size and 0 < max_size <= 2**14
+        self.initial_size = min(initial_size, max_size)
+        self.max_size = max_size
+        self.boost_threshold = boost_threshold
+        # None のときは時間では切り替えない
+        self.boost_after = boost_after
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self.bytes_sent = 0
+        self.last_sent = None
+        # 小さなレコードで送り始めた時刻
+        self.started = None
+
+    def reset(self):
+        self.bytes_sent = 0
+        self.started = None
+
+    def next_size(self) -> int:
+        """
+        次に送るレコードの平文の最大サイズを返す．
+        """
+        now = self.clock()
+        if self.last_sent is not None and now - self.last_sent >= self.idle_timeout:
+            self.reset()
+        if self.bytes_sent >= self.boost_threshold:
+            return self.max_size
+        if self.boost_after is not None and self.started is not None and \
+           now - self.started >= self.boost_after:
+            return self.max_size
+        return self.initial_size
+
+    def record_sent(self, size):
+        now = self.clock()
+        if self.started is None:
+            self.started = now
+        self.bytes_sent += size
+        self.last_sent = now
+
+
+def _has_fileno(data):
+    try:
+        data.fileno()
+        return True
+    except (AttributeError, OSError, ValueError):
+        # io.UnsupportedOperation は OSError と ValueError を継承している
+        return False
+
+
+class RecordWriter:
+    """
+    送信するデータを max_fragment_size 以下のレコードに分割し，暗号化しながら
+    少しずつ送信する．data には bytes，bytes のイテラブル，ファイルオブジェクトを渡せる．
+    メモリに溜めるのは records_per_send 個のレコードまでなので，大きなファイルでも
+    メモリ使用量は一定になる．溜めたレコードは conn.send_buffers でまとめて送る．
+    sizer (RecordSizer) を与えたときはレコードごとに大きさを sizer に決めさせる．
+    state (ConnectionState) を与えたときは state.write_crypto で暗号化し，
+    state.key_update_policy の条件を満たしたら KeyUpdate を送って鍵を更新する．
+
+        writer = RecordWriter(server_conn, server_app_data_crypto)
+        with open('index.html', 'rb') as f:
+            writer.write(f)
+    """
+    # TLSPlaintext.length は 2^14 を超えてはいけない (5.1)
+    max_fragment_size = 2**14
+
+    def __init__(self, conn, crypto, content_type=ContentType.application_data,
+                 max_fragment_size=max_fragment_size, records_per_send=4,
+                 sizer=None, state=None):
+        assert 0 < max_fragment_size <= 2**14
+        assert crypto is not None or state is not None
+        self.conn = conn
+        self.crypto = crypto
+        self.state = state
+        self.content_type = content_type
+        self.max_fragment_size = max_fragment_size
+        self.records_per_send = records_per_send
+        self.sizer = sizer
+
+    def next_fragment_size(self) -> int:
+        if self.sizer is None:
+            return self.max_fragment_size
+        return min(self.sizer.next_size(), self.max_fragment_size)
+
+    def write(self, data) -> int:
+        """
+        data を送信して，送信した平文のバイト数を返す．
+        """
+        if self.state is not None and self.state.kernel_tx:
+            return self.write_plaintext(data)
+        written = 0
+        # レコードのヘッダと暗号文を別々のバッファのまま sendmsg に渡す
+        buffers = []
+        num_records = 0
+        for fragment in self.iter_fragments(data):
+            crypto = self.crypto
+            if self.state is not None:
+                if self.state.needs_key_update():
+                    # KeyUpdate は今の鍵で送り，その後のレコードは次の世代の鍵で送る
+                    buffers.append(self.state.seal_key_update())
+                crypto = self.state.write_crypto
+                self.state.bytes_written += len(fragment)
+            buffers += protect_segments(fragment, crypto, self.content_type)
+            num_records += 1
+            written += len(fragment)
+            if self.sizer is not None:
+                self.sizer.record_sent(len(fragment))
+            if num_records >= self.records_per_send:
+                self.conn.send_buffers(buffers)
+                buffers = []
+                num_records = 0
+        if buffers:
+            self.conn.send_buffers(buffers)
+        return written
+
+    def write_plaintext(self, data) -> int:
+        """
+        kTLS：暗号化はカーネルが行うので平文をそのまま送る．
+        1回の送信が1つのレコードになるので，断片ごとに送ってレコードの大きさを保つ．
+        断片の大きさを変えなくてよいファイルは sendfile で送る．
+        """
+        state = self.state
+        if self.sizer is None and self.max_fragment_size == 2**14 and \
+           _has_fileno(data) and hasattr(self.conn, 'send_file'):
+            if state.needs_key_update():
+                self.conn.send_kernel_key_update()
+            # シーケンス番号は send_file がカーネルから読んで合わせる
+            written = self.conn.send_file(data)
+            state.bytes_written += written
+            return written
+        written = 0
+        for fragment in self.iter_fragments(data):
+            if state.needs_key_update():
+                self.conn.send_kernel_key_update()
+            self.conn.send_buffers([fragment])
+            state.write_crypto.seq_number += 1
+            state.bytes_written += len(fragment)
+            written += len(fragment)
+            if self.sizer is not None:
+                self.sizer.record_sent(len(fragment))
+        return written
+
+    def iter_fragments(self, data):
+        """
+        data を next_fragment_size() 以下の断片に分けて返す．
+        """
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            view = memoryview(data)
+            i = 0
+            while i < len(view):
+                size = self.next_fragment_size()
+                yield view[i:i + size]
+                i += size
+        elif hasattr(data, 'readinto'):
+            while True:
+                buffer = bytearray(self.next_fragment_size())
+                n = data.readinto(buffer)
+                if not n:
+                    return
+                yield memoryview(buffer)[:n]
+        elif hasattr(data, 'read'):
+            while True:
+                chunk = data.read(self.next_fragment_size())
+                if not chunk:
+                    return
+                yield chunk
+        else:
+            # 小さな断片はまとめて，なるべく大きなレコードにする
+            pending = bytearray()
+            for chunk in data:
+                pending += chunk
+                size = self.next_fragment_size()
+                while len(pending) >= size:
+                    yield bytes(pending[:size])
+                    del pending[:size]
+                    size = self.next_fragment_size()
+            if pending:
+                yield bytes(pending)
+
+
+def _split_buffers(buffers, size):
+    """
+    buffers（バッファのリスト）をつなげたものを size byte ずつに分けて，
+    それぞれをバッファ（memoryview）のリストで返す．バイト列はコピーしない．
+    """
+    fragments = []
+    fragment, length = [], 0
+    for buffer in buffers:
+        view = memoryview(buffer)
+        while len(view) > 0:
+            n = min(size - length, len(view))
+            fragment.append(view[:n])
+            length += n
+            view = view[n:]
+            if length == size:
+                fragments.append(fragment)
+                fragment, length = [], 0
+    if length > 0:
+        fragments.append(fragment)
+    return fragments
+
+
+class HandshakeFlight:
+    """
+    1つのフライト（相手の応答を待たずに続けて送るメッセージ）のレコードを溜めておき，
+    flush で conn.send_buffers を1回呼んでまとめて送る．
+    pack=True のときは，同じ鍵で送る連続したメッセージを1つのレコードに詰める．
+    暗号化するレコードは max_fragment_size（相手の record_size_limit）以下にする．
+
+        flight = HandshakeFlight(server_conn, pack=True)
+        flight.add(serverhello.to_segments())
+        flight.add(encrypted_extensions.to_segments(), crypto=s_traffic_crypto)
+        ...
+        flight.flush()
+
+    メッセージはバッファのリストのまま溜めるので，証明書などの大きなバイト列は
+    暗号化しないレコードではそのまま sendmsg に，暗号化するレコードでは
+    TLSInnerPlaintext を作るときに1回だけコピーされる．
+    """
+    def __init__(self, conn, pack=False,
+                 max_fragment_size=RecordWriter.max_fragment_size):
+        self.conn = conn
+        self.pack = pack
+        self.max_fragment_size = max_fragment_size
+        # 送るレコードのバッファ（ヘッダとフラグメントや暗号文は別々のバッファ）
+        self.buffers = []
+        self.num_records = 0
+        self.pending = []
+        self.pending_crypto = None
+        self.pending_type = ContentType.handshake
+
+    def __len__(self):
+        return self.num_records
+
+    def add(self, message, crypto=None, type=ContentType.handshake):
+        """
+        message（Handshake 構造体などのバイト列，または to_segments で作った
+        バッファのリスト）を追加する．crypto が None のときは暗号化しない．
+        """
+        if not self.pack or crypto is not self.pending_crypto or \
+           type != self.pending_type:
+            self._seal()
+        if isinstance(message, list):
+            self.pending += message
+        else:
+            self.pending.append(message)
+        self.pending_crypto = crypto
+        self.pending_type = type
+        if not self.pack:
+            self._seal()
+
+    def _seal(self):
+        # 溜めたメッセージを 2^14 byte 以下のレコードにする．
+        # 暗号化しないレコードには record_size_limit は適用されない (RFC 8449 4)
+        if self.pending_crypto is None:
+            size = RecordWriter.max_fragment_size
+        else:
+            size = self.max_fragment_size
+        for fragment in _split_buffers(self.pending, size):
+            if self.pending_crypto is None:
+                header = _record_header.pack(self.pending_type.value,
+                                             _legacy_record_version,
+                                             sum(map(len, fragment)))
+                self.buffers += [header] + fragment
+            else:
+                self.buffers += protect_segments(fragment, self.pending_crypto,
+                                                 self.pending_type)
+            self.num_records += 1
+        self.pending = []
+
+    def flush(self) -> int:
+        """
+        溜めたレコードを送信して，送信したレコードの数を返す．
+        """
+        self._seal()
+        num_records = self.num_records
+        if self.buffers:
+            self.conn.send_buffers(self.buffers)
+        self.buffers = []
+        self.num_records = 0
+        return num_records
@@ -0,0 +1,151 @@
+
+# 1つの接続の状態
+#
+# ネゴシエーションで決まったパラメータ（暗号スイート，ハッシュ長など）と，
+# レコードの暗号化・復号に使う暗号（シーケンス番号は暗号のインスタンスが持つ）を
+# 接続ごとに持つ．クラス変数やモジュール変数に接続の状態を置かないので，
+# 1つのプロセスで複数の接続を同時に扱える．
+
+__all__ = ['ConnectionState', 'KeyUpdatePolicy']
+
+from .ciphersuite import CipherSuite
+
+
+class KeyUpdatePolicy:
+    """
+    送信の鍵を自動で更新する条件．今の鍵で max_records 個のレコード，または
+    max_bytes バイトのアプリケーションデータを送ったら KeyUpdate を送る．
+    None の条件は使わない．
+
+    AES-GCM では1つの鍵で 2^24.5 レコードまでしか安全に送れないので (5.5)，
+    既定値はそれより少なくしておく．
+    """
+    max_records = 2**24
+    max_bytes = None
+
+    def __init__(self, max_records=max_records, max_bytes=max_bytes):
+        assert max_records is None or max_records > 0
+        assert max_bytes is None or max_bytes > 0
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+
+    def needs_update(self, records, bytes_written) -> bool:
+        if self.max_records is not None and records >= self.max_records:
+            return True
+        if self.max_bytes is not None and bytes_written >= self.max_bytes:
+            return True
+        return False
+
+
+class ConnectionState:
+    """
+    接続ごとの状態．バイト列から構造体を作るときは state を渡して，
+    Finished.verify_data の長さなどを決める．
+
+        state = ConnectionState(side='server')
+        state.set_cipher_suite(cipher_suite)
+        state.set_crypto(read_crypto=c_traffic_crypto, write_crypto=s_traffic_crypto)
+        finished = TLSPlaintext.from_handshake_bytes(data, state=state)
+
+    application_traffic_secret を与えておくと，KeyUpdate で鍵を次の世代に更新できる．
+    """
+    def __init__(self, side, key_update_policy=None):
+        assert side in ('client', 'server')
+        self.side = side
+        self.cipher_suite = None
+        self.hash_algo = None
+        self.hash_size = None
+        # 相手から受信したレコードを復号する暗号と，送信するレコードを暗号化する暗号
+        self.read_crypto = None
+        self.write_crypto = None
+        # KeyUpdate で次の世代の鍵を作るための application_traffic_secret
+        self.read_secret = None
+        self.write_secret = None
+        # 今の送信の鍵で送ったアプリケーションデータのバイト数
+        self.bytes_written = 0
+        # 相手から KeyUpdate で鍵の更新を求められて，まだ応えていない
+        self.key_update_requested = False
+        self.key_update_policy = key_update_policy or KeyUpdatePolicy()
+        # 相手に送る保護されたレコードの平文の最大サイズ (RFC 8449)
+        self.max_fragment_size = 2**14
+        # レコードの暗号化（tx）・復号（rx）をカーネルに任せているか (utils.ktls)
+        self.kernel_tx = False
+        self.kernel_rx = False
+
+    def set_cipher_suite(self, cipher_suite):
+        self.cipher_suite = cipher_suite
+        self.hash_algo = CipherSuite.get_hash_algo_name(cipher_suite)
+        self.hash_size = CipherSuite.get_hash_algo_size(cipher_suite)
+
+    def set_crypto(self, read_crypto=None, write_crypto=None,
+                   read_secret=None, write_secret=None):
+        """
+        鍵が変わったときに新しい暗号に切り替える．None の方向は変えない．
+        新しい暗号のシーケンス番号は 0 から始まる (5.3)．
+        """
+        if read_crypto is not None:
+            self.read_crypto = read_crypto
+            self.read_secret = read_secret
+        if write_crypto is not None:
+            self.write_crypto = write_crypto
+            self.write_secret = write_secret
+            self.bytes_written = 0
+            self.key_update_requested = False
+
+    def _next_generation(self, secret, crypto):
+        from ..utils import cryptomath
+        if secret is None:
+            raise RuntimeError("unexpected_message: keys cannot be updated now")
+        secret = cryptomath.gen_next_traffic_secret(secret, self.hash_algo)
+        cipher_class = type(crypto)
+        key, iv = cryptomath.gen_key_and_iv(
+            secret, cipher_class.key_size, cipher_class.nonce_size, self.hash_algo)
+        return secret, cipher_class(key=key, nonce=iv)
+
+    def update_read_crypto(self):
+        """
+        KeyUpdate を受け取ったときに受信の鍵を次の世代にする．
+        """
+        secret, crypto = self._next_generation(self.read_secret, self.read_crypto)
+        self.set_crypto(read_crypto=crypto, read_secret=secret)
+
+    def update_write_crypto(self):
+        """
+        KeyUpdate を送った後に送信の鍵を次の世代にする．
+        """
+        secret, crypto = self._next_generation(self.write_secret, self.write_crypto)
+        self.set_crypto(write_crypto=crypto, write_secret=secret)
+
+    def needs_key_update(self) -> bool:
+        if self.write_secret is None:
+            return False
+        if self.key_update_requested:
+            return True
+        return self.key_update_policy.needs_update(
+            self.write_crypto.seq_number, self.bytes_written)
+
+    @staticmethod
+    def key_update_message(request_update=False) -> bytes:
+        """
+        KeyUpdate の Handshake 構造体のバイト列を返す．
+        """
+        from .handshake import Handshake, HandshakeType
+        from .keyupdate import KeyUpdate, KeyUpdateRequest
+        if request_update:
+            request = KeyUpdateRequest.update_requested
+        else:
+            request = KeyUpdateRequest.update_not_requested
+        key_update = Handshake(
+            msg_type=HandshakeType.key_update,
+            msg=KeyUpdate(request_update=request))
+        return key_update.to_bytes()
+
+    def seal_key_update(self, request_update=False) -> bytes:
+        """
+        今の送信の鍵で暗号化した KeyUpdate のレコードを返し，送信の鍵を次の世代にする．
+        """
+        from .recordlayer import ContentType, protect
+        record = protect(self.key_update_message(request_update),
+                         self.write_crypto, ContentType.handshake)
+        self.update_write_crypto()
+        return record
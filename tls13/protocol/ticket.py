@@ -2,12 +2,29 @@
 # B.3.4.  Ticket Establishment
 # https://tools.ietf.org/html/draft-ietf-tls-tls13-26#appendix-B.3.4
 
-__all__ = ['NewSessionTicket']
+__all__ = [
+    'NewSessionTicket', 'TicketState', 'SessionTicketKey', 'TicketKeyEntry',
+    'TicketKeyFile', 'TicketKeyRing', 'SessionTicket', 'SessionTicketEntry',
+    'SessionTicketFile', 'SessionTicketStore',
+]
 
-from .keyexchange.messages import Extension
+import os
+import time
+import fcntl
+import contextlib
+
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+from cryptography.exceptions import InvalidTag
+
+from .ciphersuite import CipherSuite
+from .keyexchange.messages import Extension, HasExtension
 from ..metastruct import *
+from ..metastruct.codec import ReaderParseError
+from ..utils.trace import tracer, ERROR
 
-class NewSessionTicket(Struct):
+_trace = tracer.category('handshake')
+
+class NewSessionTicket(Struct, HasExtension):
     """
     struct {
       uint32 ticket_lifetime;
@@ -17,12 +34,534 @@ class NewSessionTicket(Struct):
       Extension extensions<0..2^16-2>;
     } NewSessionTicket;
     """
+    members = [
+        Member(Uint32, 'ticket_lifetime'),
+        Member(Uint32, 'ticket_age_add'),
+        Member(bytes, 'ticket_nonce', length_t=Uint8),
+        Member(bytes, 'ticket', length_t=Uint16, min_length=1),
+        Member(Listof(Extension), 'extensions', length_t=Uint16,
+               max_length=2**16-2),
+    ]
+
     def __init__(self, **kwargs):
-        self.struct = Members(self, [
-            Member(Uint32, 'ticket_lifetime'),
-            Member(Uint32, 'ticket_age_add'),
-            Member(bytes, 'ticket_nonce', length_t=Uint8),
-            Member(bytes, 'ticket', length_t=Uint16),
-            Member(Listof(Extension), 'extensions', length_t=Uint16),
-        ])
-        self.struct.set_args(**kwargs)
+        self.set_args(**kwargs)
+
+    @classmethod
+    def from_bytes(cls, data):
+        from .handshake import HandshakeType
+        reader = Reader(data)
+        ticket_lifetime = reader.get(Uint32)
+        ticket_age_add  = reader.get(Uint32)
+        ticket_nonce    = reader.get(bytes, length_t=Uint8, copy=True)
+        ticket          = reader.get(bytes, length_t=Uint16, copy=True,
+                                     min_length=1)
+
+        # Read extensions
+        extensions = Extension.get_list_from_bytes(
+            reader.get_rest(),
+            msg_type=HandshakeType.new_session_ticket, max_length=2**16-2)
+
+        return cls(ticket_lifetime=ticket_lifetime,
+                   ticket_age_add=ticket_age_add,
+                   ticket_nonce=ticket_nonce,
+                   ticket=ticket,
+                   extensions=extensions).index_extensions()
+
+
+class TicketState(Struct):
+    # サーバが NewSessionTicket.ticket に暗号化して入れるセッションの状態。
+    # サーバはセッションの状態を保存しない（stateless）ので、再開に必要な情報は全てここに入れる。
+    """
+    struct {
+      CipherSuite cipher_suite;
+      uint32 ticket_age_add;
+      uint32 ticket_lifetime;
+      uint32 issued_at;            /* UNIX time [sec] */
+      uint32 max_early_data_size;
+      opaque psk<1..255>;
+    } TicketState;
+    """
+    members = [
+        Member(CipherSuite, 'cipher_suite'),
+        Member(Uint32, 'ticket_age_add'),
+        Member(Uint32, 'ticket_lifetime'),
+        Member(Uint32, 'issued_at',
+               default_factory=lambda: Uint32(int(time.time()))),
+        Member(Uint32, 'max_early_data_size', default=Uint32(0)),
+        Member(bytes, 'psk', length_t=Uint8),
+    ]
+
+    def __init__(self, **kwargs):
+        self.set_args(**kwargs)
+
+    def is_expired(self, now=None):
+        if now is None:
+            now = time.time()
+        return now > int(self.issued_at) + int(self.ticket_lifetime)
+
+    def get_expected_age(self, now=None):
+        """
+        サーバから見たチケットの経過時間 [ms] を返す．
+        """
+        if now is None:
+            now = time.time()
+        return int((now - int(self.issued_at)) * 1000)
+
+
+class SessionTicketKey:
+    """
+    TicketState を暗号化してチケットのバイト列にするための鍵．
+    チケットの先頭には鍵の ID を付けて，復号するときに使う鍵をすぐに選べるようにする．
+
+        ticket = key_id (4 bytes) || nonce (12 bytes) ||
+                 ChaCha20-Poly1305(key, nonce, TicketState, aad=key_id)
+    """
+    key_id_size = 4
+    key_size = 32
+    nonce_size = 12
+
+    def __init__(self, key=None, key_id=None, created_at=None):
+        if key is None:
+            key = os.urandom(self.key_size)
+        if key_id is None:
+            key_id = os.urandom(self.key_id_size)
+        assert len(key) == self.key_size
+        assert len(key_id) == self.key_id_size
+        self.key = bytes(key)
+        self.key_id = bytes(key_id)
+        self.created_at = int(time.time()) if created_at is None else int(created_at)
+        self.aead = ChaCha20Poly1305(self.key)
+
+    def seal(self, state) -> bytes:
+        nonce = os.urandom(self.nonce_size)
+        return self.key_id + nonce + \
+            self.aead.encrypt(nonce, bytes(state.to_bytes()), self.key_id)
+
+    def open(self, ticket) -> TicketState or None:
+        """
+        チケットを復号して TicketState を返す．
+        自分が発行したチケットでなければ None を返す．
+        """
+        ticket = bytes(ticket)
+        header_size = self.key_id_size + self.nonce_size
+        if len(ticket) < header_size + 16:
+            return None
+        if ticket[:self.key_id_size] != self.key_id:
+            return None
+        nonce = ticket[self.key_id_size:header_size]
+        ciphertext = ticket[header_size:]
+        try:
+            return TicketState.from_bytes(
+                self.aead.decrypt(nonce, ciphertext, self.key_id))
+        except InvalidTag:
+            return None
+
+
+class TicketKeyId(bytes):
+    """ opaque key_id[4]; """
+    _size = SessionTicketKey.key_id_size
+
+
+class TicketKeyBytes(bytes):
+    """ opaque key[32]; """
+    _size = SessionTicketKey.key_size
+
+
+class TicketKeyEntry(Struct):
+    """
+    struct {
+      opaque key_id[4];
+      uint32 created_at;           /* UNIX time [sec] */
+      opaque key[32];
+    } TicketKeyEntry;
+    """
+    members = [
+        Member(TicketKeyId, 'key_id'),
+        Member(Uint32, 'created_at'),
+        Member(TicketKeyBytes, 'key'),
+    ]
+
+    def __init__(self, **kwargs):
+        self.set_args(**kwargs)
+
+
+class TicketKeyFile(Struct):
+    # チケットの鍵を保存するファイルの中身．先頭の鍵が現在の鍵．
+    """
+    struct {
+      TicketKeyEntry keys<0..2^16-1>;
+    } TicketKeyFile;
+    """
+    members = [
+        Member(Listof(TicketKeyEntry), 'keys', length_t=Uint16),
+    ]
+
+    def __init__(self, **kwargs):
+        self.set_args(**kwargs)
+
+
+class TicketKeyRing:
+    """
+    チケットの暗号化に使う鍵の集合．現在の鍵1つと，以前の鍵いくつかを持つ．
+
+    * 新しいチケットは現在の鍵で暗号化する．
+    * rotation_interval [sec] ごとに新しい鍵を作って現在の鍵にする．
+      古い鍵は max_previous_keys 個まで残し，それまでに発行したチケットを復号できるようにする．
+    * チケットの先頭の鍵 ID で復号に使う鍵を辞書から O(1) で選ぶ．
+    * path を指定すると鍵をファイルに保存する．複数のプロセスが同じファイルを読むので，
+      再起動やプロセスを増やしたときもセッションを再開できる．
+      鍵の更新はロックを取ってから行い，ファイルは一時ファイルからの rename で置き換える．
+
+        ring = TicketKeyRing(path='/var/lib/tls13/ticket.keys')
+        ticket = ring.seal(ticket_state)
+        ticket_state = ring.open(ticket)
+    """
+    def __init__(self, path=None, rotation_interval=3600, max_previous_keys=2,
+                 reload_interval=1):
+        self.path = path
+        self.rotation_interval = rotation_interval
+        self.max_previous_keys = max_previous_keys
+        self.reload_interval = reload_interval
+        self.current = None
+        self.previous = []
+        self.keys = {}
+        self._file_id = None
+        self._checked_at = 0
+
+        if self.path is not None:
+            with _lock_file(self.path):
+                self.load()
+                if self.current is None:
+                    self._add_new_key()
+                    self.persist()
+        else:
+            self._add_new_key()
+
+    def seal(self, state) -> bytes:
+        self.rotate()
+        return self.current.seal(state)
+
+    def open(self, ticket) -> TicketState or None:
+        self.reload()
+        key = self.keys.get(bytes(ticket[:SessionTicketKey.key_id_size]))
+        if key is None:
+            return None
+        return key.open(ticket)
+
+    def rotate(self, now=None):
+        """
+        現在の鍵が rotation_interval より古ければ新しい鍵に切り替える．
+        """
+        if now is None:
+            now = time.time()
+        self.reload(now)
+        if now - self.current.created_at < self.rotation_interval:
+            return
+        if self.path is None:
+            self._add_new_key(now)
+            return
+        with _lock_file(self.path):
+            # 他のプロセスが先に鍵を更新しているかもしれないので読み直してから確認する
+            self.load()
+            if now - self.current.created_at < self.rotation_interval:
+                return
+            self._add_new_key(now)
+            self.persist()
+
+    def _add_new_key(self, now=None):
+        self._set_keys([SessionTicketKey(created_at=now)] +
+                       ([self.current] if self.current else []) + self.previous)
+
+    def _set_keys(self, keys):
+        keys = keys[:1 + self.max_previous_keys]
+        self.current = keys[0] if keys else None
+        self.previous = keys[1:]
+        self.keys = dict((key.key_id, key) for key in keys)
+
+    def reload(self, now=None):
+        """
+        他のプロセスがファイルを更新していれば読み直す．
+        stat を呼ぶのは reload_interval [sec] に1回だけにする．
+        """
+        if self.path is None:
+            return
+        if now is None:
+            now = time.time()
+        if now - self._checked_at < self.reload_interval:
+            return
+        self._checked_at = now
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if self._get_file_id(st) != self._file_id:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                file_id = self._get_file_id(os.fstat(f.fileno()))
+                data = f.read()
+        except FileNotFoundError:
+            return
+        key_file = TicketKeyFile.from_bytes(data)
+        self._set_keys([SessionTicketKey(key=entry.key,
+                                         key_id=entry.key_id,
+                                         created_at=entry.created_at)
+                        for entry in key_file.keys])
+        self._file_id = file_id
+
+    def persist(self):
+        key_file = TicketKeyFile(keys=[
+            TicketKeyEntry(key_id=TicketKeyId(key.key_id),
+                           created_at=Uint32(key.created_at),
+                           key=TicketKeyBytes(key.key))
+            for key in [self.current] + self.previous])
+
+        _replace_file(self.path, key_file.to_bytes())
+        self._file_id = self._get_file_id(os.stat(self.path))
+
+    @staticmethod
+    def _get_file_id(st):
+        # mtime の精度は粗いことがあるので，os.replace で変わる inode も見る
+        return (st.st_ino, st.st_mtime_ns)
+
+
+@contextlib.contextmanager
+def _lock_file(path):
+    # 同じファイルを使う複数のプロセスの間で排他制御する
+    fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def _replace_file(path, data):
+    # 書き込み途中のファイルを他のプロセスが読まないように，
+    # 同じディレクトリの一時ファイルに書いてから置き換える
+    tmp_path = '%s.tmp.%d' % (path, os.getpid())
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+class SessionTicket:
+    """
+    クライアントが NewSessionTicket から作るセッション再開用の情報．
+    次の ClientHello の pre_shared_key 拡張で identity として ticket を送る．
+    """
+    def __init__(self, ticket, psk, cipher_suite, ticket_age_add,
+                 ticket_lifetime, max_early_data_size=0, received_at=None):
+        self.ticket = bytes(ticket)
+        self.psk = bytes(psk)
+        self.cipher_suite = cipher_suite
+        self.ticket_age_add = int(ticket_age_add)
+        self.ticket_lifetime = int(ticket_lifetime)
+        self.max_early_data_size = int(max_early_data_size)
+        self.received_at = time.time() if received_at is None else received_at
+
+    @classmethod
+    def from_new_session_ticket(cls, nst, resumption_master_secret, cipher_suite):
+        from .keyexchange.messages import ExtensionType
+        from ..utils import cryptomath
+        hash_algo = CipherSuite.get_hash_algo_name(cipher_suite)
+        psk = cryptomath.gen_resumption_psk(
+            resumption_master_secret, nst.ticket_nonce, hash_algo)
+        early_data = nst.get_extension(ExtensionType.early_data)
+        max_early_data_size = \
+            int(early_data.max_early_data_size) if early_data else 0
+        return cls(ticket=nst.ticket,
+                   psk=psk,
+                   cipher_suite=cipher_suite,
+                   ticket_age_add=nst.ticket_age_add,
+                   ticket_lifetime=nst.ticket_lifetime,
+                   max_early_data_size=max_early_data_size)
+
+    # クライアントは7日より長くチケットを使ってはいけない (4.6.1)
+    max_ticket_lifetime = 604800
+
+    def is_expired(self, now=None):
+        if now is None:
+            now = time.time()
+        lifetime = min(self.ticket_lifetime, self.max_ticket_lifetime)
+        return now > self.received_at + lifetime
+
+    def get_obfuscated_ticket_age(self, now=None):
+        if now is None:
+            now = time.time()
+        ticket_age = int((now - self.received_at) * 1000)
+        return Uint32((ticket_age + self.ticket_age_add) % 2**32)
+
+
+class SessionTicketEntry(Struct):
+    # クライアントがファイルに保存するチケット1つ分．
+    # (host, port, alpn) ごとにチケットを分けて保存する．
+    """
+    struct {
+      opaque host<0..255>;
+      uint16 port;
+      opaque alpn<0..255>;
+      CipherSuite cipher_suite;
+      uint32 ticket_age_add;
+      uint32 ticket_lifetime;
+      uint32 received_at;          /* UNIX time [sec] */
+      uint32 max_early_data_size;
+      opaque psk<1..255>;
+      opaque ticket<1..2^16-1>;
+    } SessionTicketEntry;
+    """
+    members = [
+        Member(bytes, 'host', length_t=Uint8),
+        Member(Uint16, 'port'),
+        Member(bytes, 'alpn', length_t=Uint8),
+        Member(CipherSuite, 'cipher_suite'),
+        Member(Uint32, 'ticket_age_add'),
+        Member(Uint32, 'ticket_lifetime'),
+        Member(Uint32, 'received_at'),
+        Member(Uint32, 'max_early_data_size'),
+        Member(bytes, 'psk', length_t=Uint8),
+        Member(bytes, 'ticket', length_t=Uint16),
+    ]
+
+    def __init__(self, **kwargs):
+        self.set_args(**kwargs)
+
+    @classmethod
+    def from_session(cls, server, session):
+        host, port, alpn = server
+        return cls(host=host.encode(), port=Uint16(port), alpn=bytes(alpn),
+                   cipher_suite=session.cipher_suite,
+                   ticket_age_add=Uint32(session.ticket_age_add),
+                   ticket_lifetime=Uint32(session.ticket_lifetime),
+                   received_at=Uint32(int(session.received_at)),
+                   max_early_data_size=Uint32(session.max_early_data_size),
+                   psk=session.psk, ticket=session.ticket)
+
+    def get_server(self):
+        return (self.host.decode(), int(self.port), bytes(self.alpn))
+
+    def get_session(self) -> SessionTicket:
+        return SessionTicket(ticket=self.ticket,
+                             psk=self.psk,
+                             cipher_suite=self.cipher_suite,
+                             ticket_age_add=self.ticket_age_add,
+                             ticket_lifetime=self.ticket_lifetime,
+                             max_early_data_size=self.max_early_data_size,
+                             received_at=int(self.received_at))
+
+
+class SessionTicketFile(Struct):
+    """
+    struct {
+      SessionTicketEntry tickets<0..2^24-1>;
+    } SessionTicketFile;
+    """
+    members = [
+        Member(Listof(SessionTicketEntry), 'tickets', length_t=Uint24),
+    ]
+
+    def __init__(self, **kwargs):
+        self.set_args(**kwargs)
+
+
+class SessionTicketStore:
+    """
+    クライアントが受け取ったチケットを (host, port, alpn) ごとに保存する．
+
+    * pop は期限切れのチケットを捨ててから，一番新しいチケットを取り出して返す．
+      同じチケットを何度も使うと接続を紐付けられてしまうので，取り出したチケットは消す．
+    * 1つのサーバにつき max_tickets_per_server 個まで新しいものから順に残す．
+    * path を指定するとファイルに保存するので，クライアントを何度起動しても
+      前回までに受け取ったチケットでセッションを再開できる．
+
+        store = SessionTicketStore(path='.tls13_tickets')
+        session = store.pop('localhost', 50007)
+        ...
+        store.add('localhost', 50007, new_session)
+    """
+    def __init__(self, path=None, max_tickets_per_server=4):
+        self.path = path
+        self.max_tickets_per_server = max_tickets_per_server
+        # {(host, port, alpn): [SessionTicket, ...]} 新しいチケットが先頭
+        self.tickets = {}
+
+    def add(self, host, port, session, alpn=b''):
+        with self._transaction():
+            tickets = self.tickets.setdefault((host, port, bytes(alpn)), [])
+            tickets.append(session)
+            tickets.sort(key=lambda t: t.received_at, reverse=True)
+            del tickets[self.max_tickets_per_server:]
+
+    def pop(self, host, port, alpn=b'', now=None) -> SessionTicket or None:
+        with self._transaction(now):
+            tickets = self.tickets.get((host, port, bytes(alpn)))
+            if not tickets:
+                return None
+            return tickets.pop(0)
+
+    def prune(self, now=None):
+        """
+        期限切れのチケットを捨てる．
+        """
+        if now is None:
+            now = time.time()
+        for server, tickets in list(self.tickets.items()):
+            tickets[:] = [t for t in tickets if not t.is_expired(now)]
+            if len(tickets) == 0:
+                del self.tickets[server]
+
+    def __len__(self):
+        return sum(len(tickets) for tickets in self.tickets.values())
+
+    @contextlib.contextmanager
+    def _transaction(self, now=None):
+        # 他のプロセスが書き込んだチケットも使えるように，ファイルがあるときは
+        # ロックを取って読み直してから変更し，書き戻す
+        if self.path is None:
+            self.prune(now)
+            yield
+            return
+        with _lock_file(self.path):
+            self.load()
+            self.prune(now)
+            yield
+            self.persist()
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+        self.tickets = {}
+        if len(data) == 0:
+            return
+        # 壊れたファイル（古いクライアントが書き込みの途中で落ちたものなど）は
+        # 読み捨てて空から始める．次の persist で正しいファイルに置き換わる
+        try:
+            ticket_file = SessionTicketFile.from_bytes(data)
+            tickets = {}
+            for entry in ticket_file.tickets:
+                tickets.setdefault(entry.get_server(), []) \
+                    .append(entry.get_session())
+        except (ReaderParseError, RuntimeError) as e:
+            _trace.log(ERROR, "ignoring broken ticket file %s: %s", self.path, e)
+            return
+        self.tickets = tickets
+
+    def persist(self):
+        ticket_file = SessionTicketFile(tickets=[
+            SessionTicketEntry.from_session(server, session)
+            for server, tickets in self.tickets.items()
+            for session in tickets])
+        _replace_file(self.path, ticket_file.to_bytes())
@@ -1,3 +1,7 @@
 
+from .trace import *
 from .cryptomath import *
 from .connection import *
+from .antireplay import *
+from .psk import *
+from .pipeline import *
@@ -0,0 +1,100 @@
+
+# 8.2.  Client Hello Recording
+# https://tools.ietf.org/html/draft-ietf-tls-tls13-26#section-8.2
+
+__all__ = ['BloomFilter', 'AntiReplayFilter']
+
+import hashlib
+import math
+import time
+
+# 0-RTT の early data はリプレイ攻撃を防げないので，サーバは一定時間内に受け取った
+# ClientHello（の binder）を記録しておき，同じものが来たら early data を拒否する．
+# 記録には Bloom filter を使うので，メモリ使用量は受け取った ClientHello の数に
+# 依存せず一定になる．偽陽性のときは early data を拒否して 1-RTT に戻るだけなので安全．
+
+class BloomFilter:
+    """
+    capacity 個の要素を入れたときに偽陽性率が error_rate になる Bloom filter．
+    """
+    def __init__(self, capacity=100000, error_rate=1e-6):
+        assert capacity > 0 and 0 < error_rate < 1
+        num_bits = -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        self.num_bits = max(8, int(math.ceil(num_bits)))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # double hashing: h_i(x) = h1(x) + i * h2(x)
+        digest = hashlib.blake2b(bytes(item), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:], 'big') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(item))
+
+    def clear(self):
+        self.bits = bytearray(len(self.bits))
+        self.count = 0
+
+
+class AntiReplayFilter:
+    """
+    window [sec] ごとに切り替わる2つの Bloom filter で ClientHello を記録する．
+    記録した値は少なくとも window 秒間は検出できる．
+    それより古い ClientHello は，チケットの経過時間（obfuscated_ticket_age）と
+    サーバ側で求めた経過時間の差が window を超えるので，鮮度の確認で拒否される．
+
+        anti_replay = AntiReplayFilter(window=10)
+        if anti_replay.check_and_add(binder):
+            # early data を受け入れる
+    """
+    def __init__(self, window=10, capacity=100000, error_rate=1e-6):
+        self.window = window
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.current = BloomFilter(capacity, error_rate)
+        self.previous = BloomFilter(capacity, error_rate)
+        self.rotated_at = time.time()
+
+    def rotate(self, now=None):
+        if now is None:
+            now = time.time()
+        elapsed = now - self.rotated_at
+        if elapsed < self.window:
+            return
+        if elapsed >= 2 * self.window:
+            self.previous.clear()
+        else:
+            self.previous = self.current
+        self.current = BloomFilter(self.capacity, self.error_rate)
+        self.rotated_at = now
+
+    def check_and_add(self, item, now=None) -> bool:
+        """
+        item が記録されていなければ記録して True を返す（early data を受け入れてよい）．
+        既に記録されているとき，または記録できないときは False を返す．
+        """
+        self.rotate(now)
+        if item in self.current or item in self.previous:
+            return False
+        if self.current.count >= self.capacity:
+            # 容量を超えると偽陽性率が上がるので，次の切り替えまで early data は拒否する
+            return False
+        self.current.add(item)
+        return True
+
+    def is_fresh(self, client_ticket_age, expected_ticket_age) -> bool:
+        """
+        クライアントが送ってきたチケットの経過時間 [ms] と，サーバが求めた経過時間 [ms]
+        の差が window 以内のときに True を返す．
+        """
+        return abs(client_ticket_age - expected_ticket_age) <= self.window * 1000
@@ -1,42 +1,208 @@
 
 __all__ = [
-    'ClientConnection', 'ServerConnection',
+    'ClientConnection', 'ServerConnection', 'ConnectionStats',
 ]
 
 import socket
 
+from ..protocol.recordlayer import RecordFramer
+from ..protocol.state import ConnectionState
+from .trace import tracer, INFO
+from . import ktls
+
+_trace = tracer.category('connection')
+
 # ネットワーク通信部分の機能
 
 HOST = 'localhost' # The remote host
 PORT = 50007
 
+class ConnectionStats:
+    """
+    接続ごとの送受信のシステムコールの回数とバイト数．
+    """
+    def __init__(self):
+        self.send_calls = 0
+        self.recv_calls = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def __repr__(self):
+        return "ConnectionStats(send_calls=%d, recv_calls=%d, " \
+               "bytes_sent=%d, bytes_received=%d)" % \
+               (self.send_calls, self.recv_calls,
+                self.bytes_sent, self.bytes_received)
+
+
 class Connection:
+    def __init__(self, side='client'):
+        self.framer = RecordFramer()
+        self.stats = ConnectionStats()
+        # ネゴシエーションの結果と暗号は接続ごとに持つ
+        self.state = ConnectionState(side)
+
     def send_msg(self, byte_str):
         self.socket.sendall(byte_str)
+        self.stats.send_calls += 1
+        self.stats.bytes_sent += len(byte_str)
+
+    def send_buffers(self, buffers):
+        """
+        複数のバッファを sendmsg でまとめて送る（gather write）．
+        一部しか送れなかったときは残りを送り直す．
+        """
+        if not hasattr(self.socket, 'sendmsg'):
+            self.send_msg(b''.join(buffers))
+            return
+        buffers = [memoryview(buffer) for buffer in buffers]
+        while buffers:
+            sent = self.socket.sendmsg(buffers)
+            self.stats.send_calls += 1
+            self.stats.bytes_sent += sent
+            # 送れた分のバッファを取り除く
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers.pop(0))
+            if sent > 0:
+                buffers[0] = buffers[0][sent:]
+
+    def send_file(self, file) -> int:
+        """
+        ファイルを sendfile で送り，送ったバイト数を返す（kTLS で使う）．
+        カーネルがいくつのレコードに分けたかは分からないので，
+        送信の鍵のシーケンス番号はカーネルから読んで合わせる．
+        """
+        sent = self.socket.sendfile(file)
+        self.stats.send_calls += 1
+        self.stats.bytes_sent += sent
+        if self.state.kernel_tx:
+            self.state.write_crypto.seq_number = ktls.write_seq_number(self)
+        return sent
 
-    def recv_msg(self):
-        # TLSPlaintext の最大の大きさが 2^14 byte
-        return self.socket.recv(2**14 * 8)
+    def set_record_size_limit(self, record_size_limit):
+        """
+        自分が広告した record_size_limit (RFC 8449) を超える保護されたレコードを
+        受信したときに record_overflow にする．
+        """
+        # AEAD による増加分は 255 byte まで (5.2)
+        self.framer.max_fragment_size = min(record_size_limit, 2**14 + 1) + 255
+
+    def recv_record(self) -> memoryview:
+        """
+        レコードを1つ受信して返す．相手が接続を閉じたときは b'' を返す．
+        返すレコードは次に受信するまで有効（RecordFramer を参照）．
+        """
+        while True:
+            record = self.framer.next_record()
+            if record is not None:
+                return record
+            n = self.framer.recv_into(self.socket)
+            self.stats.recv_calls += 1
+            self.stats.bytes_received += n
+            if n == 0:
+                if len(self.framer) > 0:
+                    raise ConnectionError("connection closed in the middle of a record")
+                return b''
+
+    def recv_events(self, tls):
+        """
+        レコードを1つ受信して sans-I/O の接続 tls（main.tlsconnection.TLSConnection）に
+        渡し，起きたイベントのリストを返す．相手が接続を閉じたときは None を返す．
+        kTLS で受信するときは，カーネルが復号したレコードを渡す．
+        """
+        state = self.state
+        read_crypto = state.read_crypto
+        if state.kernel_rx and len(self.framer) == 0:
+            type, content = ktls.recv_record(self)
+            if type is None:
+                return None
+            events = tls.receive_content(type, content)
+        else:
+            # kTLS を有効にする前に受信バッファに入っていたレコードもここで渡す
+            record = self.recv_record()
+            if len(record) == 0:
+                return None
+            events = tls.receive_record(record)
+        if state.kernel_rx and state.read_crypto is not read_crypto:
+            # tls が KeyUpdate で更新した受信の鍵をカーネルにも渡す (4.6.3)
+            ktls.update_read_key(self)
+        return events
+
+    def drive(self, tls, event_type) -> list:
+        """
+        sans-I/O の接続 tls の送るバイト列を送信し，受信したレコードを渡すことを
+        event_type のイベントが起きるまで繰り返して，起きたイベントのリストを返す．
+        レコードは1つずつ渡すので，その後に届いたレコードは受信バッファに残る．
+        """
+        events = []
+        while True:
+            data = tls.data_to_send()
+            if data:
+                self.send_msg(data)
+            if any(isinstance(event, event_type) for event in events):
+                return events
+            received = self.recv_events(tls)
+            if received is None:
+                raise ConnectionError("connection closed during handshake")
+            events += received
+
+    def recv_app_data(self, tls) -> bytes:
+        """
+        ハンドシェイクの後にアプリケーションデータを1レコード分受信して返す．
+        相手が接続を閉じたとき，または close_notify を受け取ったときは b'' を返す．
+        KeyUpdate などのハンドシェイクメッセージは tls が処理する．
+        """
+        from ..main.tlsconnection import DataReceived
+        while True:
+            events = self.recv_events(tls)
+            if events is None:
+                return b''
+            data = [event.data for event in events
+                    if isinstance(event, DataReceived)]
+            if data:
+                return b''.join(data)
+            if tls.closed:
+                return b''
+
+    def send_kernel_key_update(self, request_update=False):
+        """
+        kTLS：KeyUpdate をカーネルに暗号化させて送り，送信の鍵を次の世代にする．
+        ユーザ空間で暗号化するときは RecordWriter や TLSConnection.send_key_update が送る．
+        """
+        ktls.send_key_update(self, request_update)
+        if _trace.info:
+            _trace.log(INFO, "KeyUpdate: write keys updated")
 
     def close(self):
+        # 別のスレッドが recv で待っているとソケットを閉じても FIN が送られないので，
+        # 先に shutdown して相手に FIN を送り，待っているスレッドも起こす
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         return self.socket.close()
 
 
 class ClientConnection(Connection):
     def __init__(self, host=HOST, port=PORT):
+        super().__init__(side='client')
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.connect((host, port))
         self.socket = self.sock
 
 
 class ServerConnection(Connection):
-    def __init__(self, host=HOST, port=PORT):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # prevent "Address already in use" error
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.bind((host, port))
-        self.sock.listen(1)
+    def __init__(self, host=HOST, port=PORT, sock=None):
+        super().__init__(side='server')
+        # sock に listen 中のソケットを渡すと，そのソケットで次の接続を待つ
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # prevent "Address already in use" error
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((host, port))
+            sock.listen(1)
+        self.sock = sock
         conn, addr = self.sock.accept()
         self.socket = conn
         self.addr = addr
-        print('Connected by', self.addr)
+        if _trace.info:
+            _trace.log(INFO, "Connected by %s", self.addr)
@@ -2,7 +2,9 @@
 __all__ = [
     'secureHash', 'secureHMAC',
     'HKDF_extract', 'HKDF_expand', 'HKDF_expand_label', 'derive_secret',
-    'transcript_hash', 'get_random_bytes', 'get_random_number',
+    'transcript_hash', 'gen_key_and_iv', 'gen_verify_data', 'gen_binder_key',
+    'gen_binder', 'gen_resumption_psk', 'gen_next_traffic_secret',
+    'get_random_bytes', 'get_random_number',
 ]
 
 import hmac
@@ -183,6 +185,60 @@ def gen_key_and_iv(secret, key_size, nonce_size, hash_algo='sha256'):
     write_iv  = HKDF_expand_label(secret, b'iv',  b'', nonce_size, hash_algo)
     return write_key, write_iv
 
+def gen_verify_data(base_key, messages, hash_algo='sha256'):
+    # https://tools.ietf.org/html/draft-ietf-tls-tls13-26#section-4.4.4
+    """
+    finished_key =
+        HKDF-Expand-Label(BaseKey, "finished", "", Hash.length)
+
+    verify_data =
+        HMAC(finished_key,
+             Transcript-Hash(Handshake Context,
+                             Certificate*, CertificateVerify*))
+    """
+    hash_size = getattr(hashlib, hash_algo)().digest_size
+    finished_key = HKDF_expand_label(base_key, b'finished', b'', hash_size, hash_algo)
+    return secureHMAC(finished_key, transcript_hash(messages, hash_algo), hash_algo)
+
+def gen_binder_key(early_secret, external=False, hash_algo='sha256'):
+    # https://tools.ietf.org/html/draft-ietf-tls-tls13-26#section-7.1
+    """
+    binder_key =
+        Derive-Secret(Early Secret, "ext binder" | "res binder", "")
+    """
+    label = b"ext binder" if external else b"res binder"
+    return derive_secret(early_secret, label, b"", hash_algo)
+
+def gen_binder(binder_key, truncated_hello, hash_algo='sha256'):
+    # https://tools.ietf.org/html/draft-ietf-tls-tls13-26#section-4.2.11.2
+    """
+    PskBinderEntry は Finished と同じ方法で計算する．
+    ただし BaseKey は binder_key で，Transcript-Hash には
+    binders リストを取り除いた ClientHello（Truncate(ClientHello1)）を使う．
+    """
+    return gen_verify_data(binder_key, truncated_hello, hash_algo)
+
+def gen_resumption_psk(resumption_master_secret, ticket_nonce, hash_algo='sha256'):
+    # https://tools.ietf.org/html/draft-ietf-tls-tls13-26#section-4.6.1
+    """
+    HKDF-Expand-Label(resumption_master_secret,
+                      "resumption", ticket_nonce, Hash.length)
+    """
+    hash_size = getattr(hashlib, hash_algo)().digest_size
+    return HKDF_expand_label(resumption_master_secret, b'resumption',
+                             ticket_nonce, hash_size, hash_algo)
+
+def gen_next_traffic_secret(traffic_secret, hash_algo='sha256'):
+    # https://tools.ietf.org/html/draft-ietf-tls-tls13-26#section-7.2
+    """
+    application_traffic_secret_N+1 =
+        HKDF-Expand-Label(application_traffic_secret_N,
+                          "traffic upd", "", Hash.length)
+    """
+    hash_size = getattr(hashlib, hash_algo)().digest_size
+    return HKDF_expand_label(traffic_secret, b'traffic upd', b'',
+                             hash_size, hash_algo)
+
 
 # FFDHEで使用するSecretKeyの生成(乱数)に使用する関数たち
 
@@ -0,0 +1,205 @@
+
+# Linux の kernel TLS (kTLS)
+# https://www.kernel.org/doc/html/latest/networking/tls.html
+#
+# ハンドシェイクが終わったら application_traffic_secret から作った鍵と IV，
+# レコードのシーケンス番号をカーネルに渡し，その後のレコードの暗号化・復号を
+# カーネルに任せる．送信は平文をそのまま send / sendfile すればよい．
+# カーネルが tls ULP に対応していないときや，暗号スイートに対応していないときは
+# 今まで通りユーザ空間で暗号化・復号する．
+#
+#     tx, rx = ktls.offload(server_conn)
+#
+# offload した後は ConnectionState.kernel_tx / kernel_rx が True になり，
+# RecordWriter と Connection.recv_events がカーネルを使う．
+
+__all__ = ['available', 'crypto_info', 'offload', 'recv_record',
+           'send_key_update', 'update_read_key', 'write_seq_number']
+
+import errno
+import socket
+import struct
+
+from ..protocol.ciphersuite import CipherSuite
+from ..protocol.recordlayer import ContentType
+from ..metastruct import Uint8
+from .trace import tracer, INFO
+
+_trace = tracer.category('connection')
+
+# <linux/tcp.h>, <linux/tls.h>
+TCP_ULP = getattr(socket, 'TCP_ULP', 31)
+SOL_TLS = getattr(socket, 'SOL_TLS', 282)
+TLS_TX = 1
+TLS_RX = 2
+TLS_SET_RECORD_TYPE = 1
+TLS_GET_RECORD_TYPE = 2
+TLS_1_3_VERSION = 0x0304
+
+TLS_CIPHER_AES_GCM_128        = 51
+TLS_CIPHER_AES_GCM_256        = 52
+TLS_CIPHER_CHACHA20_POLY1305  = 54
+
+# 暗号スイート -> (cipher_type, salt の長さ)
+# AES-GCM では IV の先頭4バイトが salt，残りの8バイトが iv になる
+_ciphers = {
+    CipherSuite.TLS_AES_128_GCM_SHA256.value:       (TLS_CIPHER_AES_GCM_128, 4),
+    CipherSuite.TLS_AES_256_GCM_SHA384.value:       (TLS_CIPHER_AES_GCM_256, 4),
+    CipherSuite.TLS_CHACHA20_POLY1305_SHA256.value: (TLS_CIPHER_CHACHA20_POLY1305, 0),
+}
+
+# 1回の recvmsg で受け取る平文の大きさ
+_recv_size = 2**14
+
+
+def available() -> bool:
+    """
+    カーネルが tls ULP に対応しているか（ループバックの TCP 接続で試す）．
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        with socket.create_connection(listener.getsockname()) as sock:
+            sock.setsockopt(socket.IPPROTO_TCP, TCP_ULP, b'tls')
+        return True
+    except (OSError, AttributeError):
+        return False
+    finally:
+        listener.close()
+
+
+def crypto_info(cipher_suite, crypto, seq_number=None) -> bytes:
+    """
+    setsockopt(SOL_TLS, TLS_TX / TLS_RX) に渡す struct tls12_crypto_info_* を作る．
+
+        struct tls12_crypto_info_chacha20_poly1305 {
+            struct tls_crypto_info info;   /* u16 version, u16 cipher_type */
+            unsigned char iv[12];
+            unsigned char key[32];
+            unsigned char salt[0];
+            unsigned char rec_seq[8];
+        };
+
+    AES-GCM では iv[8], key, salt[4], rec_seq[8] の順になる．
+    seq_number を省略すると crypto のシーケンス番号を使う．
+    """
+    cipher = _ciphers.get(cipher_suite.value)
+    if cipher is None:
+        raise NotImplementedError(
+            "kTLS does not support %s" % CipherSuite.label(cipher_suite))
+    cipher_type, salt_size = cipher
+    if seq_number is None:
+        seq_number = crypto.seq_number
+    iv = bytes(crypto.nonce_raw)
+    salt, iv = iv[:salt_size], iv[salt_size:]
+    return struct.pack('=HH', TLS_1_3_VERSION, cipher_type) + \
+        iv + bytes(crypto.key_raw) + salt + seq_number.to_bytes(8, 'big')
+
+
+def offload(conn, tx=True, rx=True):
+    """
+    conn の送信（tx）と受信（rx）をカーネルに任せ，(tx, rx) に実際に任せたかを返す．
+    conn.state の application_traffic_secret の暗号を設定した後に呼ぶ．
+    受信バッファに途中までのレコードが残っているときは受信は任せない．
+    """
+    state = conn.state
+    if state.cipher_suite is None or state.cipher_suite.value not in _ciphers:
+        return (False, False)
+    sock = conn.socket
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, TCP_ULP, b'tls')
+    except (OSError, AttributeError) as e:
+        _trace.log(INFO, "kTLS is not available: %s", e)
+        return (False, False)
+
+    if tx:
+        try:
+            sock.setsockopt(SOL_TLS, TLS_TX,
+                            crypto_info(state.cipher_suite, state.write_crypto))
+            state.kernel_tx = True
+        except OSError as e:
+            _trace.log(INFO, "kTLS TX is not available: %s", e)
+
+    if rx:
+        # 既にユーザ空間で受信したレコードはユーザ空間で復号するので，
+        # カーネルはその次のシーケンス番号から始める
+        buffered = conn.framer.buffered_records()
+        if buffered is None:
+            _trace.log(INFO, "kTLS RX: a partial record is buffered")
+        else:
+            seq_number = state.read_crypto.seq_number + buffered
+            try:
+                sock.setsockopt(SOL_TLS, TLS_RX, crypto_info(
+                    state.cipher_suite, state.read_crypto, seq_number))
+                state.kernel_rx = True
+            except OSError as e:
+                _trace.log(INFO, "kTLS RX is not available: %s", e)
+
+    return (state.kernel_tx, state.kernel_rx)
+
+
+def write_seq_number(conn) -> int:
+    """
+    カーネルが次に送るレコードのシーケンス番号を getsockopt(SOL_TLS, TLS_TX) で読む．
+    """
+    state = conn.state
+    size = len(crypto_info(state.cipher_suite, state.write_crypto))
+    info = conn.socket.getsockopt(SOL_TLS, TLS_TX, size)
+    return int.from_bytes(info[-8:], 'big')
+
+
+def recv_record(conn):
+    """
+    カーネルが復号したレコードの (ContentType, content) を返す．
+    相手が接続を閉じたときは (None, b'')．
+    application_data のレコードは続けて届いたものがまとめて返ることがある．
+    """
+    try:
+        data, ancdata, flags, _ = conn.socket.recvmsg(
+            _recv_size, socket.CMSG_SPACE(1))
+    except OSError as e:
+        if e.errno == errno.EBADMSG:
+            raise RuntimeError('aead_decrypt Error')
+        raise
+    conn.stats.recv_calls += 1
+    conn.stats.bytes_received += len(data)
+    if len(data) == 0 and not ancdata:
+        return (None, b'')
+    type = ContentType.application_data
+    for level, cmsg_type, cmsg_data in ancdata:
+        if level == SOL_TLS and cmsg_type == TLS_GET_RECORD_TYPE:
+            type = Uint8(cmsg_data[0])
+    return (type, data)
+
+
+def send_key_update(conn, request_update=False):
+    """
+    KeyUpdate を今の鍵でカーネルに暗号化させて送り，送信の鍵を次の世代にする．
+    カーネルに新しい鍵を渡せない（鍵の更新に対応していない）ときは RuntimeError．
+    """
+    state = conn.state
+    message = state.key_update_message(request_update)
+    record_type = [(SOL_TLS, TLS_SET_RECORD_TYPE,
+                    ContentType.handshake.to_bytes())]
+    conn.socket.sendmsg([message], record_type)
+    conn.stats.send_calls += 1
+    conn.stats.bytes_sent += len(message)
+    state.update_write_crypto()
+    try:
+        conn.socket.setsockopt(SOL_TLS, TLS_TX,
+                               crypto_info(state.cipher_suite, state.write_crypto))
+    except OSError as e:
+        raise RuntimeError("kTLS does not support KeyUpdate: %s" % e)
+
+
+def update_read_key(conn):
+    """
+    KeyUpdate を受け取って次の世代にした受信の鍵をカーネルに渡す．
+    """
+    state = conn.state
+    try:
+        conn.socket.setsockopt(SOL_TLS, TLS_RX,
+                               crypto_info(state.cipher_suite, state.read_crypto))
+    except OSError as e:
+        raise RuntimeError("kTLS does not support KeyUpdate: %s" % e)
@@ -0,0 +1,165 @@
+
+# 送受信のパイプライン
+#
+# 1つのスレッドで送受信すると，ソケットの読み書きと AEAD の暗号化・復号が交互になり
+# 重ならない．DuplexPipeline はハンドシェイクが終わった接続に
+#
+#   - 受信スレッド：レコードを受信・復号して，アプリケーションより先に読んでおく
+#   - 送信スレッド：アプリケーションが渡した平文を暗号化して送信する
+#
+# を付ける．どちらのキューも大きさに上限があるので，アプリケーションが読まなければ
+# 受信スレッドが止まり（TCP のウィンドウが閉じる），送信が追いつかなければ send が待つ．
+#
+# 受信の鍵（state.read_*）は受信スレッドだけが，送信の鍵（state.write_*）は
+# 送信スレッドだけが変更する．相手から KeyUpdate で鍵の更新を求められたときは，
+# 次のアプリケーションデータの前に送信スレッドが KeyUpdate を送る (4.6.3)．
+
+__all__ = ['DuplexPipeline']
+
+import queue
+import threading
+
+# 受信キューでデータの終わりを表す
+_EOF = object()
+
+
+class DuplexPipeline:
+    """
+    conn（Connection），ハンドシェイクが終わった tls（main.tlsconnection.TLSConnection）と，
+    その接続で使う RecordWriter からパイプラインを作る．受信したレコードは
+    受信スレッドが tls に渡す．recv / send / flush / close はアプリケーションの
+    スレッド1つから呼ぶ．
+
+        pipeline = DuplexPipeline(server_conn, tls, writer)
+        data = pipeline.recv()
+        pipeline.send(response)
+        pipeline.close()
+
+    受信スレッドで起きたエラーは，それより前に受信したデータを全て recv で返した後に
+    recv から送出される．送信スレッドで起きたエラーは次の send / flush / close から
+    送出される．
+    """
+    # send に渡したファイルやイテラブルを読んで送信キューに入れる大きさ
+    chunk_size = 2**16
+
+    def __init__(self, conn, tls, writer, recv_queue_size=16, send_queue_size=16):
+        self.conn = conn
+        self.tls = tls
+        self.writer = writer
+        self.recv_queue = queue.Queue(maxsize=recv_queue_size)
+        self.send_queue = queue.Queue(maxsize=send_queue_size)
+        self.recv_error = None
+        self.send_error = None
+        self.eof = False
+        self.reader = threading.Thread(target=self._read_loop, daemon=True)
+        self.sender = threading.Thread(target=self._send_loop, daemon=True)
+        self.reader.start()
+        self.sender.start()
+
+    def _read_loop(self):
+        try:
+            while True:
+                data = self.conn.recv_app_data(self.tls)
+                if len(data) == 0:
+                    break
+                self.recv_queue.put(data)
+            self.recv_queue.put(_EOF)
+        except Exception as e:
+            self.recv_queue.put(e)
+
+    def _send_loop(self):
+        while True:
+            data = self.send_queue.get()
+            try:
+                if data is None:
+                    return
+                if self.send_error is None:
+                    self.writer.write(data)
+            except Exception as e:
+                # エラーの後に送るデータは捨てる（キューは空にして send を待たせない）
+                self.send_error = e
+            finally:
+                self.send_queue.task_done()
+
+    def recv(self, timeout=None) -> bytes:
+        """
+        復号したアプリケーションデータを1レコード分返す．相手が閉じたら b'' を返す．
+        timeout [sec] 以内に届かなければ queue.Empty を送出する．
+        """
+        if self.recv_error is not None:
+            raise self.recv_error
+        if self.eof:
+            return b''
+        item = self.recv_queue.get(timeout=timeout)
+        if item is _EOF:
+            self.eof = True
+            return b''
+        if isinstance(item, Exception):
+            self.recv_error = item
+            raise item
+        return item
+
+    def send(self, data, timeout=None) -> int:
+        """
+        data を送信キューに入れて，入れた平文のバイト数を返す．
+        キューがいっぱいのときは空くまで待つ（timeout を過ぎたら queue.Full）．
+        ファイルやイテラブルはこのスレッドで読んでから渡すので，
+        send から戻った後に閉じてもよい．
+        """
+        self._raise_send_error()
+        queued = 0
+        for chunk in self._iter_chunks(data):
+            if len(chunk) == 0:
+                continue
+            self.send_queue.put(chunk, timeout=timeout)
+            queued += len(chunk)
+        return queued
+
+    def _iter_chunks(self, data):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            # 呼び出し側が後から書き換えても影響しないようにコピーする
+            yield bytes(data)
+        elif hasattr(data, 'read'):
+            while True:
+                chunk = data.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        else:
+            for chunk in data:
+                yield bytes(chunk)
+
+    def _raise_send_error(self):
+        if self.send_error is not None:
+            raise self.send_error
+
+    @property
+    def pending_sends(self) -> int:
+        """
+        まだ送信スレッドが処理していない送信キューの要素の数．
+        """
+        return self.send_queue.qsize()
+
+    @property
+    def pending_recvs(self) -> int:
+        """
+        復号済みでまだ recv で返していない受信キューの要素の数．
+        """
+        return self.recv_queue.qsize()
+
+    def flush(self):
+        """
+        送信キューに入れたデータを全て送り終わるまで待つ．
+        """
+        self.send_queue.join()
+        self._raise_send_error()
+
+    def close(self):
+        """
+        送信キューのデータを送り終えてから送信スレッドを止める．
+        受信スレッドは相手が接続を閉じるか，conn を閉じたときに止まる．
+        """
+        if self.sender.is_alive():
+            self.send_queue.put(None)
+            self.sender.join()
+        self._raise_send_error()
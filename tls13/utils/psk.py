@@ -0,0 +1,77 @@
+
+# 4.2.11.  Pre-Shared Key Extension
+# https://tools.ietf.org/html/draft-ietf-tls-tls13-26#section-4.2.11
+
+__all__ = ['ExternalPsk', 'ExternalPskTable']
+
+import hashlib
+
+from .cryptomath import HKDF_extract, gen_binder_key
+from ..protocol.ciphersuite import CipherSuite
+
+# 外部 PSK：あらかじめ両方の端点に配っておいた (identity, key, hash) で認証する．
+# 証明書を使わないので Certificate / CertificateVerify を省略でき，
+# psk_ke モードでは (EC)DHE の鍵共有も省略できる．
+
+class ExternalPsk:
+    """
+    外部から与えられた PSK．鍵は変わらないので，early secret と
+    binder_key はここで1度だけ計算しておき，ハンドシェイクごとには計算しない．
+
+        psk = ExternalPsk(b'client1', bytes.fromhex('...'), 'sha256')
+    """
+    def __init__(self, identity, key, hash_algo='sha256'):
+        assert len(identity) > 0 and len(key) > 0
+        self.identity = bytes(identity)
+        self.key = bytes(key)
+        self.hash_algo = hash_algo
+        self.hash_size = hashlib.new(hash_algo).digest_size
+        self.early_secret = \
+            HKDF_extract(bytearray(self.hash_size), self.key, hash_algo)
+        self.binder_key = \
+            gen_binder_key(self.early_secret, external=True, hash_algo=hash_algo)
+
+    @classmethod
+    def from_string(cls, spec):
+        """
+        "identity:hexkey" または "identity:hexkey:hash" の形式から作る．
+        """
+        fields = spec.split(':')
+        if len(fields) not in (2, 3):
+            raise ValueError("PSK must be 'identity:hexkey[:hash]': %r" % spec)
+        hash_algo = fields[2] if len(fields) == 3 else 'sha256'
+        return cls(fields[0].encode(), bytes.fromhex(fields[1]), hash_algo)
+
+    def is_usable_with(self, cipher_suite) -> bool:
+        # PSK は決められたハッシュ関数の暗号スイートでしか使えない (4.2.11)
+        return CipherSuite.get_hash_algo_name(cipher_suite) == self.hash_algo
+
+
+class ExternalPskTable:
+    """
+    サーバが受け入れる外部 PSK の表．identity から O(1) で引ける．
+    ファイルには1行に1つ "identity:hexkey[:hash]" を書く（# 以降はコメント）．
+    """
+    def __init__(self, psks=()):
+        self.psks = {}
+        for psk in psks:
+            self.add(psk)
+
+    @classmethod
+    def load(cls, path):
+        table = cls()
+        with open(path) as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    table.add(ExternalPsk.from_string(line))
+        return table
+
+    def add(self, psk):
+        self.psks[psk.identity] = psk
+
+    def get(self, identity) -> ExternalPsk or None:
+        return self.psks.get(bytes(identity))
+
+    def __len__(self):
+        return len(self.psks)
@@ -0,0 +1,239 @@
+
+# トレース（デバッグ出力）
+#
+# レコードやハンドシェイクメッセージ，鍵の値などのデバッグ出力はカテゴリとレベルで
+# 出し分ける．出力先（sink）が無いとき，またはレベルが足りないときは，
+# 呼び出し側は真偽値の属性を1つ確認するだけで，hexdump や __repr__ は実行しない．
+#
+#     from ..utils.trace import tracer, DEBUG
+#     _trace = tracer.category('record')
+#
+#     if _trace.debug:
+#         _trace.log(DEBUG, "restore after:\n%s", hexdump(data))
+#
+# メッセージの書式化（msg % args）も，sink に渡すときに1度だけ行う．
+
+__all__ = [
+    'ERROR', 'INFO', 'DEBUG', 'TraceCategory', 'TraceRecord', 'Tracer',
+    'StreamSink', 'FileSink', 'RingBufferSink', 'tracer',
+]
+
+import collections
+import sys
+import time
+
+# レベル：数字が大きいほど詳しい
+ERROR = 1
+INFO  = 2
+DEBUG = 3
+
+_level_names = {ERROR: 'error', INFO: 'info', DEBUG: 'debug'}
+_level_values = {name: level for level, name in _level_names.items()}
+
+
+class TraceCategory:
+    """
+    名前付きのカテゴリ．error / info / debug 属性はそのレベルの出力が
+    有効かどうかを表し，Tracer の設定が変わったときにだけ更新される．
+    """
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+        self.level = None
+        self.error = False
+        self.info  = False
+        self.debug = False
+
+    def _set_level(self, level):
+        # level が None のときは出力しない
+        self.level = level
+        enabled = level is not None
+        self.error = enabled and level >= ERROR
+        self.info  = enabled and level >= INFO
+        self.debug = enabled and level >= DEBUG
+
+    def enabled_for(self, level) -> bool:
+        return self.level is not None and level <= self.level
+
+    def log(self, level, msg, *args):
+        if self.enabled_for(level):
+            self.tracer.emit(self, level, msg, args)
+
+
+class TraceRecord:
+    """
+    sink に渡す1つの出力．message は書式化した後の文字列．
+    """
+    def __init__(self, category, level, message, created=None):
+        self.category = category
+        self.level = level
+        self.message = message
+        self.created = time.time() if created is None else created
+
+    @property
+    def level_name(self) -> str:
+        return _level_names.get(self.level, str(self.level))
+
+    def format(self) -> str:
+        return "[%s] %s" % (self.category, self.message)
+
+    def __repr__(self):
+        return 'TraceRecord(%r, %s, %r)' % \
+               (self.category, self.level_name, self.message)
+
+
+class Tracer:
+    """
+    カテゴリごとのレベルと出力先を管理する．
+
+        tracer.add_sink(StreamSink())
+        tracer.set_level(INFO)                  # 全てのカテゴリ
+        tracer.set_level(DEBUG, 'handshake')    # handshake だけ詳しく
+    """
+    def __init__(self):
+        self.categories = {}
+        self.sinks = []
+        self.default_level = None
+        self.levels = {}
+
+    def category(self, name) -> TraceCategory:
+        category = self.categories.get(name)
+        if category is None:
+            category = TraceCategory(self, name)
+            self.categories[name] = category
+            self._update(category)
+        return category
+
+    def set_level(self, level, category=None):
+        """
+        category を省略すると，個別に設定していないカテゴリのレベルを変える．
+        level に None を渡すとそのカテゴリは出力しない．
+        """
+        if isinstance(level, str):
+            level = self.parse_level(level)
+        if category is None:
+            self.default_level = level
+        else:
+            self.levels[category] = level
+        self._update_all()
+
+    def configure(self, spec):
+        """
+        "info" や "info,record=debug,secret=debug" の形式でレベルを設定する．
+        """
+        for item in spec.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            if '=' in item:
+                name, level = item.split('=', 1)
+                self.set_level(level.strip(), name.strip())
+            else:
+                self.set_level(item)
+
+    def setup(self, spec, path=None):
+        """
+        コマンドラインの --trace / --trace-file から設定する．
+        path を省略すると stderr に出力する．
+        """
+        self.reset()
+        self.configure(spec)
+        if self.default_level is not None or \
+           any(level is not None for level in self.levels.values()):
+            self.add_sink(FileSink(path) if path else StreamSink())
+
+    @staticmethod
+    def parse_level(name):
+        if name in ('off', 'none'):
+            return None
+        if name not in _level_values:
+            raise ValueError("unknown trace level: %r" % name)
+        return _level_values[name]
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+        self._update_all()
+        return sink
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+        self._update_all()
+
+    def reset(self):
+        """
+        全ての設定を消して出力しない状態に戻す．
+        """
+        for sink in self.sinks:
+            sink.close()
+        self.sinks = []
+        self.default_level = None
+        self.levels = {}
+        self._update_all()
+
+    def _update(self, category):
+        if not self.sinks:
+            category._set_level(None)
+        else:
+            category._set_level(
+                self.levels.get(category.name, self.default_level))
+
+    def _update_all(self):
+        for category in self.categories.values():
+            self._update(category)
+
+    def emit(self, category, level, msg, args):
+        message = msg % args if args else str(msg)
+        record = TraceRecord(category.name, level, message)
+        for sink in self.sinks:
+            sink.write(record)
+
+
+class StreamSink:
+    """
+    ストリーム（既定は sys.stderr）に1行ずつ書き出す．
+    """
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def write(self, record):
+        stream = self.stream or sys.stderr
+        stream.write(record.format() + '\n')
+
+    def close(self):
+        pass
+
+
+class FileSink(StreamSink):
+    """
+    ファイルに書き出す．
+    """
+    def __init__(self, path, mode='a'):
+        super().__init__(open(path, mode, encoding='utf-8'))
+
+    def close(self):
+        self.stream.close()
+
+
+class RingBufferSink:
+    """
+    最新の capacity 個の出力をメモリに残す．エラーが起きたときに直前の出力だけを
+    取り出したいときに使う．
+    """
+    def __init__(self, capacity=1000):
+        self.records = collections.deque(maxlen=capacity)
+
+    def write(self, record):
+        self.records.append(record)
+
+    def dump(self) -> str:
+        return '\n'.join(record.format() for record in self.records)
+
+    def clear(self):
+        self.records.clear()
+
+    def close(self):
+        pass
+
+
+# プロセス全体で使うトレーサ．既定では何も出力しない．
+tracer = Tracer()